@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import UniqueConstraint
+
+from cloudhands.burst.index import Base
+
+__doc__ = """
+The providers at which each membership has been activated, so that a
+partly activated membership is completed after a restart.
+
+The table is made by :py:func:`cloudhands.burst.index.create`.
+"""
+
+
+class ActivationEntry(Base):
+    """
+    A provider at which the user of a membership has been added.
+    """
+
+    __tablename__ = "burst_activations"
+    __table_args__ = (UniqueConstraint("membership", "provider"),)
+
+    id = Column("id", Integer, primary_key=True)
+    membership = Column("membership", String(32), nullable=False)
+    provider = Column("provider", String(255), nullable=False)
+    at = Column("at", DateTime, nullable=False)
+
+
+def activated(session, uuid):
+    """
+    :returns: The set of providers at which a membership has been
+        activated.
+    """
+    return {
+        provider for provider, in session.query(
+            ActivationEntry.provider).filter(
+            ActivationEntry.membership == uuid).all()}
+
+
+def record_activations(session, uuid, providers, at):
+    """
+    Record the providers at which a membership has been activated.
+
+    :returns: The set of all those providers.
+    """
+    rv = activated(session, uuid)
+    session.add_all(
+        ActivationEntry(membership=uuid, provider=i, at=at)
+        for i in set(providers) - rv)
+    session.commit()
+    return rv.union(providers)
@@ -12,8 +12,16 @@ import logging
 import sqlite3
 import warnings
 
+from sqlalchemy import and_
+from sqlalchemy import func
+
+from cloudhands.burst.health import CircuitOpen
+from cloudhands.burst.health import Health
+from cloudhands.burst.index import create
 from cloudhands.common.connectors import initialise
 from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import State
+from cloudhands.common.schema import Touch
 
 
 Job = namedtuple("Job", ["uuid", "token", "artifact"])
@@ -29,6 +37,30 @@ class Agent:
     def queue(args, config, loop=None):
         return asyncio.Queue(loop=loop)
 
+    #: Exceptions which show a provider can't be reached at the moment.
+    unreachable = (CircuitOpen, OSError, asyncio.TimeoutError)
+
+    def postpone(self, loop, job, providerName):
+        """
+        Put the job back on the queue for when its provider may be
+        tried again. The job stays pending meanwhile.
+        """
+        breaker = Health()(providerName)
+        delay = max(breaker.remaining(), breaker.backoff)
+        loop.call_later(delay, self.work.put_nowait, job)
+        return delay
+
+    def postponed(self, loop, job, providerName):
+        """
+        If the provider's circuit is open, postpone the job.
+
+        :returns: True if the job was postponed.
+        """
+        if Health()(providerName).ready():
+            return False
+        self.postpone(loop, job, providerName)
+        return True
+
     @property
     def callbacks(self):
         raise NotImplementedError
@@ -41,6 +73,74 @@ class Agent:
         raise NotImplementedError
 
 
+@asyncio.coroutine
+def collect(workQ, window, limit=None, loop=None):
+    """
+    Wait for a job, then gather any others which arrive within
+    `window` seconds so they may be dealt with as a batch.
+    """
+    loop = loop or asyncio.get_event_loop()
+    rv = [(yield from workQ.get())]
+    end = loop.time() + window
+    while limit is None or len(rv) < limit:
+        try:
+            rv.append(workQ.get_nowait())
+        except asyncio.QueueEmpty:
+            pause = end - loop.time()
+            if pause <= 0:
+                break
+            yield from asyncio.sleep(min(pause, 0.1), loop=loop)
+    return rv
+
+
+def latest(session, artifact, state=None, offset=0, limit=None):
+    """
+    Query the latest state of each artifact of a type.
+
+    :param artifact: An artifact class, eg: `Appliance`.
+    :param str state: If given, select only artifacts whose latest state
+        has this name.
+    :returns: A query of lightweight rows, ordered by artifact id. Each row
+        has the attributes `id`, `uuid`, `state` and `at`. Of several
+        Touches at the same time, the last one added is taken.
+    """
+    recent = session.query(
+        Touch.artifact_id, func.max(Touch.at).label("at")).group_by(
+        Touch.artifact_id).subquery()
+    newest = session.query(
+        func.max(Touch.id).label("id")).join(
+        recent, and_(
+            recent.c.artifact_id == Touch.artifact_id,
+            recent.c.at == Touch.at)).group_by(
+        Touch.artifact_id).subquery()
+    rv = session.query(
+        artifact.id, artifact.uuid,
+        State.name.label("state"), Touch.at).join(
+        Touch, Touch.artifact_id == artifact.id).join(
+        newest, newest.c.id == Touch.id).join(
+        State, Touch.state_id == State.id)
+    if state:
+        rv = rv.filter(State.name == state)
+    rv = rv.order_by(artifact.id)
+    if offset:
+        rv = rv.offset(offset)
+    if limit is not None:
+        rv = rv.limit(limit)
+    return rv
+
+
+def select(session, artifact, state=None, offset=0, limit=None):
+    """
+    Return the artifacts of a type whose latest state is `state`.
+    The arguments are as for :py:func:`latest`.
+    """
+    ids = [i.id for i in latest(session, artifact, state, offset, limit)]
+    if not ids:
+        return []
+    return session.query(artifact).filter(
+        artifact.id.in_(ids)).order_by(artifact.id).all()
+
+
 @singledispatch
 def message_handler(msg, *args, **kwargs):
     warnings.warn("No handler for {}".format(type(msg)))
@@ -52,6 +152,7 @@ def operate(loop, msgQ, workers, args, config):
     log = logging.getLogger("cloudhands.burst.operate")
     session = Registry().connect(sqlite3, args.db).session
     initialise(session)
+    create(session)
     tasks = [asyncio.Task(w(loop, msgQ, session)) for w in workers]
     pending = set()
     log.info("Starting task scheduler.")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import datetime
+import logging
+
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Component
+from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import NATRouting
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import Touch
+
+__doc__ = """
+Public IP addresses are allocated to a subscription as
+:py:class:`IPAddress` resources. An address is in use for as long as an
+appliance holds a :py:class:`NATRouting` to it. It is released again when the
+appliance goes for deletion.
+
+A reservation is recorded in the database as soon as it is made, so that
+it survives a restart and is seen by other processes.
+"""
+
+
+class IPAllocator:
+    """
+    An index of the public IP addresses free for NAT routing.
+
+    Free addresses are indexed by subscription. Each subscription's pool is
+    loaded from the database the first time it is needed. Reservations are
+    indexed by provider and appliance uuid.
+
+    Reservation and release do not yield to the event loop, so agents may
+    call them from concurrent jobs. A reservation is committed as a
+    :py:class:`NATRouting` on a new Touch of the appliance. If another
+    process has routed the same address meanwhile, the reservation is
+    withdrawn and the next free address tried.
+    """
+
+    _shared_state = {}
+
+    released = ("pre_delete", "deleted")
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "free"):
+            self.pools = {}
+            self.owners = {}
+            self.free = {}
+            self.held = {}
+
+    def holdings(self, session, provider):
+        """
+        Return the addresses held on a provider, keyed by appliance uuid.
+        These are loaded from the database the first time they are needed.
+        """
+        try:
+            return self.held[provider]
+        except KeyError:
+            rv = self.held[provider] = {
+                r.touch.artifact.uuid: r.ip_ext
+                for r in session.query(NATRouting).join(Provider).filter(
+                    Provider.name == provider).all()
+                if r.touch.artifact.changes[-1].state.name
+                not in self.released}
+            return rv
+
+    def index(self, session, subs):
+        """
+        Build the index of free addresses for a subscription.
+
+        :param subs: A :py:class:`cloudhands.common.schema.Subscription`.
+        :returns: The set of free addresses.
+        """
+        log = logging.getLogger("cloudhands.burst.allocator.index")
+        provider = self.owners[subs.uuid] = subs.provider.name
+        pool = self.pools[subs.uuid] = {
+            i.value for i in session.query(IPAddress).join(Touch).filter(
+                Touch.artifact == subs).all()}
+        taken = set(self.holdings(session, provider).values())
+        rv = self.free[subs.uuid] = pool.difference(taken)
+        log.info("{} of {} addresses free on {}".format(
+            len(rv), len(pool), provider))
+        return rv
+
+    def invalidate(self, subs=None):
+        """
+        Discard the index for a subscription, or for every subscription
+        if none is given. It will be rebuilt on next use.
+        """
+        if subs is None:
+            self.pools.clear()
+            self.owners.clear()
+            self.free.clear()
+            self.held.clear()
+        else:
+            self.pools.pop(subs.uuid, None)
+            self.owners.pop(subs.uuid, None)
+            self.free.pop(subs.uuid, None)
+
+    def reserve(self, session, provider, uuid, ip_int):
+        """
+        Reserve a public IP address for an appliance. The appliance and its
+        subscription are looked up in `session`, so that the reservation
+        is not made on objects from a session since closed.
+
+        :param str provider: The name of the provider from whose pool,
+            as subscribed to by the appliance's organisation, to allocate.
+        :param str uuid: The uuid of the appliance.
+        :param str ip_int: The private address to which the public one
+            will be routed.
+        :returns: The address, or None if the pool is exhausted.
+        """
+        log = logging.getLogger("cloudhands.burst.allocator.reserve")
+        held = self.holdings(session, provider)
+        if uuid in held:
+            return held[uuid]
+
+        app = session.query(Appliance).filter(Appliance.uuid == uuid).one()
+        try:
+            subs = next(
+                i for i in app.organisation.subscriptions
+                if i.provider.name == provider)
+        except StopIteration:
+            log.error("No subscription to {} for {}".format(provider, uuid))
+            return None
+
+        try:
+            free = self.free[subs.uuid]
+        except KeyError:
+            free = self.index(session, subs)
+
+        if not free:
+            # New addresses may have been added to the subscription
+            free = self.index(session, subs)
+
+        actor = session.query(Component).filter(
+            Component.handle=="burst.controller").one()
+        while free:
+            rv = free.pop()
+            if self.in_use(session, provider, rv, app.uuid):
+                continue
+
+            act = Touch(
+                artifact=app, actor=actor, state=app.changes[-1].state,
+                at=datetime.datetime.utcnow())
+            routing = NATRouting(
+                touch=act, provider=subs.provider, ip_int=ip_int, ip_ext=rv)
+            session.add(routing)
+            session.commit()
+            first = min(
+                self.routings(session, provider, rv),
+                key=lambda r: r.touch.id)
+            if first.touch.artifact.uuid != app.uuid:
+                log.warning("Lost a race for {}".format(rv))
+                session.delete(routing)
+                session.delete(act)
+                session.commit()
+                continue
+
+            held[app.uuid] = rv
+            return rv
+        else:
+            return None
+
+    def routings(self, session, provider, address):
+        """
+        :returns: The live NAT routings to an address.
+        """
+        return [
+            r for r in session.query(NATRouting).join(Provider).filter(
+                Provider.name == provider).filter(
+                NATRouting.ip_ext == address).all()
+            if r.touch.artifact.changes[-1].state.name not in self.released]
+
+    def in_use(self, session, provider, address, uuid=None):
+        """
+        Check the database for a live NAT routing to an address by any
+        appliance other than the one with `uuid`.
+        """
+        return any(
+            r.touch.artifact.uuid != uuid
+            for r in self.routings(session, provider, address))
+
+    def release(self, provider, uuid):
+        """
+        Return the address held by an appliance to the free pool. The
+        routing stays in the database, where it no longer counts once the
+        appliance has gone for deletion.
+
+        :returns: The address released, or None if nothing was held.
+        """
+        try:
+            rv = self.held.get(provider, {}).pop(uuid)
+        except KeyError:
+            return None
+
+        for key, pool in self.pools.items():
+            if self.owners[key] == provider and rv in pool:
+                self.free[key].add(rv)
+        return rv
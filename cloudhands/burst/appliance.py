@@ -4,30 +4,41 @@
 import asyncio
 from collections import deque
 from collections import namedtuple
+from collections import OrderedDict
 import concurrent.futures
+import copy
 import datetime
 import functools
 import logging
 import operator
 import re
-import textwrap
 import uuid
 import xml.etree.ElementTree as ET
 import xml.sax.saxutils
 
-import aiohttp
-from chameleon import PageTemplateFile
-import pkg_resources
 from sqlalchemy import desc
 
 from cloudhands.burst.agent import Agent
+from cloudhands.burst.agent import collect
 from cloudhands.burst.agent import Job
+from cloudhands.burst.agent import select
+from cloudhands.burst.allocator import IPAllocator
+from cloudhands.burst.client import Clients
 from cloudhands.burst.control import create_node
 from cloudhands.burst.control import describe_node
 from cloudhands.burst.control import destroy_node
+from cloudhands.burst.index import discard
+from cloudhands.burst.index import lookup
+from cloudhands.burst.payload import Payloads
+from cloudhands.burst.readiness import PollSchedule
+from cloudhands.burst.readiness import provisioning_started
+from cloudhands.burst.status import StatusPoller
+from cloudhands.burst.strategy import Capacities
+from cloudhands.burst.strategy import Strategy
+from cloudhands.burst.tracker import TaskTracker
+from cloudhands.burst.tracker import when_complete
 from cloudhands.burst.utils import find_xpath
 from cloudhands.burst.utils import unescape_script
-from cloudhands.common.discovery import providers
 from cloudhands.common.discovery import settings
 from cloudhands.common.schema import Appliance
 from cloudhands.common.schema import CatalogueChoice
@@ -266,28 +277,223 @@ def find_template_among_orgs(
     return rv
 
 
-def hosts(session, state=None):
-    query = session.query(Appliance)
-    if not state:
-        return query.all()
+def hosts(session, state=None, offset=0, limit=None):
+    return select(session, Appliance, state, offset, limit)
+
+
+def node_provider(app):
+    """
+    :returns: The name of the provider which holds the node of an
+        appliance. If it has no node yet, that of the first provider its
+        organisation subscribes to.
+    """
+    node = next((
+        r for c in reversed(app.changes) for r in c.resources
+        if isinstance(r, Node)), None)
+    if node is not None:
+        return node.provider.name
+    return app.organisation.subscriptions[0].provider.name
+
+
+def schedule_key(app, providerName):
+    """
+    Return the key under which a :py:class:`PollSchedule` estimates
+    the provisioning time of an appliance.
+    """
+    choice = next((
+        r for c in reversed(app.changes) for r in c.resources
+        if isinstance(r, CatalogueChoice)), None)
+    return (getattr(choice, "name", None), providerName)
+
+
+def touch_again(msg, session):
+    """
+    Touch an appliance in its current state, so that the job which
+    failed on it is tried again.
+    """
+    app = session.query(Appliance).filter(
+        Appliance.uuid == msg.uuid).first()
+    actor = session.query(Component).filter(
+        Component.handle=="burst.controller").one()
+    state = app.changes[-1].state
+    act = Touch(artifact=app, actor=actor, state=state, at=msg.ts)
+    session.add(act)
+    session.commit()
+    return act
+
+
+class GatewayUpdate:
+    """
+    Gathers DNAT and firewall rules for the edge gateway of a provider so
+    they may be applied in a single reconfiguration.
+
+    :param config: The configuration of the provider.
+    :param tuple token: Credentials as supplied with an agent's Job.
+    """
+
+    def __init__(self, config, token=None):
+        self.config = config
+        self.token = token
+        self.rules = OrderedDict()
+
+    def add(self, uuid, publicIP, privateIP):
+        """
+        Add the rules which route a public IP address to an appliance.
+        """
+        self.rules[uuid] = {"rx": publicIP, "tx": privateIP}
+        return self
 
-    return [h for h in query.all() if h.changes[-1].state.name == state]
+    @asyncio.coroutine
+    def __call__(self):
+        """
+        Reconfigure the gateway with all the pending rules.
+
+        :returns: A dictionary of success flags keyed by appliance uuid.
+        """
+        log = logging.getLogger("cloudhands.burst.appliance.gatewayupdate")
+        config = self.config
+        payloads = Payloads()
+        rv = OrderedDict((uuid, False) for uuid in self.rules)
+
+        headers = {
+            "Accept": "application/*+xml;version=5.5",
+        }
+        try:
+            headers[self.token[1]] = self.token[2]
+        except (TypeError, IndexError):
+            log.warning("No token supplied")
 
+        client = Clients()(config)
 
-class Strategy:
+        url = "{scheme}://{host}:{port}/{endpoint}".format(
+            scheme="https",
+            host=config["host"]["name"],
+            port=config["host"]["port"],
+            endpoint="api/org")
+        response = yield from client.request(
+            "GET", url,
+            headers=headers)
 
-    @staticmethod
-    def config(providerName):
-        return next((
-            cfg for p in providers.values() for cfg in p
-            if cfg["metadata"]["path"] == providerName),
-            None
-        )
+        tree = response.tree()
+        orgFound = find_orgs(tree, name=config["vdc"]["org"])
 
-    @staticmethod
-    def recommend(host):  # TODO sort providers
-        providerName = host.organisation.subscriptions[0].provider.name
-        return Strategy.config(providerName)
+        try:
+            org = next(orgFound)
+        except StopIteration:
+            log.error("Failed to find org")
+            return rv
+
+        response = yield from client.request(
+            "GET", org.attrib.get("href"),
+            headers=headers)
+        tree = response.tree()
+        try:
+            vdcLink = next(find_vdcs(tree))
+        except StopIteration:
+            log.error("Failed to find VDC")
+            return rv
+
+        response = yield from client.request(
+            "GET", vdcLink.attrib.get("href"),
+            headers=headers)
+        tree = response.tree()
+
+        # Gateway details via query to vdc
+        try:
+            gwLink = next(
+                find_records(tree, rel="edgeGateways"))
+        except StopIteration:
+            log.error("Failed to find gateways")
+            return rv
+
+        # Gateway data from link
+        response = yield from client.request(
+            "GET", gwLink.attrib.get("href"),
+            headers=headers)
+        tree = response.tree()
+
+        try:
+            gwRecord = next(
+                find_results(tree, name=config["gateway"]["name"]))
+        except StopIteration:
+            log.error("Failed to find gateway")
+            return rv
+
+        response = yield from client.request(
+            "GET", gwRecord.attrib.get("href"),
+            headers=headers)
+        # The rules are added to this tree, so it must not be shared
+        tree = copy.deepcopy(response.tree())
+
+        try:
+            interface = next(
+                find_networkinterface(
+                    tree, name=config["gateway"]["interface"]))
+        except StopIteration:
+            log.error("Failed to find network")
+            return rv
+
+        try:
+            eGSC = next(
+                c for i in tree if i.tag.endswith("Configuration")
+                for c in i
+                if c.tag.endswith("EdgeGatewayServiceConfiguration"))
+        except StopIteration:
+            log.error("Missing Edge gateway service configuration")
+            return rv
+
+        try:
+            natService = next(
+                i for i in eGSC if i.tag.endswith("NatService"))
+        except StopIteration:
+            natService = ET.XML(
+                """<NatService><IsEnabled>true</IsEnabled></NatService>""")
+            eGSC.append(natService)
+
+        try:
+            fwService = next(
+                i for i in eGSC if i.tag.endswith("FirewallService"))
+        except StopIteration:
+            log.error("Failed to find firewall service")
+            return rv
+
+        try:
+            gwSCfg = next(find_gatewayserviceconfiguration(tree))
+        except StopIteration:
+            log.error("Failed to find gateway service configuration")
+            return rv
+
+        # SNAT rule already defined for entire subnet
+        for uuid, rule in self.rules.items():
+            defn = {
+                "typ": "DNAT",
+                "network": {
+                    "name": config["gateway"]["interface"],
+                    "href": interface.attrib.get("href")
+                },
+                "rule": rule,
+                "description": "Public IP PNAT"
+            }
+            fwService.append(ET.XML(payloads.render("FirewallRule", **defn)))
+            natService.append(ET.XML(payloads.render("NatRule", **defn)))
+
+        url = gwSCfg.attrib.get("href")
+        headers["Content-Type"] = (
+            "application/vnd.vmware.admin.edgeGatewayServiceConfiguration+xml")
+        response = yield from client.request(
+            "POST", url,
+            headers=headers,
+            data=ET.tostring(eGSC, encoding="utf-8"))
+        reply = yield from response.read_and_close()
+        log.debug(reply)
+
+        tree = ET.fromstring(reply.decode("utf-8"))
+        if tree.tag.endswith("Error"):
+            log.error("Gateway update refused: {}".format(
+                tree.attrib.get("message")))
+        else:
+            rv.update((uuid, True) for uuid in rv)
+        return rv
 
 
 class PreCheckAgent(Agent):
@@ -313,10 +519,10 @@ class PreCheckAgent(Agent):
         ]
 
     def jobs(self, session):
-        for app in session.query(Appliance).all():  # TODO: Filter earlier
+        for app in hosts(session, state="pre_check"):
             acts = app.changes
             if acts[-1].state.name == "pre_check":
-                prvdrName = app.organisation.subscriptions[0].provider.name
+                prvdrName = node_provider(app)
                 token = session.query(ProviderToken).join(Touch).join(
                     Provider).filter(Touch.actor == acts[0].actor).filter(
                     Provider.name == prvdrName).order_by(
@@ -341,8 +547,22 @@ class PreCheckAgent(Agent):
             touch=act, provider=provider)
         session.add(resource)
         session.commit()
+        self.provisioned(app, msg)
         return act
 
+    @staticmethod
+    def provisioned(app, msg):
+        """
+        Learn how long an appliance took to provision, and stop polling it.
+        """
+        schedule = PollSchedule()
+        started = provisioning_started(app.changes)
+        if started is not None:
+            schedule.observe(
+                schedule_key(app, msg.provider),
+                (msg.ts - started).total_seconds())
+        schedule.forget(app.uuid)
+
     def touch_to_preoperational(self, msg:CheckedAsPreOperational, session):
         preoperational = session.query(ApplianceState).filter(
             ApplianceState.name == "pre_operational").one()
@@ -360,6 +580,7 @@ class PreCheckAgent(Agent):
             touch=act, provider=provider)
         session.add_all((ip, report))
         session.commit()
+        self.provisioned(app, msg)
         return act
 
     def touch_to_provisioning(self, msg:CheckedAsProvisioning, session):
@@ -378,6 +599,7 @@ class PreCheckAgent(Agent):
             touch=act, provider=provider)
         session.add(resource)
         session.commit()
+        PollSchedule().defer(app.uuid)
         return act
 
     @asyncio.coroutine
@@ -385,6 +607,7 @@ class PreCheckAgent(Agent):
         log = logging.getLogger("cloudhands.burst.appliance.precheck")
         log.info("Activated.")
         ET.register_namespace("", "http://www.vmware.com/vcloud/v1.5")
+        poller = StatusPoller()
         while True:
             job = yield from self.work.get()
             log.debug(job)
@@ -396,6 +619,9 @@ class PreCheckAgent(Agent):
             node = next((i for i in resources if isinstance(i, Node)), None)
             config = Strategy.config(node.provider.name)
 
+            if self.postponed(loop, job, config["metadata"]["path"]):
+                continue
+
             headers = {
                 "Accept": "application/*+xml;version=5.5",
             }
@@ -404,17 +630,29 @@ class PreCheckAgent(Agent):
             except (TypeError, IndexError):
                 log.warning("No token supplied")
 
-            client = aiohttp.client.HttpClient(
-                ["{host}:{port}".format(
-                    host=config["host"]["name"],
-                    port=config["host"]["port"])
-                ],
-                verify_ssl=config["host"].getboolean("verify_ssl_cert")
-            )
-            response = yield from client.request(
-                "GET", node.uri, headers=headers)
+            client = Clients()(config)
+            record = yield from poller(
+                client, headers, config, job.token, node.uri, loop=loop)
+            if record is not None and poller.busy(record):
+                # Still building; no need for the vApp details
+                msg = PreCheckAgent.CheckedAsProvisioning(
+                    app.uuid, datetime.datetime.utcnow(),
+                    node.provider.name, None,
+                    "deployed" if record.get("isDeployed") == "true"
+                    else "unknown", None, None
+                )
+                yield from msgQ.put(msg)
+                continue
+
+            try:
+                response = yield from client.request(
+                    "GET", node.uri, headers=headers)
+                vApp = yield from response.read_and_close()
+            except self.unreachable as e:
+                log.warning("Postponing {}: {}".format(app.uuid, e))
+                self.postpone(loop, job, config["metadata"]["path"])
+                continue
 
-            vApp = yield from response.read_and_close()
             log.debug(vApp)
             tree = ET.fromstring(vApp.decode("utf-8"))
 
@@ -463,15 +701,24 @@ class PreDeleteAgent(Agent):
     Message = namedtuple(
         "DeletedMessage", ["uuid", "ts", "provider"])
 
+    Failed = namedtuple(
+        "DeleteFailedMessage", ["uuid", "ts", "provider"])
+
     @property
     def callbacks(self):
-        return [(PreDeleteAgent.Message, self.touch_to_deleted)]
+        return [
+            (PreDeleteAgent.Message, self.touch_to_deleted),
+            (PreDeleteAgent.Failed, touch_again),
+        ]
 
     def jobs(self, session):
-        for app in session.query(Appliance).all():  # TODO: Filter earlier
+        allocator = IPAllocator()
+        for app in hosts(session, state="pre_delete"):
             acts = app.changes
             if acts[-1].state.name == "pre_delete":
-                prvdrName = app.organisation.subscriptions[0].provider.name
+                prvdrName = node_provider(app)
+                # The public address is free once deletion is requested
+                allocator.release(prvdrName, app.uuid)
                 token = session.query(ProviderToken).join(Touch).join(
                     Provider).filter(Touch.actor == acts[0].actor).filter(
                     Provider.name == prvdrName).order_by(
@@ -499,6 +746,7 @@ class PreDeleteAgent(Agent):
         log = logging.getLogger("cloudhands.burst.appliance.predelete")
         log.info("Activated.")
         ET.register_namespace("", "http://www.vmware.com/vcloud/v1.5")
+        tracker = TaskTracker()
         while True:
             job = yield from self.work.get()
             app = job.artifact
@@ -509,6 +757,9 @@ class PreDeleteAgent(Agent):
             node = next(i for i in resources if isinstance(i, Node))
             config = Strategy.config(node.provider.name)
 
+            if self.postponed(loop, job, config["metadata"]["path"]):
+                continue
+
             headers = {
                 "Accept": "application/*+xml;version=5.5",
             }
@@ -517,28 +768,55 @@ class PreDeleteAgent(Agent):
             except (TypeError, IndexError):
                 log.warning("No token supplied")
 
-            client = aiohttp.client.HttpClient(
-                ["{host}:{port}".format(
-                    host=config["host"]["name"],
-                    port=config["host"]["port"])
-                ],
-                verify_ssl=config["host"].getboolean("verify_ssl_cert")
-            )
+            client = Clients()(config)
 
-            response = yield from client.request(
-                "DELETE", node.uri,
-                headers=headers)
-            reply = yield from response.read_and_close()
+            end = yield from client.begin_task()
+            try:
+                response = yield from client.request(
+                    "DELETE", node.uri,
+                    headers=headers)
+                reply = yield from response.read_and_close()
+            except self.unreachable as e:
+                end()
+                log.warning("Postponing {}: {}".format(app.uuid, e))
+                self.postpone(loop, job, config["metadata"]["path"])
+                continue
+            except Exception as e:
+                end()
+                log.error(e)
+                msg = PreDeleteAgent.Failed(
+                    app.uuid, datetime.datetime.utcnow(),
+                    node.provider.name)
+                yield from msgQ.put(msg)
+                continue
+            try:
+                tree = ET.fromstring(reply.decode("utf-8"))
+            except ET.ParseError as e:
+                log.warning(e)
+                tree = None
 
             msg = PreDeleteAgent.Message(
                 app.uuid, datetime.datetime.utcnow(),
                 node.provider.name
             )
-            yield from msgQ.put(msg)
+            if tree is not None and tree.tag.endswith("}Task"):
+                task = tracker.watch(
+                    client, headers, config, job.token,
+                    tree.attrib.get("href"), loop=loop)
+                task.add_done_callback(end)
+                failed = PreDeleteAgent.Failed(*msg)
+                asyncio.Task(
+                    when_complete(task, msgQ, msg, failed), loop=loop)
+            else:
+                end()
+                yield from msgQ.put(msg)
 
 
 class PreOperationalAgent(Agent):
 
+    #: Seconds to wait for further jobs to share a gateway update.
+    window = 2
+
     OperationalMessage = namedtuple(
         "OperationalMessage",
         ["uuid", "ts", "provider", "ip_internal", "ip_external"])
@@ -547,18 +825,22 @@ class PreOperationalAgent(Agent):
         "ResourceConstrainedMessage",
         ["uuid", "ts", "provider", "ip_internal", "ip_external"])
 
+    Failed = namedtuple(
+        "GatewayFailedMessage", ["uuid", "ts", "provider"])
+
     @property
     def callbacks(self):
         return [
             (PreOperationalAgent.OperationalMessage, self.touch_to_operational),
             (PreOperationalAgent.ResourceConstrainedMessage, self.touch_to_prestop),
+            (PreOperationalAgent.Failed, touch_again),
         ]
 
     def jobs(self, session):
-        for app in session.query(Appliance).all():  # TODO: Filter earlier
+        for app in hosts(session, state="pre_operational"):
             acts = app.changes
             if acts[-1].state.name == "pre_operational":
-                prvdrName = app.organisation.subscriptions[0].provider.name
+                prvdrName = node_provider(app)
                 token = session.query(ProviderToken).join(Touch).join(
                     Provider).filter(Touch.actor == acts[0].actor).filter(
                     Provider.name == prvdrName).order_by(
@@ -578,7 +860,14 @@ class PreOperationalAgent(Agent):
             Provider.name==msg.provider).one()
         act = Touch(artifact=app, actor=actor, state=operational, at=msg.ts)
 
-        if msg.ip_internal and msg.ip_external:
+        # The routing was recorded when its address was reserved
+        reserved = session.query(NATRouting).join(Touch).filter(
+            Touch.artifact == app).filter(
+            NATRouting.ip_ext == msg.ip_external).first()
+        if reserved is not None:
+            reserved.ip_int = msg.ip_internal
+            session.add(act)
+        elif msg.ip_internal and msg.ip_external:
             resource = NATRouting(
                 touch=act, provider=provider,
                 ip_int=msg.ip_internal, ip_ext=msg.ip_external)
@@ -608,231 +897,143 @@ class PreOperationalAgent(Agent):
         log = logging.getLogger("cloudhands.burst.appliance.preoperation")
         log.info("Activated.")
         ET.register_namespace("", "http://www.vmware.com/vcloud/v1.5")
-        natMacro = PageTemplateFile(pkg_resources.resource_filename(
-            "cloudhands.burst.drivers", "NatRule.pt"))
-        fwMacro = PageTemplateFile(pkg_resources.resource_filename(
-            "cloudhands.burst.drivers", "FirewallRule.pt"))
+        allocator = IPAllocator()
         while True:
-            job = yield from self.work.get()
-            app = job.artifact
-            resources = sorted(
-                (r for c in app.changes for r in c.resources),
-                key=operator.attrgetter("touch.at"),
-                reverse=True)
-            choice = next(i for i in resources if isinstance(i, CatalogueChoice))
-            node = next(i for i in resources if isinstance(i, Node))
-            config = Strategy.config(node.provider.name)
-            network = config.get("vdc", "network", fallback=None)
+            jobs = yield from collect(self.work, self.window, loop=loop)
+            updates = OrderedDict()
+            batches = {}
+            for job in jobs:
+                app = job.artifact
+                resources = sorted(
+                    (r for c in app.changes for r in c.resources),
+                    key=operator.attrgetter("touch.at"),
+                    reverse=True)
+                choice = next(
+                    i for i in resources if isinstance(i, CatalogueChoice))
+                node = next(i for i in resources if isinstance(i, Node))
+                config = Strategy.config(node.provider.name)
 
-            if not choice.natrouted:
-                log.info("No rules applied for {} {}".format(
+                if not choice.natrouted:
+                    log.info("No rules applied for {} {}".format(
+                        choice.name, app.uuid))
+                    msg = PreOperationalAgent.OperationalMessage(
+                        app.uuid, datetime.datetime.utcnow(),
+                        node.provider.name,
+                        None, None
+                    )
+                    yield from msgQ.put(msg)
+                    continue
+
+                if self.postponed(loop, job, node.provider.name):
+                    continue
+
+                log.info("Applying rules for {} {}".format(
                     choice.name, app.uuid))
-                msg = PreOperationalAgent.OperationalMessage(
-                    app.uuid, datetime.datetime.utcnow(),
-                    node.provider.name,
-                    None, None
-                )
-                yield from msgQ.put(msg)
-                continue
-
-            log.info("Applying rules for {} {}".format(choice.name, app.uuid))
-            try:
-                privateIP = next(
-                    i for i in resources if isinstance(i, IPAddress))
-            except StopIteration:
-                log.error("No IPAddress")
-                continue
-            else:
-                log.debug(privateIP.value)
-
-            subs = next(i for i in app.organisation.subscriptions
-                        if i.provider.name == node.provider.name)
-            ipPool = {r.value for c in subs.changes for r in c.resources
-                             if isinstance(r, IPAddress)}
-            ipTaken = {i.ip_ext for i in session.query(NATRouting).join(
-                Provider).filter(Provider.name == node.provider.name).all()}
-            ipFree = ipPool.difference(ipTaken)
-            if not ipFree:
-                log.warning("No public IP Addresses available")
-                msg = PreOperationalAgent.ResourceConstrainedMessage(
-                    app.uuid, datetime.datetime.utcnow(),
-                    node.provider.name, privateIP.value, None
-                )
-                yield from msgQ.put(msg)
-                continue
-            else:
-                log.info("Allocating from {}".format(ipFree))
-
-            publicIP = session.query(IPAddress).filter(
-                IPAddress.value == ipFree.pop()).first()
-
-            headers = {
-                "Accept": "application/*+xml;version=5.5",
-            }
-            try:
-                headers[job.token[1]] = job.token[2]
-            except (TypeError, IndexError):
-                log.warning("No token supplied")
-
-            client = aiohttp.client.HttpClient(
-                ["{host}:{port}".format(
-                    host=config["host"]["name"],
-                    port=config["host"]["port"])
-                ],
-                verify_ssl=config["host"].getboolean("verify_ssl_cert")
-            )
-
-            url = "{scheme}://{host}:{port}/{endpoint}".format(
-                scheme="https",
-                host=config["host"]["name"],
-                port=config["host"]["port"],
-                endpoint="api/org")
-            response = yield from client.request(
-                "GET", url,
-                headers=headers)
-
-            orgList = yield from response.read_and_close()
-            tree = ET.fromstring(orgList.decode("utf-8"))
-            orgFound = find_orgs(tree, name=config["vdc"]["org"])
-
-            try:
-                org = next(orgFound)
-            except StopIteration:
-                log.error("Failed to find org")
-                continue
-
-            response = yield from client.request(
-                "GET", org.attrib.get("href"),
-                headers=headers)
-            orgData = yield from response.read_and_close()
-            tree = ET.fromstring(orgData.decode("utf-8"))
-            try:
-                vdcLink = next(find_vdcs(tree))
-            except StopIteration:
-                log.error("Failed to find VDC")
-                continue
-
-            response = yield from client.request(
-                "GET", vdcLink.attrib.get("href"),
-                headers=headers)
-            vdcData = yield from response.read_and_close()
-            tree = ET.fromstring(vdcData.decode("utf-8"))
-
-            # Gateway details via query to vdc
-            try:
-                gwLink = next(
-                    find_records(tree, rel="edgeGateways"))
-            except StopIteration:
-                log.error("Failed to find gateways")
-                continue
-
-            # Gateway data from link
-            response = yield from client.request(
-                "GET", gwLink.attrib.get("href"),
-                headers=headers)
-            gwData = yield from response.read_and_close()
-            tree = ET.fromstring(gwData.decode("utf-8"))
-
-            gwRecord = next(
-                find_results(tree, name=config["gateway"]["name"]))
-
-            response = yield from client.request(
-                "GET", gwRecord.attrib.get("href"),
-                headers=headers)
-            gwData = yield from response.read_and_close()
-            tree = ET.fromstring(gwData.decode("utf-8"))
-
-            try:
-                interface = next(
-                    find_networkinterface(
-                        tree, name=config["gateway"]["interface"]))
-            except StopIteration:
-                log.error("Failed to find network")
-
-            try:
-                eGSC = next(
-                    c for i in tree if i.tag.endswith("Configuration")
-                    for c in i
-                    if c.tag.endswith("EdgeGatewayServiceConfiguration"))
-            except StopIteration:
-                log.error("Missing Edge gateway service configuration")
-                continue
-
-            try:
-                natService = next(
-                    i for i in eGSC if i.tag.endswith("NatService"))
-            except StopIteration:
-                natService = ET.XML(
-                    """<NatService><IsEnabled>true</IsEnabled></NatService>""")
-                eGSC.append(natService)
-
-            try:
-                fwService = next(
-                    i for i in eGSC if i.tag.endswith("FirewallService"))
-            except StopIteration:
-                log.error("Failed to find firewall service")
-
-            # SNAT rule already defined for entire subnet
-            defn = {
-                "typ": "DNAT",
-                "network": {
-                    "name": config["gateway"]["interface"],
-                    "href": interface.attrib.get("href")
-                },
-                "rule": {
-                    "rx": publicIP.value,
-                    "tx": privateIP.value,
-                },
-                "description": "Public IP PNAT"
-            }
-            
-            fwService.append(ET.XML(fwMacro(**defn)))
-            natService.append(ET.XML(natMacro(**defn)))
-
-            gwServiceCfgs = find_gatewayserviceconfiguration(tree)
-            try:
-                gwSCfg = next(gwServiceCfgs)
-            except StopIteration:
-                log.error("Failed to find gateway service configuration")
+                try:
+                    privateIP = next(
+                        i for i in resources if isinstance(i, IPAddress))
+                except StopIteration:
+                    log.error("No IPAddress")
+                    msg = PreOperationalAgent.Failed(
+                        app.uuid, datetime.datetime.utcnow(),
+                        node.provider.name)
+                    yield from msgQ.put(msg)
+                    continue
+                else:
+                    log.debug(privateIP.value)
+
+                publicIP = allocator.reserve(
+                    session, node.provider.name, job.uuid, privateIP.value)
+                if publicIP is None:
+                    log.warning("No public IP Addresses available")
+                    msg = PreOperationalAgent.ResourceConstrainedMessage(
+                        app.uuid, datetime.datetime.utcnow(),
+                        node.provider.name, privateIP.value, None
+                    )
+                    yield from msgQ.put(msg)
+                    continue
+                else:
+                    log.info("Allocated {}".format(publicIP))
 
-            url = gwSCfg.attrib.get("href")
-            headers["Content-Type"] = (
-                "application/vnd.vmware.admin.edgeGatewayServiceConfiguration+xml")
-            response = yield from client.request(
-                "POST", url,
-                headers=headers,
-                data=ET.tostring(eGSC, encoding="utf-8"))
-            reply = yield from response.read_and_close()
-            log.debug(reply)
+                # Each update is made with the credentials of its own jobs
+                update = updates.setdefault(
+                    (node.provider.name, job.token),
+                    GatewayUpdate(config, job.token))
+                update.add(app.uuid, publicIP, privateIP.value)
+                batches.setdefault(
+                    (node.provider.name, job.token), []).append(job)
 
-            msg = PreOperationalAgent.OperationalMessage(
-                app.uuid, datetime.datetime.utcnow(),
-                node.provider.name,
-                defn["rule"]["tx"], defn["rule"]["rx"]
-            )
-            yield from msgQ.put(msg)
+            for (provider, token), update in updates.items():
+                try:
+                    results = yield from update()
+                except self.unreachable as e:
+                    log.warning("Postponing gateway of {}: {}".format(
+                        provider, e))
+                    for job in batches[(provider, token)]:
+                        self.postpone(loop, job, provider)
+                    continue
+                except Exception as e:
+                    log.error(e)
+                    results = {uuid: False for uuid in update.rules}
+
+                log.info("Gateway of {} reconfigured for {} appliances".format(
+                    provider, sum(results.values())))
+                for uuid, success in results.items():
+                    if not success:
+                        # The address stays reserved for the next attempt
+                        msg = PreOperationalAgent.Failed(
+                            uuid, datetime.datetime.utcnow(), provider)
+                        yield from msgQ.put(msg)
+                        continue
+                    rule = update.rules[uuid]
+                    msg = PreOperationalAgent.OperationalMessage(
+                        uuid, datetime.datetime.utcnow(),
+                        provider,
+                        rule["tx"], rule["rx"]
+                    )
+                    yield from msgQ.put(msg)
 
 
 class PreProvisionAgent(Agent):
+    """
+    Composes a vApp for each appliance in pre_provision.
+
+    Jobs go to the provider preferred by
+    :py:class:`cloudhands.burst.strategy.Strategy`, which may favour one
+    with more headroom. If the chosen provider is known to have less than
+    `Strategy.reserve` headroom, the job is deferred for `retry` seconds
+    rather than sent to a provider which can't fulfil it.
+    """
 
     Message = namedtuple(
         "ProvisioningMessage", ["uuid", "ts", "provider", "uri"])
 
+    Deferred = namedtuple(
+        "ProvisioningDeferredMessage", ["uuid", "ts", "provider"])
+
+    retry = 120
+
     @property
     def callbacks(self):
-        return [(PreProvisionAgent.Message, self.touch_to_provisioning)]
+        return [
+            (PreProvisionAgent.Message, self.touch_to_provisioning),
+            (PreProvisionAgent.Deferred, self.touch_to_pre_provision),
+        ]
 
     def jobs(self, session):
-        for app in session.query(Appliance).all():  # TODO: Filter earlier
+        for app in hosts(session, state="pre_provision"):
             acts = app.changes
             if acts[-1].state.name == "pre_provision":
-                prvdrName = app.organisation.subscriptions[0].provider.name
-                token = session.query(ProviderToken).join(Touch).join(
-                    Provider).filter(Touch.actor == acts[0].actor).filter(
-                    Provider.name == prvdrName).order_by(
-                    desc(Touch.at)).first()
-                creds = (prvdrName, token.key, token.value) if token else None
-                    
+                creds = None
+                for prvdrName in Strategy.rank(app):
+                    token = session.query(ProviderToken).join(Touch).join(
+                        Provider).filter(Touch.actor == acts[0].actor).filter(
+                        Provider.name == prvdrName).order_by(
+                        desc(Touch.at)).first()
+                    if token:
+                        creds = (prvdrName, token.key, token.value)
+                        break
+
                 yield Job(app.uuid, creds, app)
 
     def touch_to_provisioning(self, msg:Message, session):
@@ -851,17 +1052,26 @@ class PreProvisionAgent(Agent):
         session.add(resource)
         session.commit()
         return act
- 
+
+    def touch_to_pre_provision(self, msg:Deferred, session):
+        app = session.query(Appliance).filter(
+            Appliance.uuid == msg.uuid).first()
+        actor = session.query(Component).filter(
+            Component.handle=="burst.controller").one()
+        state = app.changes[-1].state
+        act = Touch(artifact=app, actor=actor, state=state, at=msg.ts)
+        session.add(act)
+        session.commit()
+        return act
+
     @asyncio.coroutine
     def __call__(self, loop, msgQ, *args):
         log = logging.getLogger("cloudhands.burst.appliance.preprovision")
         log.info("Activated.")
+        session = args[0] if args else None
         ET.register_namespace("", "http://www.vmware.com/vcloud/v1.5")
         portalName, portal = next(iter(settings.items()))
-        macro = PageTemplateFile(pkg_resources.resource_filename(
-            "cloudhands.burst.drivers", "InstantiateVAppTemplateParams.pt"))
-        macro = PageTemplateFile(pkg_resources.resource_filename(
-            "cloudhands.burst.drivers", "ComposeVAppParams.pt"))
+        payloads = Payloads()
         while True:
             job = yield from self.work.get()
             app = job.artifact
@@ -872,7 +1082,22 @@ class PreProvisionAgent(Agent):
             label = next(i for i in resources if isinstance(i, Label))
             choice = next(i for i in resources if isinstance(i, CatalogueChoice))
             image = choice.name
-            config = Strategy.recommend(app)
+            config = (
+                Strategy.config(job.token[0]) if job.token
+                else Strategy.recommend(app))
+
+            providerName = config["metadata"]["path"]
+            free = Capacities().free(providerName)
+            if free is not None and free < Strategy.reserve:
+                log.warning("Deferring {}: {} has {:.0%} headroom".format(
+                    app.uuid, providerName, free))
+                msg = PreProvisionAgent.Deferred(
+                    app.uuid, datetime.datetime.utcnow(), providerName)
+                loop.call_later(self.retry, msgQ.put_nowait, msg)
+                continue
+
+            if self.postponed(loop, job, providerName):
+                continue
 
             headers = {
                 "Accept": "application/*+xml;version=5.5",
@@ -882,105 +1107,133 @@ class PreProvisionAgent(Agent):
             except (TypeError, IndexError):
                 log.warning("No token supplied")
 
-            client = aiohttp.client.HttpClient(
-                ["{host}:{port}".format(
-                    host=config["host"]["name"],
-                    port=config["host"]["port"])
-                ],
-                verify_ssl=config["host"].getboolean("verify_ssl_cert")
-            )
-
-            # Find template among catalogues
-            url = "{scheme}://{host}:{port}/{endpoint}".format(
-                scheme="https",
-                host=config["host"]["name"],
-                port=config["host"]["port"],
-                endpoint="api/catalogs/query")
-            response = yield from client.request(
-                "GET", url, headers=headers)
-            data = yield from response.read_and_close()
-
-            catalogues = [
-                i for i in find_catalogrecords(data.decode("utf-8"))
-                if i.attrib.get("name", None) in (
-                    config["vdc"]["org"],
-                    config["vdc"]["catalogue"]
-                )
-            ]
-            template = yield from find_template_among_catalogues(
-                client, headers, image, catalogues
-            )
-            if template is None:
-                log.error("Couldn't find template {}".format(image))
+            client = Clients()(config)
 
-            response = yield from client.request(
-                "GET", template.get("href"),
-                headers=headers)
-            reply = yield from response.read_and_close()
-            log.debug(reply)
-            tree = ET.fromstring(reply.decode("utf-8"))
-
-            script = customizationScript.format(
-                host=portal["auth.rest"]["host"],
-                uuid=app.uuid)
-
-            vmConfigs = []
-            for vm in find_vms(tree):
-                ncs = next(find_networkconnectionsection(tree), None)
-                if ncs is None:
-                    log.error("Couldn't find network connection section")
-                vmConfigs.append({
-                    "href": vm.attrib.get("href"),
+            catalogueNames = (config["vdc"]["org"], config["vdc"]["catalogue"])
+            try:
+                entry = lookup(
+                    session, config["metadata"]["path"], image, catalogueNames
+                ) if session is not None else None
+                if entry is not None:
+                    log.debug("Found {} in template index".format(image))
+                    template = {"name": entry["name"], "href": entry["href"]}
+                    vms = [(i["href"], i["networks"]) for i in entry["vms"]]
+
+                    # The template may have been removed since it was indexed
+                    response = yield from client.request(
+                        "GET", template["href"], headers=headers)
+                    reply = yield from response.read_and_close()
+                    try:
+                        tree = ET.fromstring(reply.decode("utf-8"))
+                    except ET.ParseError:
+                        tree = None
+                    if (response.status == 404 or tree is None or
+                        next(find_vms(tree), None) is None):
+                        log.warning("{} has gone from {}".format(
+                            template["href"], providerName))
+                        discard(session, providerName, template["href"])
+                        entry = None
+
+                if entry is None:
+                    # Find template among catalogues
+                    url = "{scheme}://{host}:{port}/{endpoint}".format(
+                        scheme="https",
+                        host=config["host"]["name"],
+                        port=config["host"]["port"],
+                        endpoint="api/catalogs/query")
+                    response = yield from client.request(
+                        "GET", url, headers=headers)
+                    data = yield from response.read_and_close()
+
+                    catalogues = [
+                        i for i in find_catalogrecords(data.decode("utf-8"))
+                        if i.attrib.get("name", None) in catalogueNames
+                    ]
+                    element = yield from find_template_among_catalogues(
+                        client, headers, image, catalogues
+                    )
+                    if element is None:
+                        log.error("Couldn't find template {}".format(image))
+                        msg = PreProvisionAgent.Deferred(
+                            app.uuid, datetime.datetime.utcnow(), providerName)
+                        loop.call_later(self.retry, msgQ.put_nowait, msg)
+                        continue
+
+                    template = {
+                        "name": element.attrib.get("name"),
+                        "href": element.attrib.get("href")}
+
+                    response = yield from client.request(
+                        "GET", template["href"],
+                        headers=headers)
+                    reply = yield from response.read_and_close()
+                    log.debug(reply)
+                    tree = ET.fromstring(reply.decode("utf-8"))
+                    if next(find_networkconnectionsection(tree), None) is None:
+                        log.error("Couldn't find network connection section")
+                    vms = [
+                        (vm.attrib.get("href"),
+                         [nc.attrib.get("network")
+                          for nc in find_networkconnection(vm)])
+                        for vm in find_vms(tree)]
+
+                script = customizationScript.format(
+                    host=portal["auth.rest"]["host"],
+                    uuid=app.uuid)
+
+                vmConfigs = [{
+                    "href": href,
                     "name": uuid.uuid4().hex,
-                    "networks": [
-                        {"name": nc.attrib.get("network")}
-                        for nc in find_networkconnection(vm)
-                    ],
-                    "script": script})
-
-            # VDC details from organisation
-            url = "{scheme}://{host}:{port}/{endpoint}".format(
-                scheme="https",
-                host=config["host"]["name"],
-                port=config["host"]["port"],
-                endpoint="api/org")
-            response = yield from client.request(
-                "GET", url,
-                headers=headers)
-            orgList = yield from response.read_and_close()
-            tree = ET.fromstring(orgList.decode("utf-8"))
+                    "networks": [{"name": name} for name in networks],
+                    "script": script} for href, networks in vms]
 
-            userOrg = next(find_orgs(tree, name=config["vdc"]["org"]), None)
-            response = yield from client.request(
-                "GET", userOrg.attrib.get("href"),
-                headers=headers)
-            orgData = yield from response.read_and_close()
-            tree = ET.fromstring(orgData.decode("utf-8"))
-            try:
-                vdcLink = next(find_vdcs(tree))
-            except StopIteration:
-                log.error("Failed to find VDC")
+                # VDC details from organisation
+                url = "{scheme}://{host}:{port}/{endpoint}".format(
+                    scheme="https",
+                    host=config["host"]["name"],
+                    port=config["host"]["port"],
+                    endpoint="api/org")
+                response = yield from client.request(
+                    "GET", url,
+                    headers=headers)
+                orgList = yield from response.read_and_close()
+                tree = ET.fromstring(orgList.decode("utf-8"))
 
-            response = yield from client.request(
-                "GET", vdcLink.attrib.get("href"),
-                headers=headers)
-            vdcData = yield from response.read_and_close()
-            tree = ET.fromstring(vdcData.decode("utf-8"))
+                userOrg = next(find_orgs(tree, name=config["vdc"]["org"]), None)
+                response = yield from client.request(
+                    "GET", userOrg.attrib.get("href"),
+                    headers=headers)
+                orgData = yield from response.read_and_close()
+                tree = ET.fromstring(orgData.decode("utf-8"))
+                try:
+                    vdcLink = next(find_vdcs(tree))
+                except StopIteration:
+                    log.error("Failed to find VDC")
 
-            # Network details via query to vdc
-            try:
-                netLink = next(
-                    find_records(tree, rel="orgVdcNetworks"))
-            except StopIteration:
-                log.error("Failed to find network")
-            response = yield from client.request(
-                "GET", netLink.attrib.get("href"),
-                headers=headers)
-            netData = yield from response.read_and_close()
-            tree = ET.fromstring(netData.decode("utf-8"))
-            netDetails = [
-                next(find_results(tree, name=name), None)
-                for n, name in sorted(config.items("network"))]
+                response = yield from client.request(
+                    "GET", vdcLink.attrib.get("href"),
+                    headers=headers)
+                vdcData = yield from response.read_and_close()
+                tree = ET.fromstring(vdcData.decode("utf-8"))
+
+                # Network details via query to vdc
+                try:
+                    netLink = next(
+                        find_records(tree, rel="orgVdcNetworks"))
+                except StopIteration:
+                    log.error("Failed to find network")
+                response = yield from client.request(
+                    "GET", netLink.attrib.get("href"),
+                    headers=headers)
+                netData = yield from response.read_and_close()
+                tree = ET.fromstring(netData.decode("utf-8"))
+                netDetails = [
+                    next(find_results(tree, name=name), None)
+                    for n, name in sorted(config.items("network"))]
+            except self.unreachable as e:
+                log.warning("Postponing {}: {}".format(app.uuid, e))
+                self.postpone(loop, job, providerName)
+                continue
 
             try:
                 data = {
@@ -993,38 +1246,58 @@ class PreProvisionAgent(Agent):
                         "name": net.attrib.get("name"),
                         "href": net.attrib.get("href"),
                     } for net in netDetails],
-                    "template": {
-                        "name": template.attrib.get("name"),
-                        "href": template.attrib.get("href"),
-                    },
+                    "template": template,
                 }
 
                 url = "{vdc}/{endpoint}".format(
                     vdc=vdcLink.attrib.get("href"),
                     endpoint="action/composeVApp")
                 headers["Content-Type"] = (
-                "application/vnd.vmware.vcloud.instantiateVAppTemplateParams+xml")
-                headers["Content-Type"] = (
                 "application/vnd.vmware.vcloud.composeVAppParams+xml")
-                payload = macro(**data)
+                payload = payloads.render("ComposeVAppParams", **data)
                 log.debug(payload)
             except Exception as e:
                 log.error(e)
 
-            response = yield from client.request(
-                "POST", url,
-                headers=headers,
-                data=payload.encode("utf-8"))
-            reply = yield from response.read_and_close()
-            log.debug(reply)
+            end = yield from client.begin_task()
+            try:
+                response = yield from client.request(
+                    "POST", url,
+                    headers=headers,
+                    data=payload)
+                reply = yield from response.read_and_close()
+                log.debug(reply)
+                tree = ET.fromstring(reply.decode("utf-8"))
+            except self.unreachable as e:
+                end()
+                log.warning("Postponing {}: {}".format(app.uuid, e))
+                self.postpone(loop, job, providerName)
+                continue
+            except Exception as e:
+                end()
+                log.error(e)
+                msg = PreProvisionAgent.Deferred(
+                    app.uuid, datetime.datetime.utcnow(), providerName)
+                loop.call_later(self.retry, msgQ.put_nowait, msg)
+                continue
 
-            tree = ET.fromstring(reply.decode("utf-8"))
+            task = next(
+                (i for i in tree.iter() if i.tag.endswith("}Task")), None)
+            if task is None:
+                end()
+            else:
+                client.running[task.attrib.get("href")] = end
             try:
                 vApp = next(find_xpath(".", tree, name=label.name))
             except StopIteration:
                 #TODO: Check error for duplicate, take action
                 log.error("Failed to find vapp")
+                msg = PreProvisionAgent.Deferred(
+                    app.uuid, datetime.datetime.utcnow(), providerName)
+                loop.call_later(self.retry, msgQ.put_nowait, msg)
             else:
+                if task is not None:
+                    PollSchedule().track(app.uuid, task.attrib.get("href"))
 
                 msg = PreProvisionAgent.Message(
                     app.uuid, datetime.datetime.utcnow(),
@@ -1038,20 +1311,31 @@ class ProvisioningAgent(Agent):
 
     Message = namedtuple("CheckRequiredMessage", ["uuid", "ts"])
 
+    Waiting = namedtuple("ProvisioningWaitMessage", ["uuid", "ts"])
+
+    Failed = namedtuple(
+        "ProvisioningFailedMessage", ["uuid", "ts", "status"])
+
     @property
     def callbacks(self):
         return [
             (ProvisioningAgent.Message, self.touch_to_precheck),
+            (ProvisioningAgent.Waiting, self.touch_to_provisioning),
+            (ProvisioningAgent.Failed, self.touch_to_preprovision),
         ]
 
     def jobs(self, session):
         # TODO: get token (need user registration ProviderToken)
         now = datetime.datetime.utcnow()
-        then = now - datetime.timedelta(seconds=20)
-        for app in session.query(Appliance).all():  # TODO: Filter earlier
+        schedule = PollSchedule()
+        for app in hosts(session, state="provisioning"):
             acts = app.changes
-            if acts[-1].state.name == "provisioning" and acts[-1].at < then:
-                prvdrName = app.organisation.subscriptions[0].provider.name
+            if acts[-1].state.name != "provisioning":
+                continue
+
+            prvdrName = node_provider(app)
+            key = schedule_key(app, prvdrName)
+            if schedule.due(app.uuid, key, acts[-1].at, now):
                 token = session.query(ProviderToken).join(Touch).join(
                     Provider).filter(Touch.actor == acts[0].actor).filter(
                     Provider.name == prvdrName).order_by(
@@ -1071,11 +1355,39 @@ class ProvisioningAgent(Agent):
         session.add(act)
         session.commit()
         return act
+
+    def touch_to_provisioning(self, msg:Waiting, session):
+        provisioning = session.query(ApplianceState).filter(
+            ApplianceState.name == "provisioning").one()
+        app = session.query(Appliance).filter(
+            Appliance.uuid == msg.uuid).first()
+        actor = session.query(Component).filter(
+            Component.handle=="burst.controller").one()
+        act = Touch(artifact=app, actor=actor, state=provisioning, at=msg.ts)
+        session.add(act)
+        session.commit()
+        PollSchedule().defer(app.uuid)
+        return act
+
+    def touch_to_preprovision(self, msg:Failed, session):
+        preprovision = session.query(ApplianceState).filter(
+            ApplianceState.name == "pre_provision").one()
+        app = session.query(Appliance).filter(
+            Appliance.uuid == msg.uuid).first()
+        actor = session.query(Component).filter(
+            Component.handle=="burst.controller").one()
+        act = Touch(artifact=app, actor=actor, state=preprovision, at=msg.ts)
+        session.add(act)
+        session.commit()
+        PollSchedule().forget(app.uuid)
+        return act
  
     @asyncio.coroutine
     def __call__(self, loop, msgQ, *args):
         log = logging.getLogger("cloudhands.burst.appliance.provisioning")
         log.info("Activated.")
+        poller = StatusPoller()
+        schedule = PollSchedule()
         while True:
             job = yield from self.work.get()
             log.debug(job)
@@ -1094,6 +1406,9 @@ class ProvisioningAgent(Agent):
 
             config = Strategy.config(node.provider.name)
 
+            if self.postponed(loop, job, config["metadata"]["path"]):
+                continue
+
             headers = {
                 "Accept": "application/*+xml;version=5.5",
             }
@@ -1102,23 +1417,55 @@ class ProvisioningAgent(Agent):
             except (TypeError, IndexError):
                 log.warning("No token supplied")
 
-            client = aiohttp.client.HttpClient(
-                ["{host}:{port}".format(
-                    host=config["host"]["name"],
-                    port=config["host"]["port"])
-                ],
-                verify_ssl=config["host"].getboolean("verify_ssl_cert")
-            )
+            client = Clients()(config)
 
-            response = yield from client.request(
-                "GET", node.uri, headers=headers)
-            reply = yield from response.read_and_close()
-            tree = ET.fromstring(reply.decode("utf-8"))
+            task = schedule.tasks.get(app.uuid)
+            if task is not None:
+                try:
+                    response = yield from client.request(
+                        "GET", task, headers=headers)
+                    reply = yield from response.read_and_close()
+                except self.unreachable as e:
+                    log.warning("Postponing {}: {}".format(app.uuid, e))
+                    self.postpone(loop, job, config["metadata"]["path"])
+                    continue
+                tree = ET.fromstring(reply.decode("utf-8"))
+                status = tree.attrib.get("status")
+                if status in ("queued", "preRunning", "running"):
+                    msg = ProvisioningAgent.Waiting(
+                        job.uuid, datetime.datetime.utcnow())
+                    yield from msgQ.put(msg)
+                    continue
+
+                del schedule.tasks[app.uuid]
+                client.end_task(task)
+                if status != "success":
+                    log.warning("Task {} ended with status {}".format(
+                        task, status))
+                    msg = ProvisioningAgent.Failed(
+                        job.uuid, datetime.datetime.utcnow(), status)
+                    yield from msgQ.put(msg)
+                    continue
+
+            record = yield from poller(
+                client, headers, config, job.token, node.uri, loop=loop)
+            if record is None:
+                try:
+                    response = yield from client.request(
+                        "GET", node.uri, headers=headers)
+                    reply = yield from response.read_and_close()
+                except self.unreachable as e:
+                    log.warning("Postponing {}: {}".format(app.uuid, e))
+                    self.postpone(loop, job, config["metadata"]["path"])
+                    continue
+                tree = ET.fromstring(reply.decode("utf-8"))
 
-            try:
-                sectionElement = next(find_customizationsection(tree))
-            except StopIteration:
-                log.warning("Missing customisation script")
+                try:
+                    sectionElement = next(find_customizationsection(tree))
+                except StopIteration:
+                    log.warning("Missing customisation script")
+            else:
+                log.debug(record)
 
             msg = ProvisioningAgent.Message(
                 job.uuid, datetime.datetime.utcnow())
@@ -1130,15 +1477,21 @@ class PreStartAgent(Agent):
     Message = namedtuple(
         "OperationalMessage", ["uuid", "ts", "provider"])
 
+    Failed = namedtuple(
+        "StartFailedMessage", ["uuid", "ts", "provider"])
+
     @property
     def callbacks(self):
-        return [(PreStartAgent.Message, self.touch_to_running)]
+        return [
+            (PreStartAgent.Message, self.touch_to_running),
+            (PreStartAgent.Failed, touch_again),
+        ]
 
     def jobs(self, session):
-        for app in session.query(Appliance).all():  # TODO: Filter earlier
+        for app in hosts(session, state="pre_start"):
             acts = app.changes
             if acts[-1].state.name == "pre_start":
-                prvdrName = app.organisation.subscriptions[0].provider.name
+                prvdrName = node_provider(app)
                 token = session.query(ProviderToken).join(Touch).join(
                     Provider).filter(Touch.actor == acts[0].actor).filter(
                     Provider.name == prvdrName).order_by(
@@ -1166,8 +1519,11 @@ class PreStartAgent(Agent):
         log = logging.getLogger("cloudhands.burst.appliance.prestart")
         log.info("Activated.")
         ET.register_namespace("", "http://www.vmware.com/vcloud/v1.5")
+        payloads = Payloads()
+        tracker = TaskTracker()
         while True:
             job = yield from self.work.get()
+            end = None
             try:
                 app = job.artifact
                 resources = sorted(
@@ -1177,6 +1533,9 @@ class PreStartAgent(Agent):
                 node = next(i for i in resources if isinstance(i, Node))
                 config = Strategy.config(node.provider.name)
 
+                if self.postponed(loop, job, config["metadata"]["path"]):
+                    continue
+
                 headers = {
                     "Accept": "application/*+xml;version=5.5",
                 }
@@ -1185,36 +1544,51 @@ class PreStartAgent(Agent):
                 except (TypeError, IndexError):
                     log.warning("No token supplied")
 
-                client = aiohttp.client.HttpClient(
-                    ["{host}:{port}".format(
-                        host=config["host"]["name"],
-                        port=config["host"]["port"])
-                    ],
-                    verify_ssl=config["host"].getboolean("verify_ssl_cert")
-                )
+                client = Clients()(config)
 
-                deploy = textwrap.dedent("""
-                <DeployVAppParams xmlns="http://www.vmware.com/vcloud/v1.5"
-                powerOn="true" />
-                """)
                 url = "{}/action/deploy".format(node.uri)
                 headers["Content-Type"] = (
                     "application/vnd.vmware.vcloud.deployVAppParams+xml")
+                end = yield from client.begin_task()
                 response = yield from client.request(
                     "POST", url,
                     headers=headers,
-                    data=deploy.encode("utf-8"))
+                    data=payloads.render("DeployVAppParams"))
                 reply = yield from response.read_and_close()
 
+            except self.unreachable as e:
+                log.warning("Postponing {}: {}".format(app.uuid, e))
+                if end is not None:
+                    end()
+                self.postpone(loop, job, config["metadata"]["path"])
+                continue
             except Exception as e:
                 log.error(e)
+                if end is not None:
+                    end()
                 continue
 
+            try:
+                tree = ET.fromstring(reply.decode("utf-8"))
+            except ET.ParseError as e:
+                log.warning(e)
+                tree = None
+
             msg = PreStartAgent.Message(
                 app.uuid, datetime.datetime.utcnow(),
                 node.provider.name
             )
-            yield from msgQ.put(msg)
+            if tree is not None and tree.tag.endswith("}Task"):
+                task = tracker.watch(
+                    client, headers, config, job.token,
+                    tree.attrib.get("href"), loop=loop)
+                task.add_done_callback(end)
+                failed = PreStartAgent.Failed(*msg)
+                asyncio.Task(
+                    when_complete(task, msgQ, msg, failed), loop=loop)
+            else:
+                end()
+                yield from msgQ.put(msg)
 
 
 class PreStopAgent(Agent):
@@ -1222,15 +1596,21 @@ class PreStopAgent(Agent):
     Message = namedtuple(
         "StoppedMessage", ["uuid", "ts", "provider"])
 
+    Failed = namedtuple(
+        "StopFailedMessage", ["uuid", "ts", "provider"])
+
     @property
     def callbacks(self):
-        return [(PreStopAgent.Message, self.touch_to_stopped)]
+        return [
+            (PreStopAgent.Message, self.touch_to_stopped),
+            (PreStopAgent.Failed, touch_again),
+        ]
 
     def jobs(self, session):
-        for app in session.query(Appliance).all():  # TODO: Filter earlier
+        for app in hosts(session, state="pre_stop"):
             acts = app.changes
             if acts[-1].state.name == "pre_stop":
-                prvdrName = app.organisation.subscriptions[0].provider.name
+                prvdrName = node_provider(app)
                 token = session.query(ProviderToken).join(Touch).join(
                     Provider).filter(Touch.actor == acts[0].actor).filter(
                     Provider.name == prvdrName).order_by(
@@ -1258,6 +1638,8 @@ class PreStopAgent(Agent):
         log = logging.getLogger("cloudhands.burst.appliance.prestop")
         log.info("Activated.")
         ET.register_namespace("", "http://www.vmware.com/vcloud/v1.5")
+        payloads = Payloads()
+        tracker = TaskTracker()
         while True:
             job = yield from self.work.get()
             app = job.artifact
@@ -1268,6 +1650,9 @@ class PreStopAgent(Agent):
             node = next(i for i in resources if isinstance(i, Node))
             config = Strategy.config(node.provider.name)
 
+            if self.postponed(loop, job, config["metadata"]["path"]):
+                continue
+
             headers = {
                 "Accept": "application/*+xml;version=5.5",
             }
@@ -1276,30 +1661,49 @@ class PreStopAgent(Agent):
             except (TypeError, IndexError):
                 log.warning("No token supplied")
 
-            client = aiohttp.client.HttpClient(
-                ["{host}:{port}".format(
-                    host=config["host"]["name"],
-                    port=config["host"]["port"])
-                ],
-                verify_ssl=config["host"].getboolean("verify_ssl_cert")
-            )
+            client = Clients()(config)
 
-            unDeploy = textwrap.dedent("""
-            <UndeployVAppParams xmlns="http://www.vmware.com/vcloud/v1.5">
-            <UndeployPowerAction>powerOff</UndeployPowerAction>
-            </UndeployVAppParams>
-            """)
             url = "{}/action/undeploy".format(node.uri)
             headers["Content-Type"] = (
                 "application/vnd.vmware.vcloud.undeployVAppParams+xml")
-            response = yield from client.request(
-                "POST", url,
-                headers=headers,
-                data=unDeploy.encode("utf-8"))
-            reply = yield from response.read_and_close()
+            end = yield from client.begin_task()
+            try:
+                response = yield from client.request(
+                    "POST", url,
+                    headers=headers,
+                    data=payloads.render("UndeployVAppParams", action="powerOff"))
+                reply = yield from response.read_and_close()
+            except self.unreachable as e:
+                end()
+                log.warning("Postponing {}: {}".format(app.uuid, e))
+                self.postpone(loop, job, config["metadata"]["path"])
+                continue
+            except Exception as e:
+                end()
+                log.error(e)
+                msg = PreStopAgent.Failed(
+                    app.uuid, datetime.datetime.utcnow(),
+                    node.provider.name)
+                yield from msgQ.put(msg)
+                continue
+            try:
+                tree = ET.fromstring(reply.decode("utf-8"))
+            except ET.ParseError as e:
+                log.warning(e)
+                tree = None
 
             msg = PreStopAgent.Message(
                 app.uuid, datetime.datetime.utcnow(),
                 node.provider.name
             )
-            yield from msgQ.put(msg)
+            if tree is not None and tree.tag.endswith("}Task"):
+                task = tracker.watch(
+                    client, headers, config, job.token,
+                    tree.attrib.get("href"), loop=loop)
+                task.add_done_callback(end)
+                failed = PreStopAgent.Failed(*msg)
+                asyncio.Task(
+                    when_complete(task, msgQ, msg, failed), loop=loop)
+            else:
+                end()
+                yield from msgQ.put(msg)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+import logging
+
+from cloudhands.burst.agent import Agent
+from cloudhands.burst.control import vdc_headroom
+from cloudhands.burst.health import Breaker
+from cloudhands.burst.health import Health
+from cloudhands.burst.strategy import Capacities
+from cloudhands.burst.workers import WorkerPool
+from cloudhands.common.discovery import providers
+
+
+class CapacityAgent(Agent):
+    """
+    Refreshes the vDC capacity of every provider each `interval` seconds,
+    and keeps it in :py:class:`cloudhands.burst.strategy.Capacities`.
+    It has no jobs and sends no messages.
+    """
+
+    interval = 300
+
+    @property
+    def callbacks(self):
+        return []
+
+    def jobs(self, session):
+        return tuple()
+
+    @asyncio.coroutine
+    def __call__(self, loop, msgQ, *args):
+        log = logging.getLogger("cloudhands.burst.capacity")
+        log.info("Activated.")
+        names = [cfg["metadata"]["path"]
+                 for p in providers.values() for cfg in p]
+        capacities = Capacities()
+        health = Health()
+        while True:
+            exctr = WorkerPool(self.config).executor
+            # Outcomes count here, in the process whose agents consult
+            # the breakers, not in the workers
+            ready = [name for name in names if health(name).allow()]
+            results = yield from asyncio.gather(*[
+                loop.run_in_executor(exctr, vdc_headroom, name)
+                for name in ready], loop=loop, return_exceptions=True)
+            for name, result in zip(ready, results):
+                if isinstance(result, Exception):
+                    if Breaker.unavailable(result):
+                        health(name).failure()
+                    else:
+                        health(name).success()
+                    log.warning("No capacity from {}: {}".format(name, result))
+                    continue
+
+                health(name).success()
+                if result is not None:
+                    capacities.update(name, result)
+                    log.debug("{} headroom {}".format(name, result))
+            yield from asyncio.sleep(self.interval, loop=loop)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+import logging
+import xml.etree.ElementTree as ET
+
+import aiohttp
+
+from cloudhands.burst.health import CircuitOpen
+from cloudhands.burst.health import Health
+
+__doc__ = """
+Agents make their HTTP requests to a provider through a single
+:py:class:`ProviderClient`. :py:class:`Clients` holds one for each provider.
+"""
+
+
+class Reply:
+    """
+    The response to a GET, which may be shared by several callers. It
+    reads like an :py:class:`aiohttp.client.HttpResponse`.
+
+    The element tree from :py:meth:`tree` is parsed once and shared too.
+    A caller which alters it must work on a copy.
+    """
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self._tree = None
+
+    @asyncio.coroutine
+    def read_and_close(self):
+        return self.body
+
+    def tree(self):
+        if self._tree is None:
+            self._tree = ET.fromstring(self.body.decode("utf-8"))
+        return self._tree
+
+
+class Waits:
+    """
+    Statistics of the time spent waiting for a limiter.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.longest = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return "<Waits: count={}, mean={:.3f}, longest={:.3f}>".format(
+            self.count, self.mean, self.longest)
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions each second on average, and up to `burst`
+    at once. `rate` must be positive and `burst` at least one.
+    """
+
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst < 1:
+            raise ValueError(
+                "Bad token bucket: rate {}, burst {}".format(rate, burst))
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    def refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @asyncio.coroutine
+    def acquire(self, loop=None):
+        """
+        Wait for a token.
+
+        :returns: The seconds spent waiting.
+        """
+        loop = loop or asyncio.get_event_loop()
+        start = now = loop.time()
+        while True:
+            self.refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return now - start
+            yield from asyncio.sleep((1 - self.tokens) / self.rate, loop=loop)
+            now = loop.time()
+
+
+class ProviderClient:
+    """
+    Makes HTTP requests to a provider. Its `request` method has the same
+    signature as that of :py:class:`aiohttp.client.HttpClient`.
+
+    Requests pass through the provider's
+    :py:class:`cloudhands.burst.health.Breaker`. They fail with
+    :py:class:`cloudhands.burst.health.CircuitOpen` while it is open. A
+    request which raises, takes longer than `timeout` seconds, or gets
+    a status in `unavailable` counts as a failure.
+
+    Requests are limited to `rate` each second, with bursts of `burst`.
+    Those made with a session token are also limited to `token_rate`
+    each second for that token. No more than `tasks` long-running tasks
+    may be started at once; see :py:meth:`begin_task`. These may be set
+    in the `limits` section of the provider's configuration; a value
+    which is not positive, or a burst or task count below one, is
+    ignored in favour of the default. The time spent waiting for each
+    limit is kept in `waits`.
+
+    GETs in flight are kept in `flights`, so that identical ones may share
+    them. The number which did so is kept in `coalesced`.
+    """
+
+    timeout = 120
+    unavailable = (502, 503, 504)
+
+    rate = 10
+    burst = 20
+    token_rate = 4
+    tasks = 8
+
+    #: The longest a task may hold its slot.
+    task_expiry = 600
+
+    #: The most per-token limiters kept before idle ones are dropped.
+    tokens = 1024
+
+    def __init__(self, config):
+        self.name = config["metadata"]["path"]
+        self.client = aiohttp.client.HttpClient(
+            ["{host}:{port}".format(
+                host=config["host"]["name"],
+                port=config["host"]["port"])
+            ],
+            verify_ssl=config["host"].getboolean("verify_ssl_cert")
+        )
+        log = logging.getLogger("cloudhands.burst.client.ProviderClient")
+        limits = config["limits"] if "limits" in config else {}
+        for key, kind, least in (
+            ("rate", float, 0), ("burst", float, 1),
+            ("token_rate", float, 0), ("tasks", int, 1)
+        ):
+            val = kind(limits.get(key, getattr(self, key)))
+            if val <= 0 or val < least:
+                log.warning("Ignoring {} limit of {} for {}".format(
+                    key, val, self.name))
+            else:
+                setattr(self, key, val)
+
+        self.bucket = TokenBucket(self.rate, self.burst)
+        self.buckets = {}
+        self.slots = asyncio.Semaphore(self.tasks)
+        self.running = {}
+        self.waits = {"rate": Waits(), "token": Waits(), "tasks": Waits()}
+        self.flights = {}
+        self.coalesced = 0
+
+    def token_bucket(self, token, now=None):
+        try:
+            return self.buckets[token]
+        except KeyError:
+            if len(self.buckets) >= self.tokens:
+                # A bucket which has refilled has been idle a while
+                now = asyncio.get_event_loop().time() if now is None else now
+                for bucket in self.buckets.values():
+                    bucket.refill(now)
+                self.buckets = {
+                    k: v for k, v in self.buckets.items()
+                    if v.tokens < v.burst}
+            if len(self.buckets) >= self.tokens:
+                stalest = min(
+                    self.buckets, key=lambda k: self.buckets[k].updated)
+                del self.buckets[stalest]
+            rv = self.buckets[token] = TokenBucket(
+                self.token_rate, max(1, self.token_rate))
+            return rv
+
+    @asyncio.coroutine
+    def throttle(self, headers):
+        """
+        Wait until a request with these headers may be made.
+        """
+        log = logging.getLogger("cloudhands.burst.client.throttle")
+        waited = yield from self.bucket.acquire()
+        self.waits["rate"].record(waited)
+        token = (headers or {}).get("x-vcloud-authorization")
+        if token:
+            held = yield from self.token_bucket(token).acquire()
+            self.waits["token"].record(held)
+            waited += held
+        if waited > 1:
+            log.debug("Waited {:.1f}s to call {}".format(waited, self.name))
+
+    @asyncio.coroutine
+    def begin_task(self):
+        """
+        Wait for a slot in which to start a long-running task.
+
+        :returns: A function which frees the slot. It may be called
+            more than once, or given as a callback. The slot is freed
+            anyway after `task_expiry` seconds.
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        yield from self.slots.acquire()
+        self.waits["tasks"].record(loop.time() - start)
+        state = {"done": False}
+
+        def end(*args):
+            if not state["done"]:
+                state["done"] = True
+                self.slots.release()
+                handle.cancel()
+
+        handle = loop.call_later(self.task_expiry, end)
+        return end
+
+    def end_task(self, href):
+        """
+        Free the slot of a task recorded in `running` by its href.
+        """
+        end = self.running.pop(href, None)
+        if end is not None:
+            end()
+
+    @staticmethod
+    def scope(url, kwargs):
+        """
+        :returns: A key for a GET which is the same for any other GET of
+            that url with the same credentials.
+        """
+        headers = kwargs.get("headers") or {}
+        return (
+            url, headers.get("x-vcloud-authorization"),
+            headers.get("Accept"), repr(kwargs.get("auth")))
+
+    @asyncio.coroutine
+    def request(self, method, url, **kwargs):
+        """
+        Make a request. Concurrent GETs of the same url with the same
+        credentials share one request; each caller gets the same
+        :py:class:`Reply`.
+        """
+        if method.upper() != "GET" or kwargs.get("data") is not None:
+            return (yield from self.send(method, url, **kwargs))
+
+        key = self.scope(url, kwargs)
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = asyncio.Task(
+                self.fetch(method, url, **kwargs))
+
+            def land(future):
+                if self.flights.get(key) is future:
+                    del self.flights[key]
+
+            flight.add_done_callback(land)
+        else:
+            self.coalesced += 1
+        return (yield from asyncio.shield(flight))
+
+    @asyncio.coroutine
+    def fetch(self, method, url, **kwargs):
+        response = yield from self.send(method, url, **kwargs)
+        body = yield from response.read_and_close()
+        return Reply(response.status, response.headers, body)
+
+    @asyncio.coroutine
+    def send(self, method, url, **kwargs):
+        yield from self.throttle(kwargs.get("headers"))
+        breaker = Health()(self.name)
+        if not breaker.allow():
+            raise CircuitOpen(self.name)
+        response = None
+        try:
+            response = yield from asyncio.wait_for(
+                self.client.request(method, url, **kwargs), self.timeout)
+        except Exception:
+            breaker.failure()
+            raise
+        finally:
+            if response is None:
+                # Cancelled, so the probe must not be held forever
+                breaker.release()
+
+        if response.status in self.unavailable:
+            breaker.failure()
+        else:
+            breaker.success()
+        return response
+
+
+class Clients:
+    """
+    Keeps one :py:class:`ProviderClient` for each provider.
+    """
+
+    _shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "clients"):
+            self.clients = {}
+
+    def __call__(self, config):
+        """
+        Return the client for the provider described by `config`.
+        """
+        key = config["metadata"]["path"]
+        try:
+            return self.clients[key]
+        except KeyError:
+            log = logging.getLogger("cloudhands.burst.client.clients")
+            rv = self.clients[key] = ProviderClient(config)
+            log.debug("Client created for {}".format(key))
+            return rv
+
+    def stats(self):
+        """
+        :returns: The wait statistics of each client, keyed by provider.
+        """
+        return {k: dict(v.waits) for k, v in self.clients.items()}
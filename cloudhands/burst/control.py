@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 # encoding: UTF-8
 
+import functools
+import importlib
 import os
 import os.path
 import logging
 import sqlite3
+import threading
+import time
 
 from libcloud import security
+from libcloud.common.types import InvalidCredsError
 from libcloud.compute.base import NodeAuthPassword
-from libcloud.compute.providers import DRIVERS
-from libcloud.compute.providers import get_driver
 
+from cloudhands.burst.strategy import headroom
+from cloudhands.burst.strategy import Strategy
 from cloudhands.common.connectors import initialise
 from cloudhands.common.connectors import Registry
 from cloudhands.common.discovery import bundles
@@ -106,6 +111,32 @@ def debug_node(self, **kwargs):
     return node
 
 
+@functools.lru_cache()
+def driver_class(module, name, verify):
+    """
+    Load a libcloud driver class. Its HTTPS connections verify certificates
+    according to `verify`, and not `libcloud.security.VERIFY_SSL_CERT`,
+    which is shared by every driver in the process.
+
+    :returns: A subclass of the driver named `name` in `module`.
+    """
+    drvr = getattr(importlib.import_module(module), name)
+    http, https = drvr.connectionCls.conn_classes
+
+    class HTTPSConnection(https):
+
+        def _setup_verify(self):
+            self.verify = verify
+
+    class Connection(drvr.connectionCls):
+        conn_classes = (http, HTTPSConnection)
+
+    class Driver(drvr):
+        connectionCls = Connection
+
+    return Driver
+
+
 def connect(config):
     log = logging.getLogger("cloudhands.burst.control.connect")
     user = config["user"]["name"]
@@ -113,11 +144,9 @@ def connect(config):
     host = config["host"]["name"]
     port = config["host"]["port"]
     apiV = config["host"]["api_version"]
-    security.VERIFY_SSL_CERT = config["host"].getboolean("verify_ssl_cert")
-    DRIVERS[config["libcloud"]["provider"]] = (
-        config["libcloud"]["module"], config["libcloud"]["driver"])
-
-    drvr = get_driver(config["libcloud"]["provider"])
+    drvr = driver_class(
+        config["libcloud"]["module"], config["libcloud"]["driver"],
+        config["host"].getboolean("verify_ssl_cert"))
     log.debug(drvr)
     log.debug(' '.join((user, pswd, host, port, apiV)))
     conn = drvr(
@@ -126,24 +155,88 @@ def connect(config):
     return conn
 
 
+class Connections:
+    """
+    Keeps one libcloud driver per provider in each worker process.
+
+    A driver keeps its authentication token and the results of discovery,
+    so later operations on the same provider skip both. A driver idle for
+    longer than `idle` seconds is checked before reuse, and replaced if
+    its session has lapsed.
+    """
+
+    _shared_state = {}
+
+    idle = 300
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "drivers"):
+            self.drivers = {}
+            self.lock = threading.Lock()
+
+    def __call__(self, config):
+        """
+        Return a driver for the provider described by `config`.
+        """
+        log = logging.getLogger("cloudhands.burst.control.connections")
+        key = config["metadata"]["path"]
+        with self.lock:
+            now = time.time()
+            try:
+                conn, then = self.drivers[key]
+            except KeyError:
+                conn = None
+            else:
+                if now - then > self.idle and not self.healthy(conn):
+                    log.info("Reconnecting to {}".format(key))
+                    conn = None
+
+            if conn is None:
+                conn = connect(config)
+            self.drivers[key] = (conn, now)
+            return conn
+
+    @staticmethod
+    def healthy(conn):
+        """
+        Return True if the driver's session is still valid.
+        """
+        log = logging.getLogger("cloudhands.burst.control.healthy")
+        try:
+            conn.connection.request("/api/session")
+        except Exception as e:
+            log.debug(e)
+            return False
+        else:
+            return True
+
+    def discard(self, config):
+        """
+        Drop the driver for a provider so the next use connects afresh.
+        """
+        with self.lock:
+            self.drivers.pop(config["metadata"]["path"], None)
+
+
 def create_node(config, name, auth=None, size=None, image=None, network=None):
     """
-    Create a node the libcloud way. Connection is created locally to permit
-    threadpool dispatch.
+    Create a node the libcloud way. The connection is kept by the worker
+    process which runs this, so it is safe for process pool dispatch.
     """
     log = logging.getLogger("cloudhands.burst.control.create_node")
-    conn = connect(config)
-    log.debug("Connection uses {}".format(config["metadata"]["path"]))
     auth = auth or NodeAuthPassword("q1W2e3R4t5Y6")  # FIXME
-    images = conn.list_images()
-    img = ([i for i in images if i.name==image] or images)[0]
-    size = size or next(
-        i for i in conn.list_sizes() if i.name == "1024 Ram")
-    net = (
-        [i.get("href") for i in conn.networks if i.get("name") == network]
-        or [None])[0]  # TODO: remove
-    log.debug(net)
     try:
+        conn = Connections()(config)
+        log.debug("Connection uses {}".format(config["metadata"]["path"]))
+        images = conn.list_images()
+        img = ([i for i in images if i.name==image] or images)[0]
+        size = size or next(
+            i for i in conn.list_sizes() if i.name == "1024 Ram")
+        net = (
+            [i.get("href") for i in conn.networks if i.get("name") == network]
+            or [None])[0]  # TODO: remove
+        log.debug(net)
         node = conn.create_node(
             #name=name, auth=auth, size=size, image=img,
             #ex_network=network, ex_vm_fence="natRouted")
@@ -153,6 +246,8 @@ def create_node(config, name, auth=None, size=None, image=None, network=None):
         del node.driver  # rv should be picklable
     except Exception as e:
         log.warning(e)
+        if isinstance(e, InvalidCredsError):
+            Connections().discard(config)
         node = None
     return (config, node)
 
@@ -162,12 +257,14 @@ def describe_node(config, uri, auth=None, size=None, image=None):
     Get the attributes of an existing node.
     """
     log = logging.getLogger("cloudhands.burst.control.describe_node")
-    conn = connect(config)
-    log.debug("Connection uses {}".format(config["metadata"]["path"]))
     try:
-        node = next(i for i in conn.list_nodes() if i.id == uri)
+        conn = Connections()(config)
+        log.debug("Connection uses {}".format(config["metadata"]["path"]))
+        node = conn.ex_get_node(uri)
     except Exception as e:
         log.warning(e)
+        if isinstance(e, InvalidCredsError):
+            Connections().discard(config)
         return None
     else:
         log.debug(node)
@@ -176,17 +273,19 @@ def describe_node(config, uri, auth=None, size=None, image=None):
 
 def destroy_node(config, uri, auth=None, size=None, image=None):
     """
-    Destroy a node the libcloud way. Connection is created locally to permit
-    threadpool dispatch.
+    Destroy a node the libcloud way. The connection is kept by the worker
+    process which runs this, so it is safe for process pool dispatch.
     """
     log = logging.getLogger("cloudhands.burst.control.destroy_node")
-    conn = connect(config)
-    log.debug("Connection uses {}".format(config["metadata"]["path"]))
     try:
-        node = next(i for i in conn.list_nodes() if i.id == uri)
+        conn = Connections()(config)
+        log.debug("Connection uses {}".format(config["metadata"]["path"]))
+        node = conn.ex_get_node(uri)
         conn.destroy_node(node)
     except Exception as e:
         log.warning(e)
+        if isinstance(e, InvalidCredsError):
+            Connections().discard(config)
         uri = None
     return (config, uri)
 
@@ -196,7 +295,45 @@ def list_images(providerName):
         cfg for p in providers.values() for cfg in p
         if cfg["metadata"]["path"] == providerName
     ]:
-        conn = connect(config)
+        conn = Connections()(config)
         return [(i.name, i.id) for i in conn.list_images()]
     else:
         return None
+
+
+def list_images_since(providerName, fingerprints=None):
+    """
+    List images by the vDC or catalog which holds them, skipping catalogs
+    whose fingerprints are unchanged.
+
+    :returns: A dictionary keyed by vDC or catalog href. Each value is a
+        tuple of the fingerprint and a list of (name, id) pairs, or of the
+        fingerprint and None where the fingerprint is unchanged.
+    """
+    for config in [
+        cfg for p in providers.values() for cfg in p
+        if cfg["metadata"]["path"] == providerName
+    ]:
+        conn = Connections()(config)
+        listing = conn.ex_list_images_since(fingerprints)
+        return {
+            href: (fp, None if imgs is None else [(i.name, i.id) for i in imgs])
+            for href, (fp, imgs) in listing.items()}
+    else:
+        return None
+
+
+def vdc_headroom(providerName):
+    """
+    :returns: The :py:class:`cloudhands.burst.strategy.Headroom` of a
+        provider's vDCs, or None if the provider is not configured.
+    """
+    config = Strategy.config(providerName)
+    if config is None:
+        return None
+    try:
+        conn = Connections()(config)
+        return headroom(conn.ex_get_vdc_capacity())
+    except InvalidCredsError:
+        Connections().discard(config)
+        raise
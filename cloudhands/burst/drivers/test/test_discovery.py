@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import unittest
+import xml.etree.ElementTree as ET
+
+from cloudhands.burst.drivers.vcloud import VCloud_1_5_NodeDriver
+
+xml_org = """
+<Org xmlns="http://www.vmware.com/vcloud/v1.5"
+href="https://cloud/api/org/1" name="un-managed_tenancy_test_org"
+type="application/vnd.vmware.vcloud.org+xml">
+    <Link href="https://cloud/api/vdc/1" name="un-managed-tenancy-test-org-std"
+rel="down" type="application/vnd.vmware.vcloud.vdc+xml"/>
+    <Link href="https://cloud/api/catalog/1" name="Public catalog"
+rel="down" type="application/vnd.vmware.vcloud.catalog+xml"/>
+</Org>
+"""
+
+xml_vdc = """
+<Vdc xmlns="http://www.vmware.com/vcloud/v1.5"
+href="https://cloud/api/vdc/1" name="un-managed-tenancy-test-org-std"
+type="application/vnd.vmware.vcloud.vdc+xml">
+    <AllocationModel>AllocationPool</AllocationModel>
+    <ComputeCapacity>
+        <Cpu><Units>MHz</Units><Limit>10000</Limit><Used>2500</Used></Cpu>
+        <Memory><Units>MB</Units><Limit>8192</Limit><Used>4096</Used></Memory>
+    </ComputeCapacity>
+    <ResourceEntities>
+        <ResourceEntity href="https://cloud/api/vApp/vapp-1" name="test_01"
+type="application/vnd.vmware.vcloud.vApp+xml"/>
+        <ResourceEntity href="https://cloud/api/vApp/vapp-2" name="test_02"
+type="application/vnd.vmware.vcloud.vApp+xml"/>
+        <ResourceEntity href="https://cloud/api/vAppTemplate/vappTemplate-1"
+name="Ubuntu" type="application/vnd.vmware.vcloud.vAppTemplate+xml"/>
+    </ResourceEntities>
+</Vdc>
+"""
+
+xml_vapp = """
+<VApp xmlns="http://www.vmware.com/vcloud/v1.5"
+href="https://cloud/api/vApp/{0}" name="{0}" status="4"
+type="application/vnd.vmware.vcloud.vApp+xml">
+    <Link href="https://cloud/api/vdc/1" rel="up"
+type="application/vnd.vmware.vcloud.vdc+xml"/>
+</VApp>
+"""
+
+
+class Response:
+
+    def __init__(self, data):
+        self.object = ET.fromstring(data)
+
+
+class Connection:
+
+    def __init__(self):
+        self.requests = []
+
+    def check_org(self):
+        pass
+
+    def request(self, path, **kwargs):
+        self.requests.append(path)
+        if path.startswith("/api/vdc/"):
+            return Response(xml_vdc)
+        elif path.startswith("/api/vApp/"):
+            return Response(xml_vapp.format(path.rsplit("/", 1)[-1]))
+        else:
+            return Response(xml_org)
+
+
+class DiscoveryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = object.__new__(VCloud_1_5_NodeDriver)
+        self.driver.connection = Connection()
+        self.driver.org = "/api/org/1"
+
+    def test_catalogs_are_reused(self):
+        rv = self.driver._get_catalog_hrefs()
+        self.assertEqual(["https://cloud/api/catalog/1"], rv)
+        self.assertEqual(rv, self.driver._get_catalog_hrefs())
+        self.assertEqual(1, len(self.driver.connection.requests))
+
+    def test_refresh(self):
+        self.driver._get_catalog_hrefs()
+        self.driver.ex_refresh()
+        self.driver._get_catalog_hrefs()
+        self.assertEqual(2, len(self.driver.connection.requests))
+
+    def test_expiry(self):
+        self.driver.discovery_ttl = 0
+        self.driver._get_catalog_hrefs()
+        self.driver._get_catalog_hrefs()
+        self.assertEqual(2, len(self.driver.connection.requests))
+
+
+class ListingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = object.__new__(VCloud_1_5_NodeDriver)
+        self.driver.connection = Connection()
+        self.driver.connection.driver = self.driver
+        self.driver.org = "/api/org/1"
+
+    def test_list_nodes(self):
+        rv = self.driver.ex_list_nodes(ex_max_workers=4)
+        self.assertEqual(
+            ["https://cloud/api/vApp/vapp-1", "https://cloud/api/vApp/vapp-2"],
+            [i.id for i in rv])
+
+    def test_get_node(self):
+        rv = self.driver.ex_get_node("https://cloud/api/vApp/vapp-2")
+        self.assertEqual("https://cloud/api/vApp/vapp-2", rv.id)
+        self.assertNotIn(
+            "/api/vApp/vapp-1", self.driver.connection.requests)
+
+    def test_vdc_capacity_is_fetched(self):
+        self.driver.vdcs
+        n = len(self.driver.connection.requests)
+        rv = self.driver.ex_get_vdc_capacity()
+        self.assertEqual(n + 1, len(self.driver.connection.requests))
+        self.assertEqual(2500, rv[0].cpu.used)
+        self.assertEqual(8192, rv[0].memory.limit)
@@ -17,6 +17,7 @@ VMware vCloud driver.
 """
 import copy
 import sys
+import threading
 import re
 import base64
 import os
@@ -30,6 +31,7 @@ urlparse = urlparse.urlparse
 
 import time
 
+from concurrent import futures
 from xml.etree import ElementTree as ET
 from xml.parsers.expat import ExpatError
 
@@ -40,6 +42,8 @@ from libcloud.compute.types import NodeState
 from libcloud.compute.base import Node, NodeDriver, NodeLocation
 from libcloud.compute.base import NodeSize, NodeImage, NodeAuthPassword
 
+from cloudhands.burst.utils import fingerprint
+
 """
 From vcloud api "The VirtualQuantity element defines the number of MB
 of memory. This should be either 512 or a multiple of 1024 (1 GB)."
@@ -48,6 +52,25 @@ VIRTUAL_MEMORY_VALS = [512] + [1024 * i for i in range(1, 9)]
 
 DEFAULT_TASK_COMPLETION_TIMEOUT = 600
 
+"""
+Intervals in seconds between polls of a task. Short tasks are noticed
+quickly; long ones are polled less often as they go on.
+"""
+TASK_POLL_INTERVAL_MIN = 1
+TASK_POLL_INTERVAL_MAX = 15
+TASK_POLL_BACKOFF = 1.5
+
+"""
+Seconds for which the results of vDC, network and catalog discovery are
+reused. See L{VCloudNodeDriver.ex_refresh}.
+"""
+DEFAULT_DISCOVERY_TTL = 300
+
+"""
+Maximum number of concurrent requests made when listing nodes.
+"""
+DEFAULT_LIST_CONCURRENCY = 8
+
 DEFAULT_API_VERSION = '0.8'
 
 """
@@ -362,7 +385,8 @@ class VCloudNodeDriver(NodeDriver):
     website = 'http://www.vmware.com/products/vcloud/'
     connectionCls = VCloudConnection
     org = None
-    _vdcs = None
+    _discovered = None
+    discovery_ttl = DEFAULT_DISCOVERY_TTL
 
     NODE_STATE_MAP = {'0': NodeState.PENDING,
                       '1': NodeState.PENDING,
@@ -395,17 +419,63 @@ class VCloudNodeDriver(NodeDriver):
         @return: list of vDC objects
         @rtype: C{list} of L{Vdc}
         """
-        if not self._vdcs:
+        def discover():
             self.connection.check_org()  # make sure the org is set.  # pylint: disable-msg=E1101
             res = self.connection.request(self.org)
-            self._vdcs = [
-                self._to_vdc(
-                    self.connection.request(get_url_path(i.get('href'))).object
-                )
+            return [
+                self._to_vdc(self._get_vdc_elm(i.get('href')))
                 for i in res.object.findall(fixxpath(res.object, "Link"))
                 if i.get('type') == 'application/vnd.vmware.vcloud.vdc+xml'
             ]
-        return self._vdcs
+
+        return self._discover('vdcs', discover)
+
+    def _discover(self, key, func):
+        """
+        Return the result of a discovery call, reusing it for up to
+        C{discovery_ttl} seconds.
+        """
+        if self._discovered is None:
+            self._discovered = {}
+        now = time.time()
+        try:
+            then, rv = self._discovered[key]
+        except KeyError:
+            pass
+        else:
+            if now - then < self.discovery_ttl:
+                return rv
+        rv = func()
+        self._discovered[key] = (now, rv)
+        return rv
+
+    def ex_get_vdc_capacity(self):
+        """
+        Fetch the vDCs again for their current capacity. The vDCs
+        themselves are found as discovered.
+
+        @return: list of vDC objects
+        @rtype: C{list} of L{Vdc}
+        """
+        rv = []
+        for href in [i.id for i in self.vdcs]:
+            elm = self.connection.request(get_url_path(href)).object
+            self._discovered[('vdc', href)] = (time.time(), elm)
+            rv.append(self._to_vdc(elm))
+        return rv
+
+    def ex_refresh(self):
+        """
+        Discard the results of discovery so that the next use of
+        C{vdcs}, C{networks} or the catalogs requests them again.
+        """
+        self._discovered = {}
+
+    def _get_vdc_elm(self, vdc_href):
+        """Given a vDC href returns its elementree, reused as discovered"""
+        return self._discover(
+            ('vdc', vdc_href),
+            lambda: self.connection.request(get_url_path(vdc_href)).object)
 
     def _to_vdc(self, vdc_elm):
         return Vdc(vdc_elm.get('href'), vdc_elm.get('name'), self)
@@ -428,7 +498,7 @@ class VCloudNodeDriver(NodeDriver):
     def networks(self):
         networks = []
         for vdc in self.vdcs:
-            res = self.connection.request(get_url_path(vdc.id)).object
+            res = self._get_vdc_elm(vdc.id)
             networks.extend(
                 [network
                  for network in res.findall(
@@ -481,18 +551,20 @@ class VCloudNodeDriver(NodeDriver):
         return node
 
     def _get_catalog_hrefs(self):
-        res = self.connection.request(self.org)
-        catalogs = [
-            i.get('href')
-            for i in res.object.findall(fixxpath(res.object, "Link"))
-            if i.get('type') == 'application/vnd.vmware.vcloud.catalog+xml'
-        ]
+        def discover():
+            res = self.connection.request(self.org)
+            return [
+                i.get('href')
+                for i in res.object.findall(fixxpath(res.object, "Link"))
+                if i.get('type') == 'application/vnd.vmware.vcloud.catalog+xml'
+            ]
 
-        return catalogs
+        return self._discover('catalogs', discover)
 
     def _wait_for_task_completion(self, task_href,
                                   timeout=DEFAULT_TASK_COMPLETION_TIMEOUT):
         start_time = time.time()
+        interval = TASK_POLL_INTERVAL_MIN
         res = self.connection.request(get_url_path(task_href))
         status = res.object.get('status')
         while status != 'success':
@@ -510,7 +582,9 @@ class VCloudNodeDriver(NodeDriver):
             if (time.time() - start_time >= timeout):
                 raise Exception("Timeout (%s sec) while waiting for task %s."
                                 % (timeout, task_href))
-            time.sleep(5)
+            time.sleep(interval)
+            interval = min(TASK_POLL_INTERVAL_MAX,
+                           interval * TASK_POLL_BACKOFF)
             res = self.connection.request(get_url_path(task_href))
             status = res.object.get('status')
 
@@ -550,50 +624,87 @@ class VCloudNodeDriver(NodeDriver):
     def list_nodes(self):
         return self.ex_list_nodes()
 
-    def ex_list_nodes(self, vdcs=None):
+    def ex_list_nodes(self, vdcs=None,
+                      ex_max_workers=DEFAULT_LIST_CONCURRENCY):
         """
         List all nodes across all vDCs. Using 'vdcs' you can specify which vDCs
         should be queried.
 
+        The vDCs, and then their vApps, are fetched concurrently. Each
+        worker thread makes its requests on its own copy of the connection.
+
         @param vdcs: None, vDC or a list of vDCs to query. If None all vDCs
                      will be queried.
         @type vdcs: L{Vdc}
 
+        @param ex_max_workers: The most requests to make at once.
+        @type ex_max_workers: C{int}
+
         @rtype: C{list} of L{Node}
         """
+        # Discover vDCs before the workers need them
+        known = self.vdcs
         if not vdcs:
-            vdcs = self.vdcs
+            vdcs = known
         if not isinstance(vdcs, (list, tuple)):
             vdcs = [vdcs]
-        nodes = []
-        for vdc in vdcs:
-            res = self.connection.request(get_url_path(vdc.id))
-            elms = res.object.findall(fixxpath(
-                res.object, "ResourceEntities/ResourceEntity")
-            )
+
+        local = threading.local()
+
+        def request(href, **kwargs):
+            try:
+                conn = local.connection
+            except AttributeError:
+                conn = local.connection = copy.copy(self.connection)
+            return conn.request(get_url_path(href), **kwargs)
+
+        def get_vapp(vapp_href):
+            try:
+                res = request(
+                    vapp_href,
+                    headers={'Content-Type': 'application/vnd.vmware.vcloud.vApp+xml'}
+                )
+                return self._to_node(res.object)
+            except Exception:
+                # The vApp was probably removed since the previous vDC query, ignore
+                e = sys.exc_info()[1]
+                if not (e.args[0].tag.endswith('Error') and
+                        e.args[0].get('minorErrorCode') == 'ACCESS_TO_RESOURCE_IS_FORBIDDEN'):
+                    raise
+                return None
+
+        with futures.ThreadPoolExecutor(
+                max_workers=max(1, ex_max_workers)) as pool:
+            vdc_elms = list(
+                pool.map(lambda vdc: request(vdc.id).object, vdcs))
             vapps = [
-                (i.get('name'), i.get('href'))
-                for i in elms
+                i.get('href')
+                for res in vdc_elms
+                for i in res.findall(fixxpath(
+                    res, "ResourceEntities/ResourceEntity"))
                 if i.get('type')
                     == 'application/vnd.vmware.vcloud.vApp+xml'
                     and i.get('name')
             ]
+            nodes = list(pool.map(get_vapp, vapps))
 
-            for vapp_name, vapp_href in vapps:
-                try:
-                    res = self.connection.request(
-                        get_url_path(vapp_href),
-                        headers={'Content-Type': 'application/vnd.vmware.vcloud.vApp+xml'}
-                    )
-                    nodes.append(self._to_node(res.object))
-                except Exception:
-                    # The vApp was probably removed since the previous vDC query, ignore
-                    e = sys.exc_info()[1]
-                    if not (e.args[0].tag.endswith('Error') and
-                            e.args[0].get('minorErrorCode') == 'ACCESS_TO_RESOURCE_IS_FORBIDDEN'):
-                        raise
+        return [i for i in nodes if i is not None]
+
+    def ex_get_node(self, node_id):
+        """
+        Get a single node by its href, which is also its id. This avoids
+        listing every node to find one.
+
+        @param node_id: The href of the vApp.
+        @type node_id: C{str}
 
-        return nodes
+        @rtype: L{Node}
+        """
+        res = self.connection.request(
+            get_url_path(node_id),
+            headers={'Content-Type': 'application/vnd.vmware.vcloud.vApp+xml'}
+        )
+        return self._to_node(res.object)
 
     def _to_size(self, ram):
         ns = NodeSize(
@@ -613,37 +724,38 @@ class VCloudNodeDriver(NodeDriver):
 
     def _get_catalogitems_hrefs(self, catalog):
         """Given a catalog href returns contained catalog item hrefs"""
-        res = self.connection.request(
-            get_url_path(catalog),
-            headers={
-                'Content-Type': 'application/vnd.vmware.vcloud.catalog+xml'
-            }
-        ).object
+        def discover():
+            res = self.connection.request(
+                get_url_path(catalog),
+                headers={
+                    'Content-Type': 'application/vnd.vmware.vcloud.catalog+xml'
+                }
+            ).object
 
-        cat_items = res.findall(fixxpath(res, "CatalogItems/CatalogItem"))
-        cat_item_hrefs = [i.get('href')
-                          for i in cat_items
-                          if i.get('type') ==
-                             'application/vnd.vmware.vcloud.catalogItem+xml']
+            cat_items = res.findall(fixxpath(res, "CatalogItems/CatalogItem"))
+            return [i.get('href')
+                    for i in cat_items
+                    if i.get('type') ==
+                        'application/vnd.vmware.vcloud.catalogItem+xml']
 
-        return cat_item_hrefs
+        return self._discover(('catalog', catalog), discover)
 
     def _get_catalogitem(self, catalog_item):
         """Given a catalog item href returns elementree"""
-        res = self.connection.request(
-            get_url_path(catalog_item),
-            headers={
-                'Content-Type':
-                    'application/vnd.vmware.vcloud.catalogItem+xml'
-            }
-        ).object
-
-        return res
+        return self._discover(
+            ('catalogItem', catalog_item),
+            lambda: self.connection.request(
+                get_url_path(catalog_item),
+                headers={
+                    'Content-Type':
+                        'application/vnd.vmware.vcloud.catalogItem+xml'
+                }
+            ).object)
 
     def list_images(self, location=None):
         images = []
         for vdc in self.vdcs:
-            res = self.connection.request(get_url_path(vdc.id)).object
+            res = self._get_vdc_elm(vdc.id)
             res_ents = res.findall(fixxpath(
                 res, "ResourceEntities/ResourceEntity")
             )
@@ -670,6 +782,75 @@ class VCloudNodeDriver(NodeDriver):
 
         return self._uniquer(images, idfun)
 
+    def ex_list_images_since(self, fingerprints=None):
+        """
+        List images by the vDC or catalog which holds them. Items of a
+        catalog are only fetched if its fingerprint differs from the one
+        given.
+
+        A catalog's fingerprint combines its version number with its list
+        of items. A vDC's fingerprint is taken from its templates.
+
+        @param fingerprints: Fingerprints from a previous call, keyed by
+                             vDC or catalog href.
+        @type fingerprints: C{dict}
+
+        @return: A dictionary keyed by vDC or catalog href. Each value is
+                 a tuple of the fingerprint and a list of L{NodeImage}. The
+                 list is None where the fingerprint is unchanged.
+        @rtype: C{dict}
+        """
+        fingerprints = fingerprints or {}
+        template = 'application/vnd.vmware.vcloud.vAppTemplate+xml'
+
+        rv = {}
+        for vdc in self.vdcs:
+            res = self.connection.request(get_url_path(vdc.id)).object
+            res_ents = [
+                i for i in res.findall(fixxpath(
+                    res, "ResourceEntities/ResourceEntity"))
+                if i.get('type') == template
+            ]
+            fp = fingerprint(None, [i.get('href') for i in res_ents])
+            rv[vdc.id] = (fp, [self._to_image(i) for i in res_ents])
+
+        for catalog in self._get_catalog_hrefs():
+            res = self.connection.request(
+                get_url_path(catalog),
+                headers={
+                    'Content-Type': 'application/vnd.vmware.vcloud.catalog+xml'
+                }
+            ).object
+            cat_items = [
+                i.get('href')
+                for i in res.findall(fixxpath(res, "CatalogItems/CatalogItem"))
+                if i.get('type') ==
+                    'application/vnd.vmware.vcloud.catalogItem+xml'
+            ]
+            fp = fingerprint(
+                res.findtext(fixxpath(res, 'VersionNumber')), cat_items)
+            if fingerprints.get(catalog) == fp:
+                rv[catalog] = (fp, None)
+                continue
+
+            images = []
+            for cat_item in cat_items:
+                item = self.connection.request(
+                    get_url_path(cat_item),
+                    headers={
+                        'Content-Type':
+                            'application/vnd.vmware.vcloud.catalogItem+xml'
+                    }
+                ).object
+                images += [
+                    self._to_image(i)
+                    for i in item.findall(fixxpath(item, 'Entity'))
+                    if i.get('type') == template
+                ]
+            rv[catalog] = (fp, images)
+
+        return rv
+
     def _uniquer(self, seq, idfun=None):
         if idfun is None:
             def idfun(x):
@@ -1400,6 +1581,7 @@ class VCloud_1_5_NodeDriver(VCloudNodeDriver):
         if ex_deploy:
             # Retry 3 times: when instantiating large number of VMs at the same time some may fail on resource allocation
             retry = 3
+            delay = 2
             while True:
                 try:
                     res = self.connection.request(
@@ -1411,7 +1593,8 @@ class VCloud_1_5_NodeDriver(VCloudNodeDriver):
                     if retry <= 0:
                         raise
                     retry -= 1
-                    time.sleep(10)
+                    time.sleep(delay)
+                    delay *= 2
 
         res = self.connection.request(get_url_path(vapp_href))
         node = self._to_node(res.object)
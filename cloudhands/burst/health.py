@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import logging
+import time
+
+__doc__ = """
+Each provider has a :py:class:`Breaker` which stops calls to it while it
+is failing. :py:class:`Health` holds the breakers of a process.
+"""
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of making a call to a provider whose circuit is open.
+    """
+
+
+class Breaker:
+    """
+    A circuit breaker for the calls to one provider.
+
+    After `threshold` consecutive failures the circuit opens, and calls are
+    refused for `backoff` seconds. Then one call is allowed through as a
+    probe. If it succeeds the circuit closes. If not, it opens again for
+    twice as long, up to `ceiling` seconds.
+
+    A Breaker is also a context manager for synchronous calls. Failures
+    are those exceptions for which :py:meth:`unavailable` is True.
+    """
+
+    threshold = 3
+    backoff = 5
+    ceiling = 300
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened = None
+        self.delay = self.backoff
+        self.probing = False
+
+    def state(self, now=None):
+        """
+        :returns: One of `closed`, `open` or `half_open`.
+        """
+        now = time.monotonic() if now is None else now
+        if self.opened is None:
+            return "closed"
+        elif now - self.opened < self.delay:
+            return "open"
+        else:
+            return "half_open"
+
+    def remaining(self, now=None):
+        """
+        :returns: The seconds before the circuit may be probed.
+        """
+        now = time.monotonic() if now is None else now
+        if self.opened is None:
+            return 0
+        return max(0, self.opened + self.delay - now)
+
+    def ready(self, now=None):
+        """
+        :returns: True if a call would be allowed. Unlike
+            :py:meth:`allow`, this does not claim the probe.
+        """
+        state = self.state(now)
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def allow(self, now=None):
+        """
+        :returns: True if a call may be made now. When the circuit is half
+            open, only the first caller is allowed.
+        """
+        if not self.ready(now):
+            return False
+        if self.state(now) == "half_open":
+            self.probing = True
+        return True
+
+    def success(self):
+        log = logging.getLogger("cloudhands.burst.health.breaker")
+        if self.opened is not None:
+            log.info("{} is available again".format(self.name))
+        self.failures = 0
+        self.opened = None
+        self.delay = self.backoff
+        self.probing = False
+
+    def release(self):
+        """
+        Give up the probe without a result, as when the call is cancelled.
+        """
+        self.probing = False
+
+    def failure(self, now=None):
+        log = logging.getLogger("cloudhands.burst.health.breaker")
+        now = time.monotonic() if now is None else now
+        self.failures += 1
+        if self.probing:
+            self.probing = False
+            self.delay = min(self.delay * 2, self.ceiling)
+            self.opened = now
+            log.warning("{} still unavailable; next probe in {}s".format(
+                self.name, self.delay))
+        elif self.opened is None and self.failures >= self.threshold:
+            self.opened = now
+            log.warning("{} unavailable after {} failures".format(
+                self.name, self.failures))
+
+    @staticmethod
+    def unavailable(exc):
+        """
+        :returns: True if an exception shows the provider can't be reached.
+        """
+        return isinstance(exc, (OSError, TimeoutError))
+
+    def __enter__(self):
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value is not None and self.unavailable(exc_value):
+            self.failure()
+        else:
+            # The provider answered, perhaps with an error
+            self.success()
+        return False
+
+
+class Health:
+    """
+    Keeps a :py:class:`Breaker` for each provider.
+    """
+
+    _shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "breakers"):
+            self.breakers = {}
+
+    def __call__(self, providerName):
+        try:
+            return self.breakers[providerName]
+        except KeyError:
+            rv = self.breakers[providerName] = Breaker(providerName)
+            return rv
+
+    def report(self):
+        """
+        :returns: The state of each provider's circuit, keyed by name.
+        """
+        return {k: v.state() for k, v in self.breakers.items()}
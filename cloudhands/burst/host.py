@@ -6,9 +6,12 @@ import concurrent.futures
 import datetime
 import logging
 
+from cloudhands.burst.agent import select
 from cloudhands.burst.control import create_node
 from cloudhands.burst.control import destroy_node
-from cloudhands.common.discovery import providers
+from cloudhands.burst.health import Health
+from cloudhands.burst.strategy import Strategy
+from cloudhands.burst.workers import WorkerPool
 from cloudhands.common.schema import Host
 from cloudhands.common.schema import Node
 from cloudhands.common.schema import OSImage
@@ -17,32 +20,17 @@ from cloudhands.common.schema import Touch
 from cloudhands.common.states import HostState
 
 
-def hosts(session, state=None):
-    query = session.query(Host)
-    if not state:
-        return query.all()
-
-    return [h for h in query.all() if h.changes[-1].state.name == state]
-
-
-class Strategy:
-
-    @staticmethod
-    def recommend(host):  # TODO sort providers
-        providerName = host.organisation.subscriptions[0].provider.name
-        for config in [
-            cfg for p in providers.values() for cfg in p
-            if cfg["metadata"]["path"] == providerName
-        ]:
-            return config
-        else:
-            return None
+def hosts(session, state=None, offset=0, limit=None):
+    return select(session, Host, state, offset, limit)
 
 
 class HostAgent:
 
     _shared_state = {}
 
+    #: The most hosts to action in each run.
+    batch = 64
+
     def __init__(self, args, config, session, loop=None):
         self.__dict__ = self._shared_state
         if not hasattr(self, "loop"):
@@ -51,60 +39,88 @@ class HostAgent:
             self.config = config
             self.session = session
             self.loop = loop
+            self.states = {}
+            self.offsets = {}
+
+    def page(self, state):
+        """
+        Return the next batch of hosts in a state. Successive calls move
+        on through them, so hosts which stay in the state do not keep
+        the others waiting.
+        """
+        offset = self.offsets.get(state, 0)
+        rv = hosts(self.session, state=state, offset=offset, limit=self.batch)
+        if not rv and offset:
+            offset = 0
+            rv = hosts(self.session, state=state, limit=self.batch)
+        self.offsets[state] = offset + len(rv) if len(rv) == self.batch else 0
+        return rv
+
+    def state(self, name):
+        try:
+            return self.states[name]
+        except KeyError:
+            rv = self.states[name] = self.session.query(HostState).filter(
+                HostState.name == name).one()
+            return rv
 
     def touch_requested(self, priority=1):
         log = logging.getLogger("cloudhands.burst.host.touch_requested")
-        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as exctr:
-            jobs = {}
-            for h in hosts(self.session, state="requested"):
-                name = h.name
-                config = Strategy.recommend(h)
-                imgs = [r for r in h.changes[0].resources if isinstance(r, OSImage)]
-                network = config.get("vdc", "network", fallback=None)
-                job = exctr.submit(
-                    create_node,
-                    config=config,
-                    name=h.name,
-                    image=imgs[0].name if imgs else None,
-                    network=network)
-                jobs[job] = h
-
+        exctr = WorkerPool(self.config).executor
+        jobs = {}
+        for h in self.page("requested"):
+            name = h.name
+            config = Strategy.recommend(h)
+            if not Health()(config["metadata"]["path"]).allow():
+                log.debug("{} waits for {}".format(
+                    name, config["metadata"]["path"]))
+                continue
+            imgs = [r for r in h.changes[0].resources if isinstance(r, OSImage)]
+            network = config.get("vdc", "network", fallback=None)
+            job = exctr.submit(
+                create_node,
+                config=config,
+                name=h.name,
+                image=imgs[0].name if imgs else None,
+                network=network)
+            jobs[job] = h
+
+        now = datetime.datetime.utcnow()
+        scheduling = self.state("scheduling")
+        for host in jobs.values():
+            user = host.changes[-1].actor
+            host.changes.append(
+                Touch(artifact=host, actor=user, state=scheduling, at=now))
+            self.session.commit()
+            log.info("{} is scheduling".format(host.name))
+
+        requested = self.state("requested")
+        unknown = self.state("unknown")
+        for job in concurrent.futures.as_completed(jobs):
+            host = jobs[job]
+            user = host.changes[-1].actor
+            config, node = job.result()
+            breaker = Health()(config["metadata"]["path"])
             now = datetime.datetime.utcnow()
-            scheduling = self.session.query(HostState).filter(
-                HostState.name == "scheduling").one()
-            for host in jobs.values():
-                user = host.changes[-1].actor
-                host.changes.append(
-                    Touch(artifact=host, actor=user, state=scheduling, at=now))
-                self.session.commit()
-                log.info("{} is scheduling".format(host.name))
-
-            requested = self.session.query(HostState).filter(
-                HostState.name == "requested").one()
-            unknown = self.session.query(HostState).filter(
-                HostState.name == "unknown").one()
-            for job in concurrent.futures.as_completed(jobs):
-                host = jobs[job]
-                user = host.changes[-1].actor
-                config, node = job.result()
-                now = datetime.datetime.utcnow()
-                if not node:
-                    act = Touch(
-                        artifact=host, actor=user, state=requested, at=now)
-                    log.info("{} re-requested.".format(host.name))
-                else:
-                    provider = self.session.query(Provider).filter(
-                        Provider.name==config["metadata"]["path"]).one()
-                    act = Touch(
-                        artifact=host, actor=user, state=unknown, at=now)
-                    resource = Node(
-                        name=host.name, touch=act, provider=provider,
-                        uri=node.id)
-                    self.session.add(resource)
-                    log.info("{} created: {}".format(host.name, node.id))
-                host.changes.append(act)
-                self.session.commit()
-                self.q.append(act)
+            if not node:
+                breaker.failure()
+                act = Touch(
+                    artifact=host, actor=user, state=requested, at=now)
+                log.info("{} re-requested.".format(host.name))
+            else:
+                breaker.success()
+                provider = self.session.query(Provider).filter(
+                    Provider.name==config["metadata"]["path"]).one()
+                act = Touch(
+                    artifact=host, actor=user, state=unknown, at=now)
+                resource = Node(
+                    name=host.name, touch=act, provider=provider,
+                    uri=node.id)
+                self.session.add(resource)
+                log.info("{} created: {}".format(host.name, node.id))
+            host.changes.append(act)
+            self.session.commit()
+            self.q.append(act)
 
         if self.loop is not None:
             log.debug("Rescheduling {}s later".format(self.args.interval))
@@ -112,42 +128,46 @@ class HostAgent:
 
     def touch_deleting(self, priority=1):
         log = logging.getLogger("cloudhands.burst.host.touch_deleting")
-        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as exctr:
-            jobs = {
-                exctr.submit(
-                    destroy_node,
-                    config=Strategy.recommend(h), # FIXME
-                    uri=r.uri): r for h in hosts(self.session, state="deleting")
-                    for t in h.changes for r in t.resources
-                    if isinstance(r, Node)}
-
-            for node in jobs.values():
-                log.info("{} is going down".format(node.name))
-
-            deleting = self.session.query(HostState).filter(
-                HostState.name == "deleting").one()
-            down = self.session.query(HostState).filter(
-                HostState.name == "down").one()
-            unknown = self.session.query(HostState).filter(
-                HostState.name == "unknown").one()
-
-            for job in concurrent.futures.as_completed(jobs):
-                node = jobs[job]
-                host = node.touch.artifact
-                user = node.touch.actor
-                config, uri = job.result()
-                now = datetime.datetime.utcnow()
-                if uri:
-                    act = Touch(
-                        artifact=host, actor=user, state=down, at=now)
-                    log.info("{} down".format(host.name))
-                else:
-                    act = Touch(
-                        artifact=host, actor=user, state=deleting, at=now)
-                    log.info("{} still deleting ({}).".format(host.name, node.id))
-                host.changes.append(act)
-                self.session.commit()
-                self.q.append(act)
+        exctr = WorkerPool(self.config).executor
+        # Each node is destroyed by the provider which holds it
+        nodes = [
+            r for h in self.page("deleting")
+            for t in h.changes for r in t.resources if isinstance(r, Node)]
+        jobs = {}
+        for r in nodes:
+            config = Strategy.config(r.provider.name)
+            if config is None or not Health()(r.provider.name).allow():
+                continue
+            job = exctr.submit(destroy_node, config=config, uri=r.uri)
+            jobs[job] = r
+
+        for node in jobs.values():
+            log.info("{} is going down".format(node.name))
+
+        deleting = self.state("deleting")
+        down = self.state("down")
+        unknown = self.state("unknown")
+
+        for job in concurrent.futures.as_completed(jobs):
+            node = jobs[job]
+            host = node.touch.artifact
+            user = node.touch.actor
+            config, uri = job.result()
+            breaker = Health()(node.provider.name)
+            now = datetime.datetime.utcnow()
+            if uri:
+                breaker.success()
+                act = Touch(
+                    artifact=host, actor=user, state=down, at=now)
+                log.info("{} down".format(host.name))
+            else:
+                breaker.failure()
+                act = Touch(
+                    artifact=host, actor=user, state=deleting, at=now)
+                log.info("{} still deleting ({}).".format(host.name, node.id))
+            host.changes.append(act)
+            self.session.commit()
+            self.q.append(act)
 
         if self.loop is not None:
             log.debug("Rescheduling {}s later".format(self.args.interval))
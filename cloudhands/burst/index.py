@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import json
+import logging
+
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import Text
+from sqlalchemy import UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base
+
+__doc__ = """
+An index of the templates in each provider's catalogues. It is filled in
+when subscriptions are checked, and lets appliances be provisioned without
+first searching the catalogues.
+
+Entries are dropped when their provider is indexed again without them,
+unless their catalogue was left unchanged, or when a template is found to
+have gone from its provider.
+
+The declarative base is shared with
+:py:mod:`cloudhands.burst.activation`, so :py:func:`create` makes its
+table too.
+"""
+
+Base = declarative_base()
+
+
+class TemplateEntry(Base):
+    """
+    A template as last seen in a provider's catalogue.
+
+    `vms` is a JSON list of objects, each with the `href` of a VM in the
+    template and the `networks` it connects to. `networks` is the JSON list
+    of all those network names.
+    """
+
+    __tablename__ = "burst_templates"
+    __table_args__ = (UniqueConstraint("provider", "catalogue", "name"),)
+
+    id = Column("id", Integer, primary_key=True)
+    provider = Column("provider", String(255), nullable=False)
+    catalogue = Column("catalogue", String(255), nullable=False)
+    name = Column("name", String(255), nullable=False)
+    href = Column("href", String(255), nullable=False)
+    vms = Column("vms", Text, nullable=False, default="[]")
+    networks = Column("networks", Text, nullable=False, default="[]")
+    seen = Column("seen", DateTime, nullable=False)
+
+
+def create(session):
+    """
+    Create the index tables if they do not exist.
+    """
+    Base.metadata.create_all(session.bind)
+
+
+def upsert(session, provider, entries, seen, unchanged=()):
+    """
+    Add or update the index entries of a provider. They replace those
+    already indexed for it, so the entries of a catalogue which has been
+    emptied or removed are dropped.
+
+    :param entries: A sequence of dictionaries with the keys `catalogue`,
+        `name`, `href` and `vms`.
+    :param datetime.datetime seen: The time of discovery.
+    :param unchanged: The names of catalogues which were not scanned
+        because they have not changed. Their entries are kept.
+    :returns: The number of entries written.
+    """
+    log = logging.getLogger("cloudhands.burst.index.upsert")
+    known = {
+        (i.catalogue, i.name): i for i in session.query(TemplateEntry).filter(
+            TemplateEntry.provider == provider).all()}
+    for entry in entries:
+        networks = sorted({n for vm in entry["vms"] for n in vm["networks"]})
+        try:
+            row = known[(entry["catalogue"], entry["name"])]
+        except KeyError:
+            row = known[(entry["catalogue"], entry["name"])] = TemplateEntry(
+                provider=provider, catalogue=entry["catalogue"],
+                name=entry["name"])
+            session.add(row)
+        row.href = entry["href"]
+        row.vms = json.dumps(entry["vms"])
+        row.networks = json.dumps(networks)
+        row.seen = seen
+
+    current = {(i["catalogue"], i["name"]) for i in entries}
+    for key, row in known.items():
+        if key[0] not in unchanged and key not in current:
+            session.delete(row)
+    session.commit()
+    log.debug("{} templates indexed for {}".format(len(entries), provider))
+    return len(entries)
+
+
+def lookup(session, provider, name, catalogues=None):
+    """
+    Find a template in the index.
+
+    :param catalogues: If given, the names of the catalogues to search.
+    :returns: A dictionary with the keys `catalogue`, `name`, `href`,
+        `vms` and `networks`, or None if there is no entry.
+    """
+    query = session.query(TemplateEntry).filter(
+        TemplateEntry.provider == provider).filter(
+        TemplateEntry.name == name)
+    if catalogues:
+        query = query.filter(TemplateEntry.catalogue.in_(list(catalogues)))
+    row = query.order_by(TemplateEntry.seen.desc()).first()
+    if row is None:
+        return None
+    return {
+        "catalogue": row.catalogue,
+        "name": row.name,
+        "href": row.href,
+        "vms": json.loads(row.vms),
+        "networks": json.loads(row.networks),
+    }
+
+
+def discard(session, provider, href):
+    """
+    Remove the entries for a template which has gone from a provider.
+
+    :returns: The number of entries removed.
+    """
+    log = logging.getLogger("cloudhands.burst.index.discard")
+    rv = session.query(TemplateEntry).filter(
+        TemplateEntry.provider == provider).filter(
+        TemplateEntry.href == href).delete(synchronize_session=False)
+    session.commit()
+    log.info("Discarded {} from index of {}".format(href, provider))
+    return rv
+
@@ -20,9 +20,14 @@ from cloudhands.burst.appliance import PreProvisionAgent
 from cloudhands.burst.appliance import PreStartAgent
 from cloudhands.burst.appliance import PreStopAgent
 from cloudhands.burst.appliance import ProvisioningAgent
+from cloudhands.burst.capacity import CapacityAgent
 from cloudhands.burst.membership import AcceptedAgent
+from cloudhands.burst.payload import Payloads
 from cloudhands.burst.session import SessionAgent
 from cloudhands.burst.subscription import SubscriptionAgent
+from cloudhands.burst.strategy import Strategy
+from cloudhands.burst.subscription import UncheckedAgent
+from cloudhands.burst.workers import WorkerPool
 from cloudhands.common.connectors import initialise
 from cloudhands.common.connectors import Registry
 from cloudhands.common.discovery import settings
@@ -59,6 +64,10 @@ def main(args):
     log.addHandler(ch)
 
     portalName, config = next(iter(settings.items()))
+    log.info("Provider strategy is {}".format(Strategy.configure(config)))
+    payloads = Payloads(cache=args.cache).compile()
+    log.info("Compiled payloads {}".format(", ".join(payloads.names)))
+
     loop = asyncio.get_event_loop()
     msgQ = asyncio.Queue(loop=loop)
 
@@ -73,6 +82,7 @@ def main(args):
     workers = []
     for agentType in (
         AcceptedAgent,
+        CapacityAgent,
         PreCheckAgent,
         PreDeleteAgent,
         PreOperationalAgent,
@@ -81,7 +91,7 @@ def main(args):
         PreStopAgent,
         ProvisioningAgent,
         SessionAgent,
-        # TODO: SubscriptionAgent
+        UncheckedAgent,
     ):
         workQ = agentType.queue(args, config, loop=loop)
         agent = agentType(workQ, args, config)
@@ -106,6 +116,7 @@ def main(args):
             except Exception as e:
                 log.error(e)
 
+        WorkerPool().shutdown()
         loop.close()
 
     return 0
@@ -130,6 +141,9 @@ def parser(descr=__doc__):
     rv.add_argument(
         "--log", default=None, dest="log_path",
         help="Set a file path for log output")
+    rv.add_argument(
+        "--cache", default=None,
+        help="Set a directory for compiled payload templates")
     return rv
 
 
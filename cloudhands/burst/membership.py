@@ -3,19 +3,24 @@
 
 import asyncio
 from collections import namedtuple
+from collections import OrderedDict
 import datetime
 import functools
 import logging
 import os
-import textwrap
-import traceback
+import time
 import xml.etree.ElementTree as ET
-import sys
 
-import aiohttp
+from sqlalchemy.orm import aliased
 
+from cloudhands.burst.activation import activated
+from cloudhands.burst.activation import record_activations
 from cloudhands.burst.agent import Agent
+from cloudhands.burst.agent import collect
 from cloudhands.burst.agent import Job
+from cloudhands.burst.agent import latest
+from cloudhands.burst.client import Clients
+from cloudhands.burst.payload import Payloads
 from cloudhands.burst.utils import find_xpath
 
 from cloudhands.common.discovery import providers
@@ -24,7 +29,6 @@ from cloudhands.common.schema import Membership
 from cloudhands.common.schema import Registration
 from cloudhands.common.schema import State
 from cloudhands.common.schema import Touch
-from cloudhands.common.schema import User
 from cloudhands.common.states import MembershipState
 
 
@@ -44,7 +48,191 @@ def find_user_role(tree, **kwargs):
         tree, namespaces={"": "http://www.vmware.com/vcloud/v1.5"}, **kwargs)
     return (i for i in elems if i.tag.endswith("RoleReference"))
 
+class AdminRefs:
+    """
+    Remembers for each provider the href of the `vApp User` role and the
+    link by which users are added to its organisation. An entry lasts for
+    `ttl` seconds, or until it is invalidated after an error.
+    """
+
+    _shared_state = {}
+
+    ttl = 600
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "refs"):
+            self.refs = {}
+
+    def get(self, providerName):
+        """
+        :returns: A tuple of the role href and the add user href, or None
+            if they are not known or have expired.
+        """
+        try:
+            roleHref, addHref, at = self.refs[providerName]
+        except KeyError:
+            return None
+        if time.monotonic() - at > self.ttl:
+            del self.refs[providerName]
+            return None
+        return (roleHref, addHref)
+
+    def put(self, providerName, roleHref, addHref):
+        self.refs[providerName] = (roleHref, addHref, time.monotonic())
+        return (roleHref, addHref)
+
+    def invalidate(self, providerName):
+        self.refs.pop(providerName, None)
+
+
+@asyncio.coroutine
+def admin_refs(client, config, headers):
+    """
+    Find the href of the `vApp User` role and the link by which users are
+    added to the provider's organisation. They are taken from
+    :py:class:`AdminRefs` when they are known.
+
+    :returns: A tuple of the two hrefs, or None if they can't be found.
+    """
+    log = logging.getLogger("cloudhands.burst.membership.admin_refs")
+    refs = AdminRefs()
+    name = config["metadata"]["path"]
+    cached = refs.get(name)
+    if cached is not None:
+        return cached
+
+    url = "{scheme}://{host}:{port}/{endpoint}".format(
+        scheme="https",
+        host=config["host"]["name"],
+        port=config["host"]["port"],
+        endpoint="api/admin")
+    response = yield from client.request(
+        "GET", url,
+        headers=headers)
+
+    orgList = yield from response.read_and_close()
+    tree = ET.fromstring(orgList.decode("utf-8"))
+
+    try:
+        role = next(find_user_role(tree, name="vApp User"))
+    except StopIteration:
+        log.error("Failed to find user role reference")
+        return None
+
+    orgFound = find_admin_org(tree, name=config["vdc"]["org"])
+    try:
+        org = next(orgFound)
+    except StopIteration:
+        log.error("Failed to find org")
+        return None
+
+    response = yield from client.request(
+        "GET", org.attrib.get("href"),
+        headers=headers)
+    orgData = yield from response.read_and_close()
+    tree = ET.fromstring(orgData.decode("utf-8"))
+
+    try:
+        addUser = next(find_add_user_link(tree))
+    except StopIteration:
+        log.error("Failed to find user endpoint")
+        return None
+
+    return refs.put(
+        name, role.attrib.get("href"), addUser.attrib.get("href"))
+
+
+@asyncio.coroutine
+def activate(client, config, usernames, payloads, concurrency=8):
+    """
+    Add users to the organisation of a provider. One session is opened
+    for them all, and up to `concurrency` users are added at once.
+
+    :returns: A list with an item for each user. It is True if the
+        provider created the user or already had it, False if it did not,
+        or the exception raised while trying.
+    """
+    log = logging.getLogger("cloudhands.burst.membership.activate")
+    url = "{scheme}://{host}:{port}/{endpoint}".format(
+        scheme="https",
+        host=config["host"]["name"],
+        port=config["host"]["port"],
+        endpoint="api/sessions")
+
+    headers = {
+        "Accept": "application/*+xml;version=5.5",
+    }
+
+    response = yield from client.request(
+        "POST", url,
+        auth=(config["user"]["name"], config["user"]["pass"]),
+        headers=headers)
+    headers["x-vcloud-authorization"] = response.headers.get(
+        "x-vcloud-authorization")
+    # Only the header is needed, but the connection must be released
+    yield from response.read_and_close()
+
+    refs = yield from admin_refs(client, config, headers)
+    if refs is None:
+        return [False] * len(usernames)
+    roleHref, addHref = refs
+
+    headers["Content-Type"] = (
+        "application/vnd.vmware.admin.user+xml")
+    limit = asyncio.Semaphore(concurrency)
+
+    @asyncio.coroutine
+    def add(username):
+        user = payloads.render(
+            "User",
+            user={"name": username},
+            role={"href": roleHref})
+
+        with (yield from limit):
+            response = yield from client.request(
+                "POST", addHref,
+                headers=headers,
+                data=user)
+            reply = yield from response.read_and_close()
+
+        tree = ET.fromstring(reply.decode("utf-8"))
+        if tree.tag.endswith("User"):
+            return True
+        elif (tree.attrib.get("minorErrorCode") == "DUPLICATE_NAME" or
+              "already exists" in tree.attrib.get("message", "")):
+            log.info("User {} already exists".format(username))
+            return True
+        else:
+            log.warning("Error while adding user {}".format(username))
+            return False
+
+    rv = yield from asyncio.gather(
+        *[add(i) for i in usernames], return_exceptions=True)
+    if not any(i is True for i in rv):
+        AdminRefs().invalidate(config["metadata"]["path"])
+    return rv
+
+
 class AcceptedAgent(Agent):
+    """
+    Activates accepted memberships by adding the user to the organisation
+    of each provider the organisation subscribes to. Providers are
+    contacted concurrently.
+
+    Jobs which arrive within `window` seconds of each other are dealt with
+    together. Each provider is sent all the users of the batch over one
+    session, with at most `concurrency` requests at a time.
+
+    A membership is active once every provider has added the user. If only
+    some have, the membership is left accepted and a
+    `MembershipPartiallyActivated` message records in the database which
+    providers succeeded. Those are not contacted again when it is retried,
+    even after a restart.
+    """
+
+    window = 2
+    concurrency = 8
 
     MembershipActivated = namedtuple(
         "MembershipActivated", ["uuid", "ts", "provider"])
@@ -52,6 +240,9 @@ class AcceptedAgent(Agent):
     MembershipNotActivated = namedtuple(
         "MembershipNotActivated", ["uuid", "ts", "provider"])
 
+    MembershipPartiallyActivated = namedtuple(
+        "MembershipPartiallyActivated", ["uuid", "ts", "provider", "failed"])
+
     @staticmethod
     def queue(args, config, loop=None):
         return asyncio.Queue(loop=loop)
@@ -61,16 +252,27 @@ class AcceptedAgent(Agent):
         return [
             (AcceptedAgent.MembershipActivated, self.touch_to_active),
             (AcceptedAgent.MembershipNotActivated, self.touch_to_previous),
+            (AcceptedAgent.MembershipPartiallyActivated,
+                self.touch_to_partial),
         ]
 
     def jobs(self, session):
+        """
+        Select in one query the accepted memberships whose user has
+        registered a public key.
+        """
+        regTouch = aliased(Touch)
+        regState = aliased(State)
+        registered = session.query(regTouch.actor_id).join(
+            Registration, regTouch.artifact_id == Registration.id).join(
+            regState, regTouch.state_id == regState.id).filter(
+            regState.name == "pre_user_ldappublickey")
+        eligible = latest(session, Membership, "accepted").filter(
+            Touch.actor_id.in_(registered)).with_entities(Membership.id)
         return [
             Job(mship.uuid, None, mship)
-            for mship in session.query(Membership).all()
-            if mship.changes[-1].state.name == "accepted" and
-            session.query(Registration).join(Touch).join(State).join(User).filter(
-                User.uuid == mship.changes[-1].actor.uuid).filter(
-                State.name == "pre_user_ldappublickey").first()
+            for mship in session.query(Membership).filter(
+                Membership.id.in_(eligible)).order_by(Membership.id)
         ]
 
     def touch_to_active(self, msg:MembershipActivated , session):
@@ -98,17 +300,25 @@ class AcceptedAgent(Agent):
         session.commit()
         return act
 
+    def touch_to_partial(self, msg:MembershipPartiallyActivated, session):
+        record_activations(session, msg.uuid, msg.provider, msg.ts)
+        return self.touch_to_previous(msg, session)
 
     @asyncio.coroutine
     def __call__(self, loop, msgQ, *args):
         log = logging.getLogger("cloudhands.burst.membership")
+        session = args[0] if args else None
         configs = {cfg["metadata"]["path"]: cfg
                   for p in providers.values() for cfg in p}
+        payloads = Payloads()
         log.info("Activated.")
         while True:
-            job = yield from self.work.get()
+            jobs = yield from collect(self.work, self.window, loop=loop)
 
-            try:
+            members = OrderedDict()
+            batches = OrderedDict()
+            done = {}
+            for job in jobs:
                 try:
                     prvdrs = [sub.provider.name
                               for sub in job.artifact.organisation.subscriptions]
@@ -119,111 +329,50 @@ class AcceptedAgent(Agent):
                 else:
                     log.debug(username)
 
+                members[job.uuid] = (username, prvdrs)
+                done[job.uuid] = (
+                    activated(session, job.uuid) if session is not None
+                    else set())
                 for provider in prvdrs:
-                    config = configs[provider]
-
-                    url = "{scheme}://{host}:{port}/{endpoint}".format(
-                        scheme="https",
-                        host=config["host"]["name"],
-                        port=config["host"]["port"],
-                        endpoint="api/sessions")
-
-                    headers = {
-                        "Accept": "application/*+xml;version=5.5",
-                    }
-
-                    client = aiohttp.client.HttpClient(
-                        ["{host}:{port}".format(
-                            host=config["host"]["name"],
-                            port=config["host"]["port"])
-                        ],
-                        verify_ssl=config["host"].getboolean("verify_ssl_cert")
-                    )
-
-                    response = yield from client.request(
-                        "POST", url,
-                        auth=(config["user"]["name"], config["user"]["pass"]),
-                        headers=headers)
-                    headers["x-vcloud-authorization"] = response.headers.get(
-                        "x-vcloud-authorization")
-
-                    url = "{scheme}://{host}:{port}/{endpoint}".format(
-                        scheme="https",
-                        host=config["host"]["name"],
-                        port=config["host"]["port"],
-                        endpoint="api/admin")
-                    response = yield from client.request(
-                        "GET", url,
-                        headers=headers)
-
-                    orgList = yield from response.read_and_close()
-                    tree = ET.fromstring(orgList.decode("utf-8"))
-
-                    try:
-                        role = next(find_user_role(tree, name="vApp User"))
-                    except StopIteration:
-                        log.error("Failed to find user role reference")
-                        continue
-
-                    orgFound = find_admin_org(tree, name=config["vdc"]["org"])
-                    try:
-                        org = next(orgFound)
-                    except StopIteration:
-                        log.error("Failed to find org")
-                        continue
-
-                    response = yield from client.request(
-                        "GET", org.attrib.get("href"),
-                        headers=headers)
-                    orgData = yield from response.read_and_close()
-                    tree = ET.fromstring(orgData.decode("utf-8"))
-
-
-                    try:
-                        addUser = next(find_add_user_link(tree))
-                    except StopIteration:
-                        log.error("Failed to find user endpoint")
-                        continue
-
-                    user = textwrap.dedent("""
-                        <User
-                           xmlns="http://www.vmware.com/vcloud/v1.5"
-                           name="{}"
-                           type="application/vnd.vmware.admin.user+xml">
-                           <IsEnabled>true</IsEnabled>
-                           <IsExternal>true</IsExternal>
-                           <Role
-                            type="application/vnd.vmware.admin.role+xml"
-                            href="{}" />
-                        </User>""").format(username, role.attrib.get("href"))
-
-                    headers["Content-Type"] = (
-                        "application/vnd.vmware.admin.user+xml")
-
-                    response = yield from client.request(
-                        "POST", addUser.attrib.get("href"),
-                        headers=headers,
-                        data=user.encode("utf-8"))
-                    reply = yield from response.read_and_close()
-
-                    tree = ET.fromstring(reply.decode("utf-8"))
-                    if not tree.tag.endswith("User"):
-                        log.warning(
-                            "Error while adding user {}".format(username))
-                        msg = AcceptedAgent.MembershipNotActivated(
-                            job.uuid, datetime.datetime.utcnow(),
-                            provider,
-                        )
-                    else:
-                        msg = AcceptedAgent.MembershipActivated(
-                            job.uuid, datetime.datetime.utcnow(),
-                            provider,
-                        )
-
-                    yield from msgQ.put(msg)
-
-            except Exception as e:
-                exc_type, exc_value, exc_tb = sys.exc_info()
-                log.error(traceback.format_exception(
-                    exc_type, exc_value, exc_tb))
-                log.error(e)
+                    if provider not in configs:
+                        log.error("No configuration for {}".format(provider))
+                    elif provider not in done[job.uuid]:
+                        batches.setdefault(provider, []).append(job.uuid)
+
+            names = list(batches)
+            results = yield from asyncio.gather(*[
+                activate(
+                    Clients()(configs[name]), configs[name],
+                    [members[i][0] for i in batches[name]],
+                    payloads, self.concurrency)
+                for name in names], loop=loop, return_exceptions=True)
+
+            for name, result in zip(names, results):
+                if isinstance(result, Exception):
+                    log.error("Failed to activate at {}: {}".format(
+                        name, result))
+                    continue
+                for key, outcome in zip(batches[name], result):
+                    if isinstance(outcome, Exception):
+                        log.error("{} failed to add {}: {}".format(
+                            name, members[key][0], outcome))
+                    elif outcome:
+                        done[key].add(name)
+
+            now = datetime.datetime.utcnow()
+            for key, (username, prvdrs) in members.items():
+                failed = tuple(i for i in prvdrs if i not in done[key])
+                if not failed:
+                    msg = AcceptedAgent.MembershipActivated(
+                        key, now, tuple(prvdrs))
+                elif done[key]:
+                    log.warning("{} activated at {} but not {}".format(
+                        username, ", ".join(sorted(done[key])),
+                        ", ".join(failed)))
+                    msg = AcceptedAgent.MembershipPartiallyActivated(
+                        key, now, tuple(sorted(done[key])), failed)
+                else:
+                    msg = AcceptedAgent.MembershipNotActivated(
+                        key, now, failed)
+
+                yield from msgQ.put(msg)
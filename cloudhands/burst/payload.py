@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import logging
+import os.path
+
+from chameleon import PageTemplateFile
+from chameleon.loader import ModuleLoader
+import pkg_resources
+
+__doc__ = """
+The vCloud API accepts XML documents as the payload of its requests. Burst
+keeps these as Chameleon page templates in
+:py:mod:`cloudhands.burst.drivers`.
+
+A :py:class:`Payloads` registry compiles each template once only. Agents
+share the registry, so rendering a payload for a job costs nothing but the
+call to the compiled template.
+"""
+
+
+class Payloads:
+    """
+    The registry of page templates in a package.
+
+    :param str package: The package which contains the `.pt` files.
+    :param str cache: An optional directory in which to keep compiled
+        templates between restarts. Chameleon also honours the
+        `CHAMELEON_CACHE` environment variable.
+
+    The registry is shared between all instances created for the same
+    package. Only the first instance created sets the cache directory.
+    """
+
+    _shared_state = {}
+
+    def __init__(self, package="cloudhands.burst.drivers", cache=None):
+        self.__dict__ = self._shared_state.setdefault(package, {})
+        if not hasattr(self, "package"):
+            self.package = package
+            self.cache = cache
+            self.templates = {}
+            self.loader = ModuleLoader(cache) if cache else None
+
+    @property
+    def names(self):
+        """
+        The names of all templates in the package, without the file extension.
+        """
+        return sorted(
+            os.path.splitext(i)[0]
+            for i in pkg_resources.resource_listdir(self.package, "")
+            if i.endswith(".pt"))
+
+    def __getitem__(self, name):
+        name = os.path.splitext(name)[0]
+        try:
+            return self.templates[name]
+        except KeyError:
+            log = logging.getLogger("cloudhands.burst.payload")
+            tmplt = PageTemplateFile(pkg_resources.resource_filename(
+                self.package, name + ".pt"))
+            if self.loader is not None:
+                tmplt.loader = self.loader
+            tmplt.cook_check()
+            log.debug("Compiled {}".format(tmplt.filename))
+            self.templates[name] = tmplt
+            return tmplt
+
+    def compile(self):
+        """
+        Compile every template in the package now rather than on first use.
+        """
+        for name in self.names:
+            self[name]
+        return self
+
+    def render(self, name, **kwargs):
+        """
+        Render a payload from its template.
+
+        :param str name: The name of the template, eg: `NatRule`.
+        :returns: The UTF-8 encoded document.
+        :rtype: bytes
+        """
+        return self[name](**kwargs).encode("utf-8")
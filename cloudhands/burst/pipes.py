@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+from collections import deque
+import io
+import logging
+import os
+import pickle
+
+__doc__ = """
+The portal sends its requests to burst as pickled objects written to a
+named pipe. A :py:class:`PipeReader` reads them from within the event loop.
+"""
+
+
+class PipeReader:
+    """
+    Reads pickled objects from a named pipe without blocking the event loop.
+
+    The pipe is watched with :py:meth:`asyncio.BaseEventLoop.add_reader`.
+    Data is buffered until an object is complete, so a write which arrives
+    in parts is not lost. If the buffer exceeds `limit` bytes without
+    yielding an object, it is discarded.
+
+    The attributes `reads`, `bytes` and `objects` count the activity on
+    the pipe.
+    """
+
+    chunk = 65536
+    limit = 1 << 20
+
+    def __init__(self, path, loop=None):
+        self.path = path
+        self.loop = loop or asyncio.get_event_loop()
+        self.fd = None
+        self.buffer = bytearray()
+        self.items = deque()
+        self.waiter = None
+        self.reads = 0
+        self.bytes = 0
+        self.objects = 0
+
+    def open(self):
+        """
+        Open the pipe and start watching it. The pipe is opened for
+        writing too, so that it stays open when writers come and go.
+        """
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+            self.loop.add_reader(self.fd, self.readable)
+        return self
+
+    def close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def readable(self):
+        log = logging.getLogger("cloudhands.burst.pipes.readable")
+        try:
+            data = os.read(self.fd, self.chunk)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.reads += 1
+        self.bytes += len(data)
+        self.buffer.extend(data)
+        n = self.unframe()
+        if n:
+            log.debug("{} objects from {} ({} reads, {} bytes)".format(
+                n, self.path, self.reads, self.bytes))
+        if self.items and self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def unframe(self):
+        """
+        Unpickle the complete objects in the buffer.
+
+        :returns: The number of objects found.
+        """
+        log = logging.getLogger("cloudhands.burst.pipes.unframe")
+        stream = io.BytesIO(bytes(self.buffer))
+        pos = 0
+        n = 0
+        while pos < len(self.buffer):
+            try:
+                obj = pickle.load(stream)
+            except EOFError:
+                break
+            except Exception as e:
+                if (isinstance(e, pickle.UnpicklingError) and
+                    "truncated" in str(e)):
+                    break
+                # Corrupt data may raise almost anything
+                log.error("Discarding {} bytes: {}".format(
+                    len(self.buffer) - pos, e))
+                pos = len(self.buffer)
+                break
+            else:
+                self.items.append(obj)
+                pos = stream.tell()
+                n += 1
+
+        del self.buffer[:pos]
+        if len(self.buffer) > self.limit:
+            log.error("Discarding {} bytes of incomplete data".format(
+                len(self.buffer)))
+            self.buffer.clear()
+        self.objects += n
+        return n
+
+    @asyncio.coroutine
+    def get(self, limit=None):
+        """
+        Wait for objects from the pipe.
+
+        :returns: A list of all those which have arrived, up to `limit`.
+        """
+        self.open()
+        while not self.items:
+            self.waiter = asyncio.Future(loop=self.loop)
+            try:
+                yield from self.waiter
+            finally:
+                self.waiter = None
+        n = len(self.items) if limit is None else min(limit, len(self.items))
+        return [self.items.popleft() for i in range(n)]
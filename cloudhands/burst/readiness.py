@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import logging
+
+__doc__ = """
+An appliance in `provisioning` is not worth checking until its vApp is
+likely to be ready. How long that takes depends on the template and the
+provider. A :py:class:`PollSchedule` learns it from experience.
+"""
+
+
+def provisioning_started(changes):
+    """
+    Return the time at which an appliance first entered `provisioning`
+    after its most recent `pre_provision`, or None if it has not.
+
+    :param changes: The Touches of the appliance, in order.
+    """
+    rv = None
+    for act in changes:
+        if act.state.name == "pre_provision":
+            rv = None
+        elif act.state.name == "provisioning" and rv is None:
+            rv = act.at
+    return rv
+
+
+class PollSchedule:
+    """
+    Decides when each appliance is due for a readiness check.
+
+    The first check falls due once the appliance has been provisioning for
+    as long as the estimate for its template and provider. Each check which
+    finds it still building defers the next by an exponential backoff.
+
+    Estimates begin at `initial` seconds. They follow a moving average of
+    the observed provisioning times.
+    """
+
+    _shared_state = {}
+
+    initial = 20
+    floor = 5
+    ceiling = 300
+    factor = 2
+    weight = 0.3
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "estimates"):
+            self.estimates = {}
+            self.attempts = {}
+            self.tasks = {}
+
+    def estimate(self, key):
+        """
+        :param tuple key: Template name and provider name.
+        :returns: The expected provisioning time in seconds.
+        """
+        return self.estimates.get(key, self.initial)
+
+    def observe(self, key, seconds):
+        """
+        Record the time an appliance took to become ready.
+        """
+        log = logging.getLogger("cloudhands.burst.readiness.observe")
+        try:
+            prior = self.estimates[key]
+        except KeyError:
+            rv = seconds
+        else:
+            rv = prior + self.weight * (seconds - prior)
+        self.estimates[key] = max(self.floor, min(self.ceiling, rv))
+        log.debug("{} estimated at {:.1f}s".format(key, self.estimates[key]))
+        return self.estimates[key]
+
+    def interval(self, uuid, key):
+        """
+        :returns: The seconds to wait before the next check of an appliance.
+        """
+        n = self.attempts.get(uuid, 0)
+        if not n:
+            return max(self.floor, self.estimate(key))
+        else:
+            return min(self.ceiling, self.floor * self.factor ** n)
+
+    def due(self, uuid, key, since, now):
+        """
+        Return True if an appliance should be checked now.
+
+        :param datetime.datetime since: The time of the appliance's
+            latest Touch.
+        """
+        return (now - since).total_seconds() >= self.interval(uuid, key)
+
+    def defer(self, uuid):
+        """
+        Note that a check found the appliance still building.
+        """
+        self.attempts[uuid] = self.attempts.get(uuid, 0) + 1
+        return self.attempts[uuid]
+
+    def track(self, uuid, task):
+        """
+        Record the href of the vCloud Task which is building an appliance.
+        """
+        if task:
+            self.tasks[uuid] = task
+
+    def forget(self, uuid):
+        """
+        Discard all the schedule has for an appliance.
+        """
+        self.attempts.pop(uuid, None)
+        self.tasks.pop(uuid, None)
@@ -4,14 +4,15 @@
 import asyncio
 from collections import namedtuple
 import datetime
+import hashlib
 import logging
 import os
 
-import aiohttp
-
 from cloudhands.burst.agent import Agent
 from cloudhands.burst.agent import Job
 from cloudhands.burst.appliance import Strategy
+from cloudhands.burst.client import Clients
+from cloudhands.burst.pipes import PipeReader
 
 from cloudhands.common.schema import Component
 from cloudhands.common.schema import Provider
@@ -22,10 +23,28 @@ from cloudhands.common.pipes import PipeQueue
 
 
 class SessionAgent(Agent):
+    """
+    Creates provider sessions for users who log in to the portal. The
+    portal sends their credentials through a named pipe, which is read by
+    a :py:class:`cloudhands.burst.pipes.PipeReader`.
+
+    Logins run concurrently, with no more than `concurrency` in progress
+    for each provider. Credentials which a provider refuses are not tried
+    again for `refusal` seconds.
+    """
+
+    concurrency = 8
+    refusal = 30
 
     Message = namedtuple(
         "TokenReceived", ["uuid", "ts", "provider", "key", "value"])
 
+    def __init__(self, workQ, args, config):
+        super().__init__(workQ, args, config)
+        self.limits = {}
+        self.refused = {}
+        self.logins = set()
+
     @staticmethod
     def queue(args, config, loop=None, path=None):
         try:
@@ -56,57 +75,98 @@ class SessionAgent(Agent):
         session.commit()
         return act
 
+    def credentials(self, provider_name, user_name, user_pass):
+        """
+        :returns: A key for credentials which does not contain the password.
+        """
+        digest = hashlib.sha256(user_pass.encode("utf-8")).hexdigest()
+        return (provider_name, user_name, digest)
+
+    def is_refused(self, key, now):
+        try:
+            expiry = self.refused[key]
+        except KeyError:
+            return False
+        if now < expiry:
+            return True
+        del self.refused[key]
+        return False
+
     @asyncio.coroutine
-    def __call__(self, loop, msgQ, *args):
-        log = logging.getLogger("cloudhands.burst.session.token")
-        log.info("Activated.")
-        while True:
-            data = yield from self.work.get()
-            try:
-                reg_uuid, provider_name, user_name, user_pass = data
-            except ValueError as e:
-                log.error(e)
-                continue
-
-            try:
-                config = Strategy.config(provider_name)
-
-                url = "{scheme}://{host}:{port}/{endpoint}".format(
-                    scheme="https",
-                    host=config["host"]["name"],
-                    port=config["host"]["port"],
-                    endpoint="api/sessions")
-
-                headers = {
-                    "Accept": "application/*+xml;version=5.5",
-                }
-
-                client = aiohttp.client.HttpClient(
-                    ["{host}:{port}".format(
-                        host=config["host"]["name"],
-                        port=config["host"]["port"])
-                    ],
-                    verify_ssl=config["host"].getboolean("verify_ssl_cert")
-                )
+    def login(self, loop, msgQ, data):
+        """
+        Create a session for a user with a provider, and send its token
+        as a message.
+
+        :param data: A tuple of the registration uuid, the provider name,
+            the user name and the password.
+        """
+        log = logging.getLogger("cloudhands.burst.session.login")
+        try:
+            reg_uuid, provider_name, user_name, user_pass = data
+        except ValueError as e:
+            log.error(e)
+            return
 
-                user_ref = "{}@{}".format(user_name, config["vdc"]["org"])
-                auth=(user_ref, user_pass)
-                response = yield from client.request(
+        creds = self.credentials(provider_name, user_name, user_pass)
+        if self.is_refused(creds, loop.time()):
+            log.warning("Recently refused credentials for {}".format(reg_uuid))
+            return
+
+        try:
+            config = Strategy.config(provider_name)
+
+            url = "{scheme}://{host}:{port}/{endpoint}".format(
+                scheme="https",
+                host=config["host"]["name"],
+                port=config["host"]["port"],
+                endpoint="api/sessions")
+
+            headers = {
+                "Accept": "application/*+xml;version=5.5",
+            }
+
+            limit = self.limits.setdefault(
+                provider_name, asyncio.Semaphore(self.concurrency, loop=loop))
+            user_ref = "{}@{}".format(user_name, config["vdc"]["org"])
+            auth=(user_ref, user_pass)
+            with (yield from limit):
+                response = yield from Clients()(config).request(
                     "POST", url,
                     auth=auth,
                     headers=headers)
-                key = "x-vcloud-authorization"
-                value = response.headers.get(key)
-
-                if not value:
-                    log.warning("{} sent status {} on auth of {}".format(
-                        provider_name, response.status, reg_uuid))
-                else:
-                    msg = SessionAgent.Message(
-                        reg_uuid, datetime.datetime.utcnow(),
-                        provider_name, key, value
-                    )
-                    yield from msgQ.put(msg)
-
-            except Exception as e:
-                log.error(e)
+            key = "x-vcloud-authorization"
+            value = response.headers.get(key)
+            yield from response.read_and_close()
+
+            if not value:
+                log.warning("{} sent status {} on auth of {}".format(
+                    provider_name, response.status, reg_uuid))
+                if response.status in (401, 403):
+                    self.refused[creds] = loop.time() + self.refusal
+            else:
+                msg = SessionAgent.Message(
+                    reg_uuid, datetime.datetime.utcnow(),
+                    provider_name, key, value
+                )
+                yield from msgQ.put(msg)
+
+        except Exception as e:
+            log.error(e)
+
+    @asyncio.coroutine
+    def __call__(self, loop, msgQ, *args):
+        log = logging.getLogger("cloudhands.burst.session.token")
+        log.info("Activated.")
+        reader = PipeReader(self.work.path, loop=loop)
+        try:
+            while True:
+                batch = yield from reader.get()
+                log.debug("{} requests from pipe".format(len(batch)))
+                for data in batch:
+                    task = asyncio.Task(
+                        self.login(loop, msgQ, data), loop=loop)
+                    self.logins.add(task)
+                    task.add_done_callback(self.logins.discard)
+        finally:
+            reader.close()
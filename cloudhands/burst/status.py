@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+import functools
+import logging
+import time
+import xml.etree.ElementTree as ET
+
+from cloudhands.burst.utils import find_xpath
+
+__doc__ = """
+The vCloud query API returns a page of summary records in a single response.
+A :py:class:`StatusPoller` uses it to learn the state of many vApps at
+once, so agents need only GET the full document of a vApp when they want
+the details.
+"""
+
+
+def find_vapprecords(tree):
+    return (i for i in find_xpath("./*", tree)
+            if i.tag.endswith("VAppRecord"))
+
+find_nextpage = functools.partial(find_xpath, "./*", rel="nextPage")
+
+
+class StatusPoller:
+    """
+    Keeps the most recent vApp records of each provider, as visible to
+    each set of credentials.
+
+    Records are refreshed when they become older than `ttl` seconds.
+    Concurrent requests for the same records share a single refresh.
+    """
+
+    _shared_state = {}
+
+    ttl = 10
+    pageSize = 128
+    pageLimit = 16
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "records"):
+            self.records = {}
+            self.pending = {}
+
+    @asyncio.coroutine
+    def fetch(self, client, headers, config):
+        """
+        Page through the vApp records visible to the credentials in
+        `headers`.
+
+        :returns: A dictionary of record attributes keyed by vApp href.
+        """
+        log = logging.getLogger("cloudhands.burst.status.fetch")
+        rv = {}
+        url = (
+            "{scheme}://{host}:{port}/{endpoint}"
+            "?type=vApp&format=records&pageSize={pageSize}&page=1").format(
+            scheme="https",
+            host=config["host"]["name"],
+            port=config["host"]["port"],
+            endpoint="api/query",
+            pageSize=self.pageSize)
+        for page in range(self.pageLimit):
+            response = yield from client.request(
+                "GET", url, headers=headers)
+            data = yield from response.read_and_close()
+            tree = ET.fromstring(data.decode("utf-8"))
+            rv.update(
+                (i.attrib.get("href"), dict(i.attrib))
+                for i in find_vapprecords(tree))
+            try:
+                url = next(find_nextpage(tree)).attrib.get("href")
+            except StopIteration:
+                break
+        else:
+            log.warning("Stopped after {} pages of records".format(
+                self.pageLimit))
+
+        log.debug("{} vApp records from {}".format(
+            len(rv), config["metadata"]["path"]))
+        return rv
+
+    @asyncio.coroutine
+    def __call__(self, client, headers, config, token, href, loop=None):
+        """
+        Look up the record of a vApp.
+
+        :param tuple token: The credentials in `headers`, as supplied with
+            an agent's Job.
+        :param str href: The vApp href.
+        :returns: A dictionary of record attributes, or None if the vApp
+            has no record or the query failed.
+        """
+        log = logging.getLogger("cloudhands.burst.status.poller")
+        key = (config["metadata"]["path"], token)
+        now = time.time()
+        try:
+            then, records = self.records[key]
+        except KeyError:
+            then, records = 0, {}
+
+        if now - then > self.ttl:
+            try:
+                job = self.pending[key]
+            except KeyError:
+                job = self.pending[key] = asyncio.Task(
+                    self.fetch(client, headers, config), loop=loop)
+                try:
+                    records = yield from job
+                except Exception as e:
+                    log.warning(e)
+                    return None
+                else:
+                    self.records[key] = (now, records)
+                finally:
+                    del self.pending[key]
+            else:
+                try:
+                    records = yield from asyncio.shield(job, loop=loop)
+                except Exception:
+                    return None
+
+        return records.get(href)
+
+    @staticmethod
+    def busy(record):
+        """
+        Return True if a vApp record shows it is still being built.
+        """
+        return (
+            record.get("isBusy") == "true" or
+            record.get("status") == "UNRESOLVED")
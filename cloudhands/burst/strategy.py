@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+from collections import namedtuple
+from collections import OrderedDict
+import logging
+import time
+
+from cloudhands.common.discovery import providers
+
+__doc__ = """
+A :py:class:`Strategy` chooses the provider for a host or appliance from
+those its organisation subscribes to. The choice is made by one of several
+policies, which may use the VDC capacity held by :py:class:`Capacities`.
+"""
+
+Headroom = namedtuple("Headroom", ["cpu", "memory", "storage"])
+
+
+def headroom(vdcs):
+    """
+    Calculate the unused fraction of the CPU, memory and storage of a
+    provider.
+
+    :param vdcs: A sequence of
+        :py:class:`cloudhands.burst.drivers.vcloud.Vdc` objects.
+    :returns: A :py:class:`Headroom`. Its fields are None where the
+        capacity is not known or not limited.
+    """
+    def free(capacities):
+        capacities = [i for i in capacities if i is not None and i.limit]
+        if not capacities:
+            return None
+        limit = sum(i.limit for i in capacities)
+        used = sum(i.used for i in capacities)
+        return max(0.0, (limit - used) / limit)
+
+    vdcs = list(vdcs)
+    return Headroom(
+        free(i.cpu for i in vdcs),
+        free(i.memory for i in vdcs),
+        free(i.storage for i in vdcs))
+
+
+class Capacities:
+    """
+    Remembers the headroom of each provider for `ttl` seconds.
+    """
+
+    _shared_state = {}
+
+    ttl = 600
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "headrooms"):
+            self.headrooms = {}
+
+    def update(self, providerName, room, now=None):
+        now = time.monotonic() if now is None else now
+        self.headrooms[providerName] = (room, now)
+        return room
+
+    def get(self, providerName, now=None):
+        """
+        :returns: The :py:class:`Headroom` of a provider, or None if it
+            is not known or out of date.
+        """
+        now = time.monotonic() if now is None else now
+        try:
+            room, at = self.headrooms[providerName]
+        except KeyError:
+            return None
+        return room if now - at <= self.ttl else None
+
+    def free(self, providerName, now=None):
+        """
+        :returns: The smallest unused fraction of any resource of a
+            provider, or None if that is not known.
+        """
+        room = self.get(providerName, now)
+        values = [i for i in (room or ()) if i is not None]
+        return min(values) if values else None
+
+
+def first(names, host):
+    """
+    Keep the order of subscription.
+    """
+    return list(names)
+
+
+def least_loaded(names, host):
+    """
+    Prefer the providers with the most headroom. Those whose capacity is
+    not known are placed as if half used.
+    """
+    capacities = Capacities()
+
+    def key(name):
+        free = capacities.free(name)
+        return -(Strategy.unknown if free is None else free)
+
+    return sorted(names, key=key)
+
+
+def capacity_aware(names, host):
+    """
+    Avoid providers with less than `Strategy.reserve` headroom, unless all
+    of them are short. Otherwise prefer those with the most headroom.
+    """
+    capacities = Capacities()
+    names = least_loaded(names, host)
+    short = [
+        i for i in names
+        if capacities.free(i) is not None and
+        capacities.free(i) < Strategy.reserve]
+    return [i for i in names if i not in short] + short
+
+
+def affinity(names, host):
+    """
+    Prefer the providers where the host already has resources. Otherwise
+    prefer those with the most headroom.
+    """
+    used = {
+        getattr(getattr(r, "provider", None), "name", None)
+        for c in getattr(host, "changes", ()) for r in c.resources}
+    names = least_loaded(names, host)
+    return [i for i in names if i in used] + [
+        i for i in names if i not in used]
+
+
+class Strategy:
+    """
+    Chooses providers by the policy named in `policy`. The policy may be
+    set by the `policy` option in the `strategy` section of the
+    configuration.
+    """
+
+    policies = OrderedDict([
+        ("first", first),
+        ("least_loaded", least_loaded),
+        ("capacity_aware", capacity_aware),
+        ("affinity", affinity),
+    ])
+
+    policy = "capacity_aware"
+
+    #: The headroom assumed for a provider whose capacity is not known.
+    unknown = 0.5
+
+    #: The headroom below which a provider is avoided.
+    reserve = 0.1
+
+    _index = None
+
+    @classmethod
+    def configure(cls, config):
+        log = logging.getLogger("cloudhands.burst.strategy.configure")
+        try:
+            policy = config["strategy"]["policy"]
+        except (KeyError, TypeError):
+            return cls.policy
+        if policy in cls.policies:
+            cls.policy = policy
+        else:
+            log.warning("Unknown strategy policy {}".format(policy))
+        return cls.policy
+
+    @classmethod
+    def config(cls, providerName):
+        """
+        :returns: The configuration of a provider, or None.
+        """
+        if cls._index is None:
+            cls._index = {
+                cfg["metadata"]["path"]: cfg
+                for p in providers.values() for cfg in p}
+        return cls._index.get(providerName)
+
+    @classmethod
+    def rank(cls, host, policy=None):
+        """
+        :returns: The names of the providers to which the organisation of
+            `host` subscribes, in order of preference.
+        """
+        names = OrderedDict.fromkeys(
+            i.provider.name for i in host.organisation.subscriptions)
+        return cls.policies[policy or cls.policy](list(names), host)
+
+    @classmethod
+    def recommend(cls, host, policy=None):
+        """
+        :returns: The configuration of the preferred provider for `host`,
+            or None.
+        """
+        return next(
+            (cls.config(i) for i in cls.rank(host, policy)
+             if cls.config(i) is not None),
+            None)
@@ -1,12 +1,34 @@
 #!/usr/bin/env python3
 # encoding: UTF-8
 
+import asyncio
 from collections import deque
+from collections import namedtuple
+from collections import OrderedDict
 import concurrent.futures
 import datetime
 import logging
+import xml.etree.ElementTree as ET
 
-from cloudhands.burst.control import list_images
+from cloudhands.burst.agent import Agent
+from cloudhands.burst.agent import collect
+from cloudhands.burst.agent import Job
+from cloudhands.burst.agent import select
+from cloudhands.burst.appliance import find_catalogueitems
+from cloudhands.burst.appliance import find_catalogues
+from cloudhands.burst.appliance import find_networkconnection
+from cloudhands.burst.appliance import find_orgs
+from cloudhands.burst.appliance import find_templates
+from cloudhands.burst.appliance import find_vdcs
+from cloudhands.burst.appliance import find_vms
+from cloudhands.burst.client import Clients
+from cloudhands.burst.control import list_images_since
+from cloudhands.burst.health import Breaker
+from cloudhands.burst.health import Health
+from cloudhands.burst.index import upsert
+from cloudhands.burst.utils import fingerprint
+from cloudhands.burst.workers import WorkerPool
+from cloudhands.common.discovery import providers
 from cloudhands.common.schema import Subscription
 
 from cloudhands.common.schema import Component
@@ -17,10 +39,16 @@ from cloudhands.common.states import SubscriptionState
 class Catalogue:
     """
     The catalogue of a provider as most recently discovered.
+
+    :param images: A sequence of (name, id) pairs. Each name not yet
+        recorded for the subscription is added once as a
+        :py:func:`cloudhands.common.schema.OSImage` resource of the new
+        Touch. The catalogue is the images of all its Touches.
     """
-    def __init__(self, actor, subs):
+    def __init__(self, actor, subs, images=()):
         self.actor = actor
         self.subs = subs
+        self.images = images
 
     def __call__(self, session):
         if self.subs.changes[-1].state.name != "unchecked":
@@ -33,6 +61,15 @@ class Catalogue:
         act = Touch(
             artifact=self.subs, actor=self.actor, state=active, at=now)
         self.subs.changes.append(act)
+
+        known = {
+            name for name, in session.query(OSImage.name).join(Touch).filter(
+                Touch.artifact == self.subs).all()}
+        names = OrderedDict.fromkeys(
+            name for name, id_ in self.images if name not in known)
+        session.add_all(
+            OSImage(name=name, provider=self.subs.provider, touch=act)
+            for name in names)
         session.commit()
         return act
 
@@ -65,7 +102,258 @@ class Online:
         return act
 
 
+@asyncio.coroutine
+def discover_images(
+    client, config, fingerprints=None, index=None, unchanged=None
+):
+    """
+    List the images of a provider by the vDC or catalogue which holds them.
+    Items of a catalogue are only fetched if its fingerprint differs from
+    the one given.
+
+    If `index` is a list, the templates of those catalogues which are
+    fetched are described in it, in the form expected by
+    :py:func:`cloudhands.burst.index.upsert`. If `unchanged` is a set,
+    the names of those catalogues which are not fetched are added to it.
+
+    :returns: A dictionary in the form returned by
+        :py:func:`cloudhands.burst.control.list_images_since`.
+    """
+    fingerprints = fingerprints or {}
+    headers = {
+        "Accept": "application/*+xml;version=5.5",
+    }
+    url = "{scheme}://{host}:{port}/{endpoint}".format(
+        scheme="https",
+        host=config["host"]["name"],
+        port=config["host"]["port"],
+        endpoint="api/sessions")
+    response = yield from client.request(
+        "POST", url,
+        auth=(config["user"]["name"], config["user"]["pass"]),
+        headers=headers)
+    headers["x-vcloud-authorization"] = response.headers.get(
+        "x-vcloud-authorization")
+    # Only the header is needed, but the connection must be released
+    yield from response.read_and_close()
+
+    url = "{scheme}://{host}:{port}/{endpoint}".format(
+        scheme="https",
+        host=config["host"]["name"],
+        port=config["host"]["port"],
+        endpoint="api/org")
+    response = yield from client.request("GET", url, headers=headers)
+    orgList = yield from response.read_and_close()
+    tree = ET.fromstring(orgList.decode("utf-8"))
+    org = next(find_orgs(tree, name=config["vdc"]["org"]))
+
+    response = yield from client.request(
+        "GET", org.attrib.get("href"), headers=headers)
+    orgData = yield from response.read_and_close()
+    orgTree = ET.fromstring(orgData.decode("utf-8"))
+
+    @asyncio.coroutine
+    def fetch(href):
+        response = yield from client.request("GET", href, headers=headers)
+        data = yield from response.read_and_close()
+        return ET.fromstring(data.decode("utf-8"))
+
+    rv = OrderedDict()
+    for vdc in find_vdcs(orgTree):
+        href = vdc.attrib.get("href")
+        tree = yield from fetch(href)
+        templates = [
+            (i.attrib.get("name"), i.attrib.get("href"))
+            for i in find_templates(tree)]
+        rv[href] = (fingerprint(None, [i for n, i in templates]), templates)
+
+    for catalogue in find_catalogues(orgTree):
+        href = catalogue.attrib.get("href")
+        tree = yield from fetch(href)
+        items = [
+            i.attrib.get("href") for i in find_catalogueitems(tree)
+            if i.tag.endswith("CatalogItem")]
+        version = next(
+            (i.text for i in tree if i.tag.endswith("VersionNumber")), None)
+        fp = fingerprint(version, items)
+        if fingerprints.get(href) == fp:
+            rv[href] = (fp, None)
+            if unchanged is not None:
+                unchanged.add(catalogue.attrib.get("name"))
+            continue
+
+        trees = yield from asyncio.gather(*[fetch(i) for i in items])
+        templates = [
+            (i.attrib.get("name"), i.attrib.get("href"))
+            for t in trees for i in find_templates(t)]
+        rv[href] = (fp, templates)
+
+        if index is not None:
+            trees = yield from asyncio.gather(
+                *[fetch(i) for n, i in templates])
+            index.extend({
+                "catalogue": catalogue.attrib.get("name"),
+                "name": name,
+                "href": templateHref,
+                "vms": [{
+                    "href": vm.attrib.get("href"),
+                    "networks": [
+                        nc.attrib.get("network")
+                        for nc in find_networkconnection(vm)]
+                    } for vm in find_vms(tree)]
+                } for (name, templateHref), tree in zip(templates, trees))
+
+    return rv
+
+
+class Catalogues:
+    """
+    Remembers the images of each provider's vDCs and catalogues, along
+    with their fingerprints. Only catalogues which have changed need be
+    fetched again.
+    """
+
+    _shared_state = {}
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "listings"):
+            self.listings = {}
+
+    def fingerprints(self, providerName):
+        """
+        :returns: The fingerprints known for a provider, keyed by href.
+        """
+        return {
+            href: fp for href, (fp, imgs) in
+            self.listings.get(providerName, {}).items()}
+
+    def merge(self, providerName, listing):
+        """
+        Merge a listing from :py:func:`list_images_since` or
+        :py:func:`discover_images` with what is known for a provider.
+
+        :returns: The (name, id) pairs of the provider's images.
+        """
+        known = self.listings.get(providerName, {})
+        current = OrderedDict()
+        for href, (fp, imgs) in listing.items():
+            if imgs is None:
+                imgs = known.get(href, (fp, []))[1]
+            current[href] = (fp, imgs)
+        self.listings[providerName] = current
+        return list(OrderedDict(
+            (id_, (name, id_))
+            for fp, imgs in current.values() for name, id_ in imgs).values())
+
+
+class UncheckedAgent(Agent):
+    """
+    Discovers the images of providers with unchecked subscriptions.
+
+    Jobs which arrive within `window` seconds of each other are checked
+    together, with one discovery for each provider. A provider which
+    can't be checked is tried again after `retry` seconds.
+
+    The templates found in changed catalogues are recorded in the
+    template index of :py:mod:`cloudhands.burst.index`.
+    """
+
+    Catalogued = namedtuple(
+        "CataloguedMessage",
+        ["uuid", "ts", "provider", "images", "index", "unchanged"])
+
+    NotCatalogued = namedtuple(
+        "NotCataloguedMessage", ["uuid", "ts", "provider"])
+
+    window = 2
+    retry = 60
+
+    @property
+    def callbacks(self):
+        return [
+            (UncheckedAgent.Catalogued, self.touch_to_active),
+            (UncheckedAgent.NotCatalogued, self.touch_to_previous),
+        ]
+
+    def jobs(self, session):
+        return [
+            Job(subs.uuid, None, subs)
+            for subs in select(session, Subscription, "unchecked")]
+
+    def touch_to_active(self, msg:Catalogued, session):
+        subs = session.query(Subscription).filter(
+            Subscription.uuid == msg.uuid).first()
+        actor = session.query(Component).filter(
+            Component.handle=="burst.controller").one()
+        if msg.index is not None:
+            upsert(session, msg.provider, msg.index, msg.ts, msg.unchanged)
+        # The subscription may have moved on since it was checked
+        return Catalogue(actor, subs, msg.images)(session) or subs.changes[-1]
+
+    def touch_to_previous(self, msg:NotCatalogued, session):
+        subs = session.query(Subscription).filter(
+            Subscription.uuid == msg.uuid).first()
+        actor = session.query(Component).filter(
+            Component.handle=="burst.controller").one()
+        state = subs.changes[-1].state
+        act = Touch(artifact=subs, actor=actor, state=state, at=msg.ts)
+        session.add(act)
+        session.commit()
+        return act
+
+    @asyncio.coroutine
+    def __call__(self, loop, msgQ, *args):
+        log = logging.getLogger("cloudhands.burst.subscription.unchecked")
+        log.info("Activated.")
+        configs = {cfg["metadata"]["path"]: cfg
+                  for p in providers.values() for cfg in p}
+        catalogues = Catalogues()
+        while True:
+            jobs = yield from collect(self.work, self.window, loop=loop)
+            batches = OrderedDict()
+            for job in jobs:
+                name = job.artifact.provider.name
+                if name not in configs:
+                    log.warning("No configuration for {}".format(name))
+                    continue
+                batches.setdefault(name, []).append(job)
+
+            names = list(batches)
+            indexes = {name: [] for name in names}
+            unchanged = {name: set() for name in names}
+            results = yield from asyncio.gather(*[
+                discover_images(
+                    Clients()(configs[name]), configs[name],
+                    catalogues.fingerprints(name), indexes[name],
+                    unchanged[name])
+                for name in names], loop=loop, return_exceptions=True)
+
+            now = datetime.datetime.utcnow()
+            for name, result in zip(names, results):
+                if isinstance(result, Exception):
+                    log.error("Failed to check {}: {}".format(name, result))
+                    for job in batches[name]:
+                        msg = UncheckedAgent.NotCatalogued(job.uuid, now, name)
+                        loop.call_later(self.retry, msgQ.put_nowait, msg)
+                else:
+                    images = tuple(catalogues.merge(name, result))
+                    log.info("{} images from {}".format(len(images), name))
+                    # The index is written once for each provider
+                    index = tuple(indexes[name])
+                    for job in batches[name]:
+                        msg = UncheckedAgent.Catalogued(
+                            job.uuid, now, name, images, index,
+                            tuple(unchanged[name]))
+                        yield from msgQ.put(msg)
+                        index = None
+
+
 class SubscriptionAgent:
+    """
+    Checks the image catalogues of providers from a scheduler. See
+    :py:class:`UncheckedAgent` for the asynchronous version.
+    """
 
     _shared_state = {}
 
@@ -86,26 +374,42 @@ class SubscriptionAgent:
             SubscriptionState).filter(
             SubscriptionState.name=="unchecked").one()
             
-        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as exctr:
-            subs = [i for i in self.session.query(Subscription).all()
-                if i.changes[-1].state is unchecked]
-            jobs = {
-                exctr.submit(list_images, providerName=i.name): i for i in set(
-                    s.provider for s in subs)}
-            # for job in asyncio.as_completed(jobs):
-            #   result = yield from job  # The 'yield from' may raise 
-            for job in concurrent.futures.as_completed(jobs):
-                provider = jobs[job]
-                subscribers = [i for i in subs if i.provider is provider]
-                for s in subscribers:
-                    act = Catalogue(actor, s)(self.session)
-                    for name, id_ in job.result():
-                        self.session.add(
-                            OSImage(name=name, provider=provider, touch=act))
-                    s.changes.append(act)
-                    self.session.commit()
-                    log.debug(act)
-                    self.q.append(act)
+        exctr = WorkerPool(self.config).executor
+        subs = [i for i in self.session.query(Subscription).all()
+            if i.changes[-1].state is unchecked]
+        jobs = {
+            exctr.submit(
+                list_images_since, providerName=i.name,
+                fingerprints=Catalogues().fingerprints(i.name)): i
+            for i in set(s.provider for s in subs)
+            if Health()(i.name).allow()}
+        # for job in asyncio.as_completed(jobs):
+        #   result = yield from job  # The 'yield from' may raise 
+        for job in concurrent.futures.as_completed(jobs):
+            provider = jobs[job]
+            breaker = Health()(provider.name)
+            try:
+                listing = job.result()
+            except Exception as e:
+                if Breaker.unavailable(e):
+                    breaker.failure()
+                else:
+                    breaker.success()
+                log.warning("No images from {}: {}".format(provider.name, e))
+                continue
+            else:
+                breaker.success()
+
+            if listing is None:
+                log.warning("No configuration for {}".format(provider.name))
+                continue
+
+            images = Catalogues().merge(provider.name, listing)
+            subscribers = [i for i in subs if i.provider is provider]
+            for s in subscribers:
+                act = Catalogue(actor, s, images)(self.session)
+                log.debug(act)
+                self.q.append(act)
 
         if self.loop is not None:
             log.debug("Rescheduling {}s later".format(self.args.interval))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+
+__doc__ = """
+Stand-ins for the HTTP client and its responses, for testing the code
+which talks to providers.
+"""
+
+
+class Response:
+
+    def __init__(self, data, headers=None, status=200):
+        self.data = data.encode("utf-8") if isinstance(data, str) else data
+        self.headers = headers or {}
+        self.status = status
+        self.closed = False
+
+    @asyncio.coroutine
+    def read_and_close(self):
+        self.closed = True
+        return self.data
+
+
+class Client:
+    """
+    Replies to each request with the next of `pages`. Subclasses may
+    override :py:meth:`reply` to choose a response by url. If `delay` is
+    given, each request takes that many seconds. The requests made and
+    the responses given are kept in `requests` and `responses`.
+    """
+
+    def __init__(self, *pages, delay=0, loop=None):
+        self.pages = list(pages)
+        self.delay = delay
+        self.loop = loop
+        self.requests = []
+        self.responses = []
+
+    def reply(self, method, url, **kwargs):
+        return Response(self.pages.pop(0))
+
+    @asyncio.coroutine
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        if self.delay:
+            yield from asyncio.sleep(self.delay, loop=self.loop)
+        rv = self.reply(method, url, **kwargs)
+        self.responses.append(rv)
+        return rv
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import datetime
+import sqlite3
+import unittest
+import uuid
+
+from cloudhands.burst.allocator import IPAllocator
+from cloudhands.burst.test.test_appliance import AgentTesting
+
+import cloudhands.common
+from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import NATRouting
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import Subscription
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+from cloudhands.common.states import ApplianceState
+from cloudhands.common.states import SubscriptionState
+
+
+class IPAllocatorTests(AgentTesting):
+
+    def setUp(self):
+        super().setUp()
+        IPAllocator().invalidate()
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        self.user = self.session.query(User).one()
+        self.provider = self.session.query(Provider).one()
+        self.subs = self.session.query(Subscription).one()
+        active = self.session.query(SubscriptionState).filter(
+            SubscriptionState.name == "active").one()
+        now = datetime.datetime.utcnow()
+        act = Touch(artifact=self.subs, actor=self.user, state=active, at=now)
+        self.session.add_all(
+            IPAddress(value=i, touch=act, provider=self.provider)
+            for i in ("172.16.151.170", "172.16.151.171"))
+        self.session.commit()
+
+    def tearDown(self):
+        IPAllocator().invalidate()
+        super().tearDown()
+
+    def make_appliance(self, state):
+        org = self.session.query(Organisation).one()
+        state = self.session.query(ApplianceState).filter(
+            ApplianceState.name == state).one()
+        app = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=org)
+        now = datetime.datetime.utcnow()
+        act = Touch(artifact=app, actor=self.user, state=state, at=now)
+        self.session.add(act)
+        self.session.commit()
+        return act
+
+    def reserve(self, allocator=None):
+        app = self.make_appliance("pre_operational").artifact
+        allocator = allocator or IPAllocator()
+        return (app, allocator.reserve(
+            self.session, self.provider.name, app.uuid, "192.168.2.1"))
+
+    def test_reserve_from_pool(self):
+        app, rv = self.reserve()
+        self.assertIn(rv, ("172.16.151.170", "172.16.151.171"))
+
+    def test_reserve_is_idempotent(self):
+        allocator = IPAllocator()
+        app, rv = self.reserve(allocator)
+        self.assertEqual(
+            rv,
+            allocator.reserve(
+                self.session, self.provider.name, app.uuid, "192.168.2.1"))
+
+    def test_reserve_until_exhausted(self):
+        allocator = IPAllocator()
+        a = self.reserve(allocator)[1]
+        b = self.reserve(allocator)[1]
+        self.assertNotEqual(a, b)
+        self.assertIsNone(self.reserve(allocator)[1])
+
+    def test_reservation_is_recorded(self):
+        app, rv = self.reserve()
+        routing = self.session.query(NATRouting).one()
+        self.assertEqual(rv, routing.ip_ext)
+        self.assertEqual("192.168.2.1", routing.ip_int)
+        self.assertIs(app, routing.touch.artifact)
+        self.assertEqual("pre_operational", app.changes[-1].state.name)
+
+    def test_reservation_survives_restart(self):
+        app, rv = self.reserve()
+        IPAllocator().invalidate()
+        self.assertEqual(
+            rv,
+            IPAllocator().reserve(
+                self.session, self.provider.name, app.uuid, "192.168.2.1"))
+        self.assertNotEqual(rv, self.reserve()[1])
+
+    def test_release_on_pre_delete(self):
+        allocator = IPAllocator()
+        app, a = self.reserve(allocator)
+        self.reserve(allocator)
+        self.assertIsNone(self.reserve(allocator)[1])
+
+        pre_delete = self.session.query(ApplianceState).filter(
+            ApplianceState.name == "pre_delete").one()
+        self.session.add(Touch(
+            artifact=app, actor=self.user, state=pre_delete,
+            at=datetime.datetime.utcnow()))
+        self.session.commit()
+        self.assertEqual(a, allocator.release(self.provider.name, app.uuid))
+        self.assertEqual(a, self.reserve(allocator)[1])
+
+    def test_release_without_reservation(self):
+        self.assertIsNone(IPAllocator().release(self.provider.name, "z"))
+
+    def test_routed_address_is_taken(self):
+        act = self.make_appliance("operational")
+        self.session.add(NATRouting(
+            touch=act, provider=self.provider,
+            ip_int="192.168.2.1", ip_ext="172.16.151.170"))
+        self.session.commit()
+        allocator = IPAllocator()
+        self.assertEqual("172.16.151.171", self.reserve(allocator)[1])
+        self.assertIsNone(self.reserve(allocator)[1])
+
+    def test_deleted_appliance_releases_address(self):
+        act = self.make_appliance("deleted")
+        self.session.add(NATRouting(
+            touch=act, provider=self.provider,
+            ip_int="192.168.2.1", ip_ext="172.16.151.170"))
+        self.session.commit()
+        allocator = IPAllocator()
+        self.reserve(allocator)
+        self.assertIsNotNone(self.reserve(allocator)[1])
@@ -5,9 +5,15 @@ import asyncio
 import datetime
 import sqlite3
 import unittest
+from unittest.mock import patch
 import uuid
 
+from cloudhands.burst.agent import collect
+from cloudhands.burst.agent import Job
+from cloudhands.burst.allocator import IPAllocator
 from cloudhands.burst.agent import message_handler
+from cloudhands.burst.appliance import GatewayUpdate
+from cloudhands.burst.appliance import hosts
 from cloudhands.burst.appliance import PreCheckAgent
 from cloudhands.burst.appliance import PreDeleteAgent
 from cloudhands.burst.appliance import PreOperationalAgent
@@ -15,6 +21,13 @@ from cloudhands.burst.appliance import PreProvisionAgent
 from cloudhands.burst.appliance import ProvisioningAgent
 from cloudhands.burst.appliance import PreStartAgent
 from cloudhands.burst.appliance import PreStopAgent
+from cloudhands.burst.appliance import touch_again
+from cloudhands.burst.client import Clients
+from cloudhands.burst.readiness import PollSchedule
+from cloudhands.burst.strategy import Capacities
+from cloudhands.burst.strategy import Headroom
+from cloudhands.burst.strategy import Strategy
+from cloudhands.burst.test.fakes import Client
 
 import cloudhands.common
 from cloudhands.common.connectors import Registry
@@ -39,6 +52,7 @@ from cloudhands.common.schema import Touch
 from cloudhands.common.schema import User
 from cloudhands.common.states import ApplianceState
 from cloudhands.common.states import RegistrationState
+from cloudhands.common.states import SubscriptionState
 
 
 class AgentTesting(unittest.TestCase):
@@ -281,6 +295,7 @@ class PreCheckAgentTesting(AgentTesting):
         session.commit()
 
         self.assertEqual(0, session.query(ProviderReport).count())
+        PollSchedule().defer(app.uuid)
         q = PreCheckAgent.queue(None, None, loop=None)
         agent = PreCheckAgent(q, args=None, config=None)
         for typ, handler in agent.callbacks:
@@ -298,6 +313,7 @@ class PreCheckAgentTesting(AgentTesting):
         self.assertEqual(report.creation, "deployed")
         self.assertEqual(report.power, "on")
         self.assertEqual("operational", app.changes[-1].state.name)
+        self.assertNotIn(app.uuid, PollSchedule().attempts)
 
     def test_preoperational_msg_dispatch_and_touch(self):
         session = Registry().connect(sqlite3, ":memory:").session
@@ -347,6 +363,10 @@ class PreDeleteAgentTesting(AgentTesting):
             agent.touch_to_deleted,
             message_handler.dispatch(PreDeleteAgent.Message)
         )
+        self.assertEqual(
+            touch_again,
+            message_handler.dispatch(PreDeleteAgent.Failed)
+        )
 
 
     def test_queue_creation(self):
@@ -403,6 +423,10 @@ class PreOperationalAgentTesting(AgentTesting):
             message_handler.dispatch(
                 PreOperationalAgent.ResourceConstrainedMessage)
         )
+        self.assertEqual(
+            touch_again,
+            message_handler.dispatch(PreOperationalAgent.Failed)
+        )
 
     def test_queue_creation(self):
         self.assertIsInstance(
@@ -410,6 +434,108 @@ class PreOperationalAgentTesting(AgentTesting):
             asyncio.Queue
         )
 
+    def setup_appliance(self, session):
+        user = session.query(User).one()
+        org = session.query(Organisation).one()
+        prvdr = session.query(Provider).one()
+        subs = session.query(Subscription).one()
+        IPAllocator().invalidate()
+        self.addCleanup(IPAllocator().invalidate)
+
+        # The subscription has one public address
+        active = session.query(SubscriptionState).filter(
+            SubscriptionState.name == "active").one()
+        act = Touch(
+            artifact=subs, actor=user, state=active,
+            at=datetime.datetime.utcnow())
+        session.add(
+            IPAddress(value="172.16.151.170", touch=act, provider=prvdr))
+
+        app = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=org)
+        tmplt = session.query(CatalogueItem).filter(
+            CatalogueItem.natrouted == True).first()
+        for state in ("requested", "provisioning", "pre_operational"):
+            state = session.query(ApplianceState).filter(
+                ApplianceState.name == state).one()
+            act = Touch(
+                artifact=app, actor=user, state=state,
+                at=datetime.datetime.utcnow())
+            if state.name == "requested":
+                resource = CatalogueChoice(
+                    provider=None, touch=act, natrouted=True,
+                    **{k: getattr(tmplt, k, None)
+                    for k in ("name", "description", "logo")})
+            elif state.name == "provisioning":
+                resource = Node(
+                    name="test_server01", touch=act, provider=prvdr,
+                    uri="https://vjasmin-vcloud-test.jc.rl.ac.uk/api/vApp/1")
+            else:
+                resource = IPAddress(
+                    value="192.168.2.1", touch=act, provider=prvdr)
+            session.add(resource)
+        session.commit()
+        return app
+
+    def run_agent(self, session, success=True):
+        """
+        Run the agent on its jobs with a gateway whose updates succeed
+        or fail, and return the first message it sends.
+        """
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        work = asyncio.Queue(loop=loop)
+        msgQ = asyncio.Queue(loop=loop)
+        agent = PreOperationalAgent(work, args=None, config=None)
+        for job in agent.jobs(session):
+            work.put_nowait(job)
+
+        @asyncio.coroutine
+        def update(self):
+            return {uuid: success for uuid in self.rules}
+
+        with patch.object(PreOperationalAgent, "window", 0), \
+            patch.object(GatewayUpdate, "__call__", update):
+            task = asyncio.Task(agent(loop, msgQ, session), loop=loop)
+            rv = loop.run_until_complete(
+                asyncio.wait_for(msgQ.get(), 5, loop=loop))
+            task.cancel()
+            loop.run_until_complete(asyncio.wait([task], loop=loop))
+
+        for typ, handler in agent.callbacks:
+            message_handler.register(typ, handler)
+        return rv
+
+    def test_failed_gateway_update_touches_again(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        app = self.setup_appliance(session)
+        msg = self.run_agent(session, success=False)
+        self.assertIsInstance(msg, PreOperationalAgent.Failed)
+        self.assertEqual(app.uuid, msg.uuid)
+
+        n = len(app.changes)
+        rv = message_handler(msg, session)
+        self.assertIsInstance(rv, Touch)
+        self.assertEqual(n + 1, len(app.changes))
+        self.assertEqual("pre_operational", app.changes[-1].state.name)
+
+    def test_one_routing_when_operational(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        app = self.setup_appliance(session)
+        msg = self.run_agent(session)
+        self.assertIsInstance(msg, PreOperationalAgent.OperationalMessage)
+        self.assertEqual("192.168.2.1", msg.ip_internal)
+        self.assertEqual("172.16.151.170", msg.ip_external)
+
+        rv = message_handler(msg, session)
+        self.assertIsInstance(rv, Touch)
+        self.assertEqual("operational", app.changes[-1].state.name)
+        routing = session.query(NATRouting).one()
+        self.assertEqual("192.168.2.1", routing.ip_int)
+        self.assertEqual("172.16.151.170", routing.ip_ext)
+
     def test_msg_dispatch_and_touch(self):
         session = Registry().connect(sqlite3, ":memory:").session
         user = session.query(User).one()
@@ -445,6 +571,37 @@ class PreOperationalAgentTesting(AgentTesting):
         self.assertEqual("operational", app.changes[-1].state.name)
 
 
+class GatewayUpdateTests(unittest.TestCase):
+
+    def test_rules_keep_order(self):
+        update = GatewayUpdate(config=None)
+        update.add("a", "172.16.151.170", "192.168.2.1")
+        update.add("b", "172.16.151.171", "192.168.2.2")
+        self.assertEqual(["a", "b"], list(update.rules))
+        self.assertEqual(
+            {"rx": "172.16.151.171", "tx": "192.168.2.2"},
+            update.rules["b"])
+
+    def test_collect_batches_waiting_jobs(self):
+        loop = asyncio.new_event_loop()
+        q = asyncio.Queue(loop=loop)
+        for n in range(3):
+            q.put_nowait(n)
+        rv = loop.run_until_complete(collect(q, 0, loop=loop))
+        self.assertEqual([0, 1, 2], rv)
+        loop.close()
+
+    def test_collect_respects_limit(self):
+        loop = asyncio.new_event_loop()
+        q = asyncio.Queue(loop=loop)
+        for n in range(3):
+            q.put_nowait(n)
+        rv = loop.run_until_complete(collect(q, 0, limit=2, loop=loop))
+        self.assertEqual([0, 1], rv)
+        self.assertEqual(1, q.qsize())
+        loop.close()
+
+
 class PreProvisionAgentTesting(AgentTesting):
 
     def test_handler_registration(self):
@@ -456,6 +613,10 @@ class PreProvisionAgentTesting(AgentTesting):
             agent.touch_to_provisioning,
             message_handler.dispatch(PreProvisionAgent.Message)
         )
+        self.assertEqual(
+            agent.touch_to_pre_provision,
+            message_handler.dispatch(PreProvisionAgent.Deferred)
+        )
 
     def test_queue_creation(self):
         self.assertIsInstance(
@@ -565,6 +726,34 @@ class PreProvisionAgentTesting(AgentTesting):
         job = q.get_nowait()
         self.assertIn("valid", job.token[2])
 
+    def test_job_deferred_when_provider_short(self):
+        job = self.setup_appliance().get_nowait()
+        Capacities().update(job.token[0], Headroom(0.05, 0.5, None))
+        self.addCleanup(Capacities().headrooms.clear)
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        work = asyncio.Queue(loop=loop)
+        work.put_nowait(job)
+        msgQ = asyncio.Queue(loop=loop)
+        agent = PreProvisionAgent(work, args=None, config=None)
+        with patch.object(PreProvisionAgent, "retry", 0):
+            task = asyncio.Task(agent(loop, msgQ), loop=loop)
+            msg = loop.run_until_complete(
+                asyncio.wait_for(msgQ.get(), 5, loop=loop))
+            task.cancel()
+            loop.run_until_complete(asyncio.wait([task], loop=loop))
+        self.assertIsInstance(msg, PreProvisionAgent.Deferred)
+        self.assertEqual(job.uuid, msg.uuid)
+
+        for typ, handler in agent.callbacks:
+            message_handler.register(typ, handler)
+        session = Registry().connect(sqlite3, ":memory:").session
+        rv = message_handler(msg, session)
+        self.assertIsInstance(rv, Touch)
+        self.assertEqual("pre_provision", rv.state.name)
+        self.assertEqual("burst.controller", rv.actor.handle)
+
     def test_msg_dispatch_and_touch(self):
         session = Registry().connect(sqlite3, ":memory:").session
         user = session.query(User).one()
@@ -611,6 +800,14 @@ class ProvisioningAgentTesting(AgentTesting):
             agent.touch_to_precheck,
             message_handler.dispatch(ProvisioningAgent.Message)
         )
+        self.assertEqual(
+            agent.touch_to_provisioning,
+            message_handler.dispatch(ProvisioningAgent.Waiting)
+        )
+        self.assertEqual(
+            agent.touch_to_preprovision,
+            message_handler.dispatch(ProvisioningAgent.Failed)
+        )
 
     def test_queue_creation(self):
         self.assertIsInstance(
@@ -647,6 +844,56 @@ class ProvisioningAgentTesting(AgentTesting):
 
         self.assertEqual("pre_check", app.changes[-1].state.name)
 
+    def test_failed_task_returns_to_preprovision(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        user = session.query(User).one()
+        org = session.query(Organisation).one()
+        prvdr = session.query(Provider).one()
+
+        provisioning = session.query(ApplianceState).filter(
+            ApplianceState.name == "provisioning").one()
+        app = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=org)
+        act = Touch(
+            artifact=app, actor=user, state=provisioning,
+            at=datetime.datetime.utcnow())
+        session.add(Node(
+            name="test_server01", touch=act, provider=prvdr,
+            uri="https://vjasmin-vcloud-test.jc.rl.ac.uk/api/vApp/1"))
+        session.commit()
+
+        href = "https://vjasmin-vcloud-test.jc.rl.ac.uk/api/task/1"
+        PollSchedule().track(app.uuid, href)
+        self.addCleanup(PollSchedule().forget, app.uuid)
+        client = Clients()(Strategy.config(prvdr.name))
+        self.addCleanup(Clients().clients.clear)
+        client.client = Client(
+            '<Task xmlns="http://www.vmware.com/vcloud/v1.5" '
+            'status="error" href="{}"/>'.format(href))
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        work = asyncio.Queue(loop=loop)
+        work.put_nowait(Job(app.uuid, None, app))
+        msgQ = asyncio.Queue(loop=loop)
+        agent = ProvisioningAgent(work, args=None, config=None)
+        task = asyncio.Task(agent(loop, msgQ), loop=loop)
+        msg = loop.run_until_complete(
+            asyncio.wait_for(msgQ.get(), 5, loop=loop))
+        task.cancel()
+        loop.run_until_complete(asyncio.wait([task], loop=loop))
+        self.assertIsInstance(msg, ProvisioningAgent.Failed)
+        self.assertEqual("error", msg.status)
+
+        for typ, handler in agent.callbacks:
+            message_handler.register(typ, handler)
+        rv = message_handler(msg, session)
+        self.assertIsInstance(rv, Touch)
+        self.assertEqual("pre_provision", app.changes[-1].state.name)
+        self.assertNotIn(app.uuid, PollSchedule().tasks)
+
     def test_job_query_and_transmit(self):
         session = Registry().connect(sqlite3, ":memory:").session
 
@@ -721,6 +968,10 @@ class PreStartAgentTesting(AgentTesting):
             agent.touch_to_running,
             message_handler.dispatch(PreStartAgent.Message)
         )
+        self.assertEqual(
+            touch_again,
+            message_handler.dispatch(PreStartAgent.Failed)
+        )
 
     def test_queue_creation(self):
         self.assertIsInstance(
@@ -771,6 +1022,10 @@ class PreStopAgentTesting(AgentTesting):
             agent.touch_to_stopped,
             message_handler.dispatch(PreStopAgent.Message)
         )
+        self.assertEqual(
+            touch_again,
+            message_handler.dispatch(PreStopAgent.Failed)
+        )
 
     def test_queue_creation(self):
         self.assertIsInstance(
@@ -930,3 +1185,61 @@ class ApplianceTesting(AgentTesting):
         self.assertIn(node, resources)
         self.assertIn(sdn, resources)
         self.assertIn(ip, resources)
+
+
+class HostsTesting(AgentTesting):
+
+    def setUp(self):
+        super().setUp()
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        user = self.session.query(User).one()
+        org = self.session.query(Organisation).one()
+        states = {
+            i.name: i for i in self.session.query(ApplianceState).all()}
+        now = datetime.datetime.utcnow()
+        then = now - datetime.timedelta(seconds=45)
+        self.apps = []
+        for latest in ("provisioning", "pre_check", "provisioning"):
+            app = Appliance(
+                uuid=uuid.uuid4().hex,
+                model=cloudhands.common.__version__,
+                organisation=org)
+            self.session.add_all((
+                Touch(
+                    artifact=app, actor=user,
+                    state=states["pre_provision"], at=then),
+                Touch(artifact=app, actor=user, state=states[latest], at=now),
+            ))
+            self.apps.append(app)
+        self.session.commit()
+
+    def test_filter_on_latest_state(self):
+        self.assertEqual(
+            [self.apps[0].uuid, self.apps[2].uuid],
+            [i.uuid for i in hosts(self.session, state="provisioning")])
+        self.assertEqual(
+            [self.apps[1].uuid],
+            [i.uuid for i in hosts(self.session, state="pre_check")])
+        self.assertFalse(hosts(self.session, state="pre_provision"))
+
+    def test_paging(self):
+        self.assertEqual(
+            [self.apps[2].uuid],
+            [i.uuid for i in hosts(
+                self.session, state="provisioning", offset=1, limit=1)])
+
+    def test_last_touch_wins_a_tie(self):
+        app = self.apps[0]
+        user = self.session.query(User).one()
+        preCheck = self.session.query(ApplianceState).filter(
+            ApplianceState.name == "pre_check").one()
+        self.session.add(Touch(
+            artifact=app, actor=user, state=preCheck,
+            at=app.changes[-1].at))
+        self.session.commit()
+        self.assertEqual(
+            [self.apps[2].uuid],
+            [i.uuid for i in hosts(self.session, state="provisioning")])
+        self.assertEqual(
+            [self.apps[0].uuid, self.apps[1].uuid],
+            [i.uuid for i in hosts(self.session, state="pre_check")])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+from types import SimpleNamespace
+import unittest
+from unittest.mock import patch
+
+from cloudhands.burst.capacity import CapacityAgent
+from cloudhands.burst.health import Health
+from cloudhands.burst.strategy import Capacities
+from cloudhands.burst.strategy import Headroom
+
+
+class CapacityAgentTests(unittest.TestCase):
+
+    names = (
+        "cloudhands.jasmin.vcloud.phase04.cfg",
+        "cloudhands.jasmin.vcloud.phase05.cfg",
+    )
+
+    @staticmethod
+    def vdc_headroom(name):
+        if name.endswith("phase04.cfg"):
+            return Headroom(0.05, 0.5, None)
+        else:
+            raise OSError("Unreachable")
+
+    def setUp(self):
+        Capacities().headrooms.clear()
+        Health().breakers.clear()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        Capacities().headrooms.clear()
+        Health().breakers.clear()
+        self.loop.close()
+
+    def run_agent(self):
+        agent = CapacityAgent(
+            asyncio.Queue(loop=self.loop), args=None, config=None)
+        msgQ = asyncio.Queue(loop=self.loop)
+        task = asyncio.Task(agent(self.loop, msgQ), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        task.cancel()
+        self.loop.run_until_complete(asyncio.wait([task], loop=self.loop))
+        return msgQ
+
+    @patch("cloudhands.burst.capacity.WorkerPool")
+    @patch("cloudhands.burst.capacity.providers")
+    def test_headroom_refreshed(self, providers, pool):
+        providers.values.return_value = [
+            [{"metadata": {"path": i}} for i in self.names]]
+        pool.return_value = SimpleNamespace(executor=None)
+        with patch(
+            "cloudhands.burst.capacity.vdc_headroom", self.vdc_headroom
+        ):
+            msgQ = self.run_agent()
+
+        self.assertTrue(msgQ.empty())
+        self.assertAlmostEqual(0.05, Capacities().free(self.names[0]))
+        self.assertIsNone(Capacities().free(self.names[1]))
+        self.assertEqual(0, Health()(self.names[0]).failures)
+        self.assertEqual(1, Health()(self.names[1]).failures)
+
+    @patch("cloudhands.burst.capacity.WorkerPool")
+    @patch("cloudhands.burst.capacity.providers")
+    def test_open_circuit_not_called(self, providers, pool):
+        providers.values.return_value = [
+            [{"metadata": {"path": i}} for i in self.names]]
+        pool.return_value = SimpleNamespace(executor=None)
+        for i in range(Health()(self.names[1]).threshold):
+            Health()(self.names[1]).failure()
+        calls = []
+        with patch(
+            "cloudhands.burst.capacity.vdc_headroom",
+            lambda name: calls.append(name)
+        ):
+            self.run_agent()
+
+        self.assertEqual([self.names[0]], calls)
+
+    def test_no_jobs(self):
+        agent = CapacityAgent(
+            asyncio.Queue(loop=self.loop), args=None, config=None)
+        self.assertEqual([], list(agent.callbacks))
+        self.assertEqual((), tuple(agent.jobs(None)))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+import configparser
+import time
+import unittest
+
+from cloudhands.burst.client import ProviderClient
+from cloudhands.burst.client import TokenBucket
+from cloudhands.burst.client import Waits
+from cloudhands.burst.health import Health
+from cloudhands.burst.test.fakes import Client
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_burst_does_not_wait(self):
+        bucket = TokenBucket(rate=1, burst=3)
+        waits = [
+            self.loop.run_until_complete(bucket.acquire(loop=self.loop))
+            for i in range(3)]
+        self.assertEqual([0, 0, 0], waits)
+        self.assertLess(bucket.tokens, 1)
+
+    def test_wait_when_empty(self):
+        bucket = TokenBucket(rate=50, burst=1)
+        self.loop.run_until_complete(bucket.acquire(loop=self.loop))
+        waited = self.loop.run_until_complete(bucket.acquire(loop=self.loop))
+        self.assertGreater(waited, 0)
+        self.assertLess(waited, 1)
+
+    def test_refill_is_capped(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        bucket.refill(0)
+        bucket.tokens = 0
+        bucket.refill(60)
+        self.assertEqual(2, bucket.tokens)
+
+    def test_bad_limits_rejected(self):
+        self.assertRaises(ValueError, TokenBucket, rate=0, burst=1)
+        self.assertRaises(ValueError, TokenBucket, rate=1, burst=0)
+
+
+class WaitsTests(unittest.TestCase):
+
+    def test_record(self):
+        waits = Waits()
+        self.assertEqual(0, waits.mean)
+        waits.record(1.0)
+        waits.record(3.0)
+        self.assertEqual(2, waits.count)
+        self.assertEqual(2.0, waits.mean)
+        self.assertEqual(3.0, waits.longest)
+
+
+class ProviderClientTests(unittest.TestCase):
+
+    @staticmethod
+    def config(**limits):
+        rv = configparser.ConfigParser()
+        rv.read_dict({
+            "metadata": {"path": "cloudhands.jasmin.vcloud.phase04.cfg"},
+            "host": {
+                "name": "vjasmin-vcloud-test.jc.rl.ac.uk",
+                "port": "443",
+                "verify_ssl_cert": "false",
+            },
+        })
+        if limits:
+            rv.read_dict({"limits": limits})
+        return rv
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_defaults(self):
+        client = ProviderClient(self.config())
+        self.assertEqual(ProviderClient.rate, client.rate)
+        self.assertEqual(ProviderClient.tasks, client.tasks)
+
+    def test_limits_from_config(self):
+        client = ProviderClient(self.config(rate="2", tasks="1"))
+        self.assertEqual(2.0, client.bucket.rate)
+        self.assertEqual(1, client.tasks)
+
+    def test_bad_limits_ignored(self):
+        client = ProviderClient(self.config(
+            rate="0", burst="0.5", token_rate="-1", tasks="0"))
+        self.assertEqual(ProviderClient.rate, client.bucket.rate)
+        self.assertEqual(ProviderClient.burst, client.bucket.burst)
+        self.assertEqual(ProviderClient.token_rate, client.token_rate)
+        self.assertEqual(ProviderClient.tasks, client.tasks)
+        waited = self.loop.run_until_complete(
+            client.token_bucket("a").acquire(loop=self.loop))
+        self.assertEqual(0, waited)
+
+    def test_token_buckets_are_separate(self):
+        client = ProviderClient(self.config())
+        a = client.token_bucket("a")
+        self.assertIs(a, client.token_bucket("a"))
+        self.assertIsNot(a, client.token_bucket("b"))
+
+    def test_token_bucket_burst(self):
+        client = ProviderClient(self.config(token_rate="0.5"))
+        bucket = client.token_bucket("a")
+        self.assertEqual(0.5, bucket.rate)
+        self.assertEqual(1, bucket.burst)
+        waited = self.loop.run_until_complete(bucket.acquire(loop=self.loop))
+        self.assertEqual(0, waited)
+
+    def test_idle_token_buckets_dropped(self):
+        client = ProviderClient(self.config())
+        client.tokens = 2
+        for token in ("a", "b"):
+            client.token_bucket(token).refill(0)
+        client.token_bucket("a").tokens = 0
+        client.token_bucket("c", now=0.1)
+        self.assertEqual({"a", "c"}, set(client.buckets))
+
+        client.token_bucket("c").tokens = 0
+        client.token_bucket("d", now=0.1)
+        self.assertNotIn("a", client.buckets)
+        self.assertIn("d", client.buckets)
+        self.assertEqual(2, len(client.buckets))
+
+    def test_task_slots(self):
+        client = ProviderClient(self.config(tasks="1"))
+        end = self.loop.run_until_complete(client.begin_task())
+        waiting = asyncio.Task(client.begin_task(), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertFalse(waiting.done())
+
+        client.running["task"] = end
+        client.end_task("task")
+        end()  # Is harmless a second time
+        self.loop.run_until_complete(waiting)
+        self.assertTrue(waiting.done())
+        self.assertEqual(2, client.waits["tasks"].count)
+
+    def test_cancelled_probe_is_released(self):
+        client = ProviderClient(self.config())
+        client.client = Client(b"", delay=1, loop=self.loop)
+        breaker = Health()(client.name)
+        self.addCleanup(Health().breakers.clear)
+        breaker.opened = time.monotonic() - breaker.delay
+
+        send = asyncio.Task(
+            client.send("GET", "https://vjasmin-vcloud-test.jc.rl.ac.uk"),
+            loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        self.assertTrue(breaker.probing)
+        send.cancel()
+        self.loop.run_until_complete(asyncio.wait([send], loop=self.loop))
+        self.assertFalse(breaker.probing)
+        self.assertTrue(breaker.ready())
+
+    def test_throttle_records_waits(self):
+        client = ProviderClient(self.config())
+        self.loop.run_until_complete(
+            client.throttle({"x-vcloud-authorization": "a"}))
+        self.assertEqual(1, client.waits["rate"].count)
+        self.assertEqual(1, client.waits["token"].count)
+        self.assertIn("a", client.buckets)
+
+    def test_token_wait_recorded_alone(self):
+        client = ProviderClient(self.config(rate="50", burst="1"))
+        client.bucket.tokens = 0
+        self.loop.run_until_complete(
+            client.throttle({"x-vcloud-authorization": "a"}))
+        self.assertGreater(client.waits["rate"].longest, 0)
+        self.assertEqual(0, client.waits["token"].longest)
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    body = b"""<?xml version="1.0" encoding="UTF-8"?>
+<OrgList xmlns="http://www.vmware.com/vcloud/v1.5">
+<Org href="https://vjasmin-vcloud-test.jc.rl.ac.uk/api/org/1" name="un-managed_tenancy_test_org"/>
+</OrgList>"""
+
+    url = "https://vjasmin-vcloud-test.jc.rl.ac.uk:443/api/org"
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = ProviderClient(ProviderClientTests.config())
+        self.client.client = Client(
+            *[self.body] * 3, delay=0.01, loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def gather(self, *requests):
+        return self.loop.run_until_complete(
+            asyncio.gather(*requests, loop=self.loop))
+
+    def test_identical_gets_share_one_request(self):
+        headers = {"x-vcloud-authorization": "a"}
+        replies = self.gather(*[
+            self.client.request("GET", self.url, headers=headers)
+            for i in range(3)])
+        self.assertEqual(1, len(self.client.client.requests))
+        self.assertEqual(2, self.client.coalesced)
+        self.assertEqual(1, len({id(i) for i in replies}))
+        self.assertIs(replies[0].tree(), replies[2].tree())
+        self.assertEqual({}, self.client.flights)
+
+        body = self.loop.run_until_complete(replies[1].read_and_close())
+        self.assertEqual(self.body, body)
+
+    def test_other_credentials_are_not_shared(self):
+        self.gather(
+            self.client.request(
+                "GET", self.url, headers={"x-vcloud-authorization": "a"}),
+            self.client.request(
+                "GET", self.url, headers={"x-vcloud-authorization": "b"}))
+        self.assertEqual(2, len(self.client.client.requests))
+        self.assertEqual(0, self.client.coalesced)
+
+    def test_posts_are_not_shared(self):
+        self.gather(*[
+            self.client.request("POST", self.url, data=b"") for i in range(2)])
+        self.assertEqual(2, len(self.client.client.requests))
+
+    def test_later_gets_are_made_afresh(self):
+        for i in range(2):
+            self.gather(self.client.request("GET", self.url))
+        self.assertEqual(2, len(self.client.client.requests))
@@ -1,13 +1,186 @@
 #!/usr/bin/env python
 # encoding: UTF-8
 
+from types import SimpleNamespace
 import unittest
+from unittest.mock import patch
 
+from cloudhands.burst.control import Connections
+from cloudhands.burst.control import driver_class
+from cloudhands.burst.drivers.vcloud import Capacity
+from cloudhands.burst.drivers.vcloud import Vdc
 from cloudhands.burst.host import Strategy
+from cloudhands.burst.strategy import Capacities
+from cloudhands.burst.strategy import headroom
+
+
+def subscriber(*names, resources=()):
+    return SimpleNamespace(
+        organisation=SimpleNamespace(subscriptions=[
+            SimpleNamespace(provider=SimpleNamespace(name=i))
+            for i in names]),
+        changes=[SimpleNamespace(resources=list(resources))])
+
+
+def vdc(cpu, memory, storage):
+    return Vdc(
+        "https://cloud/api/vdc/1", "test-vdc", None,
+        cpu=Capacity(100, cpu, "MHz"),
+        memory=Capacity(100, memory, "MB"),
+        storage=Capacity(0, storage, "MB"))
 
 
-@unittest.skip("Provider selection strategy not yet implemented.")
 class StrategyTests(unittest.TestCase):
 
-    def test_tbd(self):
-        self.fail("Write me!")
+    names = (
+        "cloudhands.jasmin.vcloud.phase04.cfg",
+        "cloudhands.jasmin.vcloud.phase05.cfg",
+        "cloudhands.jasmin.vcloud.phase06.cfg",
+    )
+
+    def setUp(self):
+        Capacities().headrooms.clear()
+        Strategy._index = {i: {"metadata": {"path": i}} for i in self.names}
+
+    def tearDown(self):
+        Capacities().headrooms.clear()
+        Strategy._index = None
+
+    def test_headroom(self):
+        rv = headroom([vdc(20, 90, 10)])
+        self.assertAlmostEqual(0.8, rv.cpu)
+        self.assertAlmostEqual(0.1, rv.memory)
+        self.assertIsNone(rv.storage)
+
+    def test_config_index(self):
+        self.assertEqual(
+            self.names[1], Strategy.config(self.names[1])["metadata"]["path"])
+        self.assertIsNone(Strategy.config("unknown"))
+
+    def test_first(self):
+        host = subscriber(*self.names)
+        Capacities().update(self.names[0], headroom([vdc(99, 99, 0)]))
+        self.assertEqual(list(self.names), Strategy.rank(host, "first"))
+
+    def test_unknown_capacity_keeps_order(self):
+        host = subscriber(*self.names)
+        self.assertEqual(
+            list(self.names), Strategy.rank(host, "capacity_aware"))
+
+    def test_least_loaded(self):
+        host = subscriber(*self.names)
+        Capacities().update(self.names[0], headroom([vdc(90, 50, 0)]))
+        Capacities().update(self.names[1], headroom([vdc(10, 20, 0)]))
+        self.assertEqual(
+            [self.names[1], self.names[2], self.names[0]],
+            Strategy.rank(host, "least_loaded"))
+
+    def test_capacity_aware_avoids_exhausted_provider(self):
+        host = subscriber(*self.names[:2])
+        Capacities().update(self.names[0], headroom([vdc(95, 10, 0)]))
+        self.assertEqual(
+            self.names[1],
+            Strategy.recommend(host, "capacity_aware")["metadata"]["path"])
+
+    def test_affinity(self):
+        node = SimpleNamespace(provider=SimpleNamespace(name=self.names[2]))
+        host = subscriber(*self.names, resources=[node])
+        Capacities().update(self.names[1], headroom([vdc(10, 10, 0)]))
+        self.assertEqual(
+            [self.names[2], self.names[1], self.names[0]],
+            Strategy.rank(host, "affinity"))
+
+    def test_stale_capacity_ignored(self):
+        Capacities().update(
+            self.names[0], headroom([vdc(95, 95, 0)]),
+            now=-Capacities.ttl - 1)
+        self.assertIsNone(Capacities().free(self.names[0]))
+
+
+class HTTPSConnection:
+
+    def __init__(self):
+        self._setup_verify()
+
+    def _setup_verify(self):
+        self.verify = True
+
+
+class LibcloudConnection:
+    conn_classes = (object, HTTPSConnection)
+
+
+class LibcloudDriver:
+    connectionCls = LibcloudConnection
+
+
+class DriverClassTests(unittest.TestCase):
+
+    def test_verify_per_driver(self):
+        strict = driver_class(__name__, "LibcloudDriver", True)
+        lax = driver_class(__name__, "LibcloudDriver", False)
+        self.assertTrue(issubclass(lax, LibcloudDriver))
+        self.assertTrue(strict.connectionCls.conn_classes[1]().verify)
+        self.assertFalse(lax.connectionCls.conn_classes[1]().verify)
+        self.assertTrue(HTTPSConnection().verify)
+
+    def test_driver_class_cached(self):
+        self.assertIs(
+            driver_class(__name__, "LibcloudDriver", False),
+            driver_class(__name__, "LibcloudDriver", False))
+
+
+class Driver:
+
+    def __init__(self, healthy=True):
+        self.connection = self
+        self.healthy = healthy
+
+    def request(self, path):
+        if not self.healthy:
+            raise Exception("Session expired")
+
+
+class ConnectionsTests(unittest.TestCase):
+
+    config = {"metadata": {"path": "cloudhands.jasmin.vcloud.phase04.cfg"}}
+
+    def setUp(self):
+        Connections().drivers.clear()
+
+    def tearDown(self):
+        Connections().drivers.clear()
+
+    def test_driver_reused(self):
+        with patch("cloudhands.burst.control.connect",
+                   side_effect=lambda cfg: Driver()) as connect:
+            a = Connections()(self.config)
+            b = Connections()(self.config)
+        self.assertIs(a, b)
+        self.assertEqual(1, connect.call_count)
+
+    def test_idle_driver_replaced_when_unhealthy(self):
+        conns = Connections()
+        with patch("cloudhands.burst.control.connect",
+                   side_effect=lambda cfg: Driver(healthy=False)):
+            a = conns(self.config)
+            conns.drivers[self.config["metadata"]["path"]] = (a, 0)
+            b = conns(self.config)
+        self.assertIsNot(a, b)
+
+    def test_idle_driver_kept_when_healthy(self):
+        conns = Connections()
+        with patch("cloudhands.burst.control.connect",
+                   side_effect=lambda cfg: Driver()):
+            a = conns(self.config)
+            conns.drivers[self.config["metadata"]["path"]] = (a, 0)
+            b = conns(self.config)
+        self.assertIs(a, b)
+
+    def test_discard(self):
+        with patch("cloudhands.burst.control.connect",
+                   side_effect=lambda cfg: Driver()):
+            a = Connections()(self.config)
+            Connections().discard(self.config)
+            b = Connections()(self.config)
+        self.assertIsNot(a, b)
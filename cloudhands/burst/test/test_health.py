@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import unittest
+
+from cloudhands.burst.health import Breaker
+from cloudhands.burst.health import CircuitOpen
+from cloudhands.burst.health import Health
+
+
+class BreakerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = Breaker("cloudhands.jasmin.vcloud.phase04.cfg")
+
+    def trip(self, now=0):
+        for i in range(Breaker.threshold):
+            self.breaker.failure(now=now)
+
+    def test_opens_after_threshold(self):
+        self.breaker.failure(now=0)
+        self.assertEqual("closed", self.breaker.state(now=0))
+        self.trip()
+        self.assertEqual("open", self.breaker.state(now=1))
+        self.assertFalse(self.breaker.allow(now=1))
+        self.assertEqual(Breaker.backoff - 1, self.breaker.remaining(now=1))
+
+    def test_one_probe_when_half_open(self):
+        self.trip()
+        now = Breaker.backoff
+        self.assertEqual("half_open", self.breaker.state(now=now))
+        self.assertTrue(self.breaker.ready(now=now))
+        self.assertTrue(self.breaker.allow(now=now))
+        self.assertFalse(self.breaker.ready(now=now))
+        self.assertFalse(self.breaker.allow(now=now))
+
+    def test_successful_probe_closes(self):
+        self.trip()
+        self.breaker.allow(now=Breaker.backoff)
+        self.breaker.success()
+        self.assertEqual("closed", self.breaker.state())
+        self.assertEqual(Breaker.backoff, self.breaker.delay)
+
+    def test_failed_probe_backs_off(self):
+        self.trip()
+        self.breaker.allow(now=Breaker.backoff)
+        self.breaker.failure(now=Breaker.backoff)
+        self.assertEqual(2 * Breaker.backoff, self.breaker.delay)
+        self.assertEqual(
+            "open", self.breaker.state(now=2 * Breaker.backoff))
+
+    def test_release_frees_the_probe(self):
+        self.trip()
+        self.breaker.allow(now=Breaker.backoff)
+        self.breaker.release()
+        self.assertTrue(self.breaker.ready(now=Breaker.backoff))
+        self.assertEqual(Breaker.backoff, self.breaker.delay)
+
+    def test_backoff_ceiling(self):
+        self.trip()
+        for i in range(20):
+            now = i * Breaker.ceiling
+            self.breaker.allow(now=now)
+            self.breaker.failure(now=now)
+        self.assertEqual(Breaker.ceiling, self.breaker.delay)
+
+    def test_context_manager(self):
+        for i in range(Breaker.threshold):
+            with self.assertRaises(ConnectionRefusedError):
+                with self.breaker:
+                    raise ConnectionRefusedError()
+        with self.assertRaises(CircuitOpen):
+            with self.breaker:
+                pass
+
+    def test_context_manager_counts_answers_as_success(self):
+        self.breaker.failure()
+        with self.assertRaises(ValueError):
+            with self.breaker:
+                raise ValueError()
+        self.assertEqual(0, self.breaker.failures)
+
+
+class HealthTests(unittest.TestCase):
+
+    def setUp(self):
+        Health().breakers.clear()
+
+    def tearDown(self):
+        Health().breakers.clear()
+
+    def test_breaker_shared(self):
+        Health()("cloudhands.jasmin.vcloud.phase04.cfg").failure()
+        self.assertEqual(
+            1, Health()("cloudhands.jasmin.vcloud.phase04.cfg").failures)
+        self.assertEqual(
+            {"cloudhands.jasmin.vcloud.phase04.cfg": "closed"},
+            Health().report())
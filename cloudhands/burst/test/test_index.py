@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import datetime
+import sqlite3
+import unittest
+
+from cloudhands.burst.index import create
+from cloudhands.burst.index import discard
+from cloudhands.burst.index import lookup
+from cloudhands.burst.index import upsert
+
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+
+
+class TemplateIndexTests(unittest.TestCase):
+
+    entries = [
+        {"catalogue": "Public catalog", "name": "CentOS6.5",
+         "href": "https://cloud/api/vAppTemplate/1",
+         "vms": [{"href": "https://cloud/api/vAppTemplate/vm-1",
+                  "networks": ["un-managed-external-network"]}]},
+        {"catalogue": "un-managed_tenancy_test_org", "name": "CentOS6.5",
+         "href": "https://cloud/api/vAppTemplate/2",
+         "vms": [{"href": "https://cloud/api/vAppTemplate/vm-2",
+                  "networks": []}]},
+    ]
+
+    def setUp(self):
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        initialise(self.session)
+        create(self.session)
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, ":memory:")
+
+    def test_missing_template(self):
+        self.assertIsNone(lookup(self.session, "JASMIN private DC", "CentOS6.5"))
+
+    def test_lookup_by_catalogue(self):
+        upsert(
+            self.session, "JASMIN private DC", self.entries,
+            datetime.datetime.utcnow())
+        rv = lookup(
+            self.session, "JASMIN private DC", "CentOS6.5",
+            ["un-managed_tenancy_test_org"])
+        self.assertEqual("https://cloud/api/vAppTemplate/2", rv["href"])
+        self.assertIsNone(
+            lookup(self.session, "JASMIN burst partner", "CentOS6.5"))
+
+    def test_upsert_replaces_entry(self):
+        upsert(
+            self.session, "JASMIN private DC", self.entries[:1],
+            datetime.datetime.utcnow())
+        entry = dict(self.entries[0], href="https://cloud/api/vAppTemplate/3")
+        upsert(
+            self.session, "JASMIN private DC", [entry],
+            datetime.datetime.utcnow())
+        rv = lookup(
+            self.session, "JASMIN private DC", "CentOS6.5", ["Public catalog"])
+        self.assertEqual("https://cloud/api/vAppTemplate/3", rv["href"])
+
+    def test_upsert_drops_missing_entries(self):
+        upsert(
+            self.session, "JASMIN private DC", self.entries,
+            datetime.datetime.utcnow())
+        entry = dict(self.entries[0], name="Ubuntu 12.04 LTS")
+        upsert(
+            self.session, "JASMIN private DC", [entry],
+            datetime.datetime.utcnow(), {"un-managed_tenancy_test_org"})
+        self.assertIsNone(lookup(
+            self.session, "JASMIN private DC", "CentOS6.5",
+            ["Public catalog"]))
+        self.assertIsNotNone(lookup(
+            self.session, "JASMIN private DC", "CentOS6.5",
+            ["un-managed_tenancy_test_org"]))
+
+    def test_upsert_drops_emptied_catalogues(self):
+        upsert(
+            self.session, "JASMIN private DC", self.entries,
+            datetime.datetime.utcnow())
+        upsert(
+            self.session, "JASMIN private DC", [],
+            datetime.datetime.utcnow(), {"Public catalog"})
+        self.assertIsNone(lookup(
+            self.session, "JASMIN private DC", "CentOS6.5",
+            ["un-managed_tenancy_test_org"]))
+        self.assertIsNotNone(lookup(
+            self.session, "JASMIN private DC", "CentOS6.5",
+            ["Public catalog"]))
+
+    def test_discard(self):
+        upsert(
+            self.session, "JASMIN private DC", self.entries,
+            datetime.datetime.utcnow())
+        self.assertEqual(1, discard(
+            self.session, "JASMIN private DC",
+            "https://cloud/api/vAppTemplate/2"))
+        rv = lookup(self.session, "JASMIN private DC", "CentOS6.5")
+        self.assertEqual("https://cloud/api/vAppTemplate/1", rv["href"])
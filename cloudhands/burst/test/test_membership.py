@@ -7,8 +7,14 @@ import sqlite3
 import unittest
 import uuid
 
+from cloudhands.burst.activation import activated
 from cloudhands.burst.agent import message_handler
+from cloudhands.burst.index import create
 from cloudhands.burst.membership import AcceptedAgent
+from cloudhands.burst.membership import AdminRefs
+from cloudhands.burst.membership import activate
+from cloudhands.burst.test import fakes
+from cloudhands.burst.test.fakes import Response
 
 import cloudhands.common
 from cloudhands.common.connectors import initialise
@@ -34,12 +40,156 @@ from cloudhands.common.states import MembershipState
 from cloudhands.common.states import RegistrationState
 
 
+xml_admin = """
+<VCloud xmlns="http://www.vmware.com/vcloud/v1.5">
+    <OrganizationReferences>
+        <OrganizationReference href="https://cloud/api/admin/org/1"
+name="un-managed_tenancy_test_org"
+type="application/vnd.vmware.admin.organization+xml"/>
+    </OrganizationReferences>
+    <RoleReferences>
+        <RoleReference href="https://cloud/api/admin/role/1"
+name="vApp User" type="application/vnd.vmware.admin.role+xml"/>
+    </RoleReferences>
+</VCloud>
+"""
+
+xml_admin_org = """
+<AdminOrg xmlns="http://www.vmware.com/vcloud/v1.5"
+href="https://cloud/api/admin/org/1" name="un-managed_tenancy_test_org">
+    <Users>
+        <Link href="https://cloud/api/admin/org/1/users" rel="add"
+type="application/vnd.vmware.admin.user+xml"/>
+    </Users>
+</AdminOrg>
+"""
+
+xml_user = """
+<User xmlns="http://www.vmware.com/vcloud/v1.5" name="{0}"/>
+"""
+
+xml_duplicate = """
+<Error xmlns="http://www.vmware.com/vcloud/v1.5" majorErrorCode="400"
+message="User with the name {0} already exists"
+minorErrorCode="DUPLICATE_NAME"/>
+"""
+
+xml_error = """
+<Error xmlns="http://www.vmware.com/vcloud/v1.5" majorErrorCode="403"
+message="Access denied" minorErrorCode="ACCESS_TO_RESOURCE_IS_FORBIDDEN"/>
+"""
+
+
+class Client(fakes.Client):
+
+    def __init__(self, existing=(), refused=()):
+        super().__init__()
+        self.existing = existing
+        self.refused = refused
+
+    def reply(self, method, url, **kwargs):
+        if url.endswith("api/sessions"):
+            return Response("", {"x-vcloud-authorization": "valid"})
+        elif url.endswith("api/admin"):
+            return Response(xml_admin)
+        elif url.endswith("org/1"):
+            return Response(xml_admin_org)
+        elif kwargs["data"] in self.existing:
+            return Response(xml_duplicate.format(kwargs["data"]))
+        elif kwargs["data"] in self.refused:
+            return Response(xml_error)
+        else:
+            return Response(xml_user.format(kwargs["data"]))
+
+
+class Payloads:
+
+    def render(self, template, **kwargs):
+        return kwargs["user"]["name"]
+
+
+class AdminRefsTesting(unittest.TestCase):
+
+    def setUp(self):
+        AdminRefs().refs.clear()
+
+    def tearDown(self):
+        AdminRefs().refs.clear()
+        AdminRefs.ttl = 600
+
+    def test_refs_are_shared(self):
+        AdminRefs().put(
+            "cloudhands.jasmin.vcloud.phase04.cfg",
+            "https://cloud/api/admin/role/1", "https://cloud/api/admin/org/1/users")
+        self.assertEqual(
+            ("https://cloud/api/admin/role/1",
+             "https://cloud/api/admin/org/1/users"),
+            AdminRefs().get("cloudhands.jasmin.vcloud.phase04.cfg"))
+
+    def test_invalidate(self):
+        refs = AdminRefs()
+        refs.put("cloudhands.jasmin.vcloud.phase04.cfg", "role", "users")
+        refs.invalidate("cloudhands.jasmin.vcloud.phase04.cfg")
+        self.assertIsNone(refs.get("cloudhands.jasmin.vcloud.phase04.cfg"))
+
+    def test_expiry(self):
+        AdminRefs.ttl = -1
+        refs = AdminRefs()
+        refs.put("cloudhands.jasmin.vcloud.phase04.cfg", "role", "users")
+        self.assertIsNone(refs.get("cloudhands.jasmin.vcloud.phase04.cfg"))
+
+
+class ActivateTesting(unittest.TestCase):
+
+    config = {
+        "host": {"name": "cloud", "port": "443"},
+        "metadata": {"path": "cloudhands.jasmin.vcloud.phase04.cfg"},
+        "user": {"name": "admin", "pass": "secret"},
+        "vdc": {"org": "un-managed_tenancy_test_org"},
+    }
+
+    def setUp(self):
+        AdminRefs().refs.clear()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        AdminRefs().refs.clear()
+        self.loop.close()
+
+    def test_one_session_for_many_users(self):
+        client = Client(existing=("user02",), refused=("user03",))
+        usernames = ["user{:02}".format(i) for i in range(5)]
+        rv = self.loop.run_until_complete(
+            activate(client, self.config, usernames, Payloads(), 2))
+        self.assertEqual([True, True, True, False, True], rv)
+        self.assertEqual(
+            1, len([i for i in client.requests if i[1].endswith("sessions")]))
+        self.assertEqual(
+            1, len([i for i in client.requests if i[1].endswith("admin")]))
+
+    def test_session_response_released(self):
+        client = Client()
+        self.loop.run_until_complete(
+            activate(client, self.config, ["user01"], Payloads()))
+        self.assertTrue(client.requests[0][1].endswith("sessions"))
+        self.assertTrue(client.responses[0].closed)
+
+    def test_admin_refs_reused(self):
+        client = Client()
+        for username in ("user01", "user02"):
+            self.loop.run_until_complete(
+                activate(client, self.config, [username], Payloads()))
+        self.assertEqual(
+            1, len([i for i in client.requests if i[1].endswith("admin")]))
+
+
 class AgentTesting(unittest.TestCase):
 
     def setUp(self):
         """ Populate test database"""
         self.session = Registry().connect(sqlite3, ":memory:").session
         initialise(self.session)
+        create(self.session)
         self.session.add_all((
             Organisation(
                 uuid=uuid.uuid4().hex,
@@ -95,6 +245,11 @@ class AcceptedAgentTesting(AgentTesting):
             agent.touch_to_previous,
             message_handler.dispatch(AcceptedAgent.MembershipNotActivated)
         )
+        self.assertEqual(
+            agent.touch_to_partial,
+            message_handler.dispatch(
+                AcceptedAgent.MembershipPartiallyActivated)
+        )
 
     def test_job_query_and_transmit_needs_registration(self):
         q = AcceptedAgent.queue(None, None, loop=None)
@@ -126,6 +281,23 @@ class AcceptedAgentTesting(AgentTesting):
         job = q.get_nowait()
         self.assertEqual(1, len(job.artifact.changes))
 
+    def test_job_query_needs_registration_of_member(self):
+        reg = Registration(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__)
+        other = User(handle="otheruser", uuid=uuid.uuid4().hex)
+        valid = self.session.query(
+            RegistrationState).filter(
+            RegistrationState.name=="pre_user_ldappublickey").one()
+        now = datetime.datetime.utcnow()
+        act = Touch(artifact=reg, actor=other, state=valid, at=now)
+        self.session.add_all((other, reg, act))
+        self.session.commit()
+
+        agent = AcceptedAgent(
+            AcceptedAgent.queue(None, None, loop=None), args=None, config=None)
+        self.assertEqual([], agent.jobs(self.session))
+
     def test_queue_creation(self):
         self.assertIsInstance(
             AcceptedAgent.queue(None, None, loop=None),
@@ -166,3 +338,25 @@ class AcceptedAgentTesting(AgentTesting):
         rv = message_handler(msg, self.session)
         self.assertIsInstance(rv, Touch)
         self.assertIs(rv.state, accepted)
+
+    def test_msg_dispatch_and_touch_partially_activated(self):
+        mship = self.session.query(Membership).one()
+        accepted = self.session.query(
+            MembershipState).filter(
+            MembershipState.name == "accepted").one()
+
+        q = AcceptedAgent.queue(None, None, loop=None)
+        agent = AcceptedAgent(q, args=None, config=None)
+        for typ, handler in agent.callbacks:
+            message_handler.register(typ, handler)
+
+        msg = AcceptedAgent.MembershipPartiallyActivated(
+            mship.uuid, datetime.datetime.utcnow(),
+            ("cloudhands.jasmin.vcloud.phase04.cfg",),
+            ("cloudhands.jasmin.vcloud.phase05.cfg",))
+        rv = message_handler(msg, self.session)
+        self.assertIsInstance(rv, Touch)
+        self.assertIs(rv.state, accepted)
+        self.assertEqual(
+            {"cloudhands.jasmin.vcloud.phase04.cfg"},
+            activated(self.session, mship.uuid))
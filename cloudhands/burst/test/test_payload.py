@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import unittest
+import xml.etree.ElementTree as ET
+
+from cloudhands.burst.payload import Payloads
+
+
+class PayloadsTests(unittest.TestCase):
+
+    def test_names_from_package(self):
+        names = Payloads().names
+        self.assertIn("ComposeVAppParams", names)
+        self.assertIn("DeployVAppParams", names)
+        self.assertIn("User", names)
+        self.assertFalse(any(i.endswith(".pt") for i in names))
+
+    def test_templates_compiled_once(self):
+        tmplt = Payloads()["NatRule"]
+        self.assertIs(tmplt, Payloads()["NatRule.pt"])
+
+    def test_registry_is_shared(self):
+        a = Payloads()
+        b = Payloads()
+        self.assertIs(a.templates, b.templates)
+
+    def test_registry_per_package(self):
+        a = Payloads()
+        b = Payloads("cloudhands.burst.drivers.test")
+        self.assertIsNot(a.templates, b.templates)
+
+    def test_render_bytes(self):
+        rv = Payloads().render("UndeployVAppParams", action="powerOff")
+        self.assertIsInstance(rv, bytes)
+        tree = ET.fromstring(rv)
+        self.assertTrue(tree.tag.endswith("UndeployVAppParams"))
+        self.assertEqual("powerOff", tree[0].text)
+
+    def test_render_user_escapes_name(self):
+        rv = Payloads().render(
+            "User",
+            user={"name": "<&>"},
+            role={"href": "http://cloud/api/admin/role/1"})
+        tree = ET.fromstring(rv)
+        self.assertEqual("<&>", tree.attrib.get("name"))
+        role = next(i for i in tree if i.tag.endswith("Role"))
+        self.assertEqual(
+            "http://cloud/api/admin/role/1", role.attrib.get("href"))
+
+    def test_compile_all(self):
+        payloads = Payloads().compile()
+        self.assertEqual(
+            set(payloads.names), set(payloads.templates.keys()))
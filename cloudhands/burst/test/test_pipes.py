@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+import os
+import pickle
+import tempfile
+import unittest
+
+from cloudhands.burst.pipes import PipeReader
+
+
+class PipeReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "test.fifo")
+        os.mkfifo(self.path)
+        self.reader = PipeReader(self.path, loop=self.loop).open()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def tearDown(self):
+        os.close(self.fd)
+        self.reader.close()
+        self.dir.cleanup()
+        self.loop.close()
+
+    def test_batch(self):
+        for i in range(3):
+            os.write(self.fd, pickle.dumps(("uuid", i)))
+        rv = self.loop.run_until_complete(
+            asyncio.wait_for(self.reader.get(), 2, loop=self.loop))
+        self.assertEqual([("uuid", 0), ("uuid", 1), ("uuid", 2)], rv)
+
+    def test_partial_write(self):
+        data = pickle.dumps(("uuid", "provider", "user", "pass"))
+        os.write(self.fd, data[:5])
+        self.loop.call_later(0.1, os.write, self.fd, data[5:])
+        rv = self.loop.run_until_complete(
+            asyncio.wait_for(self.reader.get(), 2, loop=self.loop))
+        self.assertEqual([("uuid", "provider", "user", "pass")], rv)
+        self.assertEqual(2, self.reader.reads)
+
+    def test_corrupt_data_discarded(self):
+        os.write(self.fd, b"\x00garbage")
+        self.loop.call_later(0.1, os.write, self.fd, pickle.dumps("valid"))
+        rv = self.loop.run_until_complete(
+            asyncio.wait_for(self.reader.get(), 2, loop=self.loop))
+        self.assertEqual(["valid"], rv)
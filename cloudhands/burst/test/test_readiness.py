@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+from collections import namedtuple
+import datetime
+import unittest
+
+from cloudhands.burst.readiness import PollSchedule
+from cloudhands.burst.readiness import provisioning_started
+
+State = namedtuple("State", ["name"])
+Act = namedtuple("Act", ["state", "at"])
+
+
+class PollScheduleTests(unittest.TestCase):
+
+    key = ("Ubuntu 14.04 Server", "cloudhands.jasmin.vcloud.phase04.cfg")
+
+    def setUp(self):
+        PollSchedule._shared_state.clear()
+
+    def tearDown(self):
+        PollSchedule._shared_state.clear()
+
+    def test_first_interval_is_initial_estimate(self):
+        schedule = PollSchedule()
+        self.assertEqual(
+            PollSchedule.initial, schedule.interval("a", self.key))
+
+    def test_observation_moves_estimate(self):
+        schedule = PollSchedule()
+        self.assertEqual(90, schedule.observe(self.key, 90))
+        rv = schedule.observe(self.key, 60)
+        self.assertTrue(60 < rv < 90)
+        self.assertEqual(rv, schedule.interval("a", self.key))
+
+    def test_estimate_is_bounded(self):
+        schedule = PollSchedule()
+        self.assertEqual(PollSchedule.floor, schedule.observe(self.key, 0))
+        self.assertEqual(
+            PollSchedule.ceiling, schedule.observe(("x", "y"), 10 ** 6))
+
+    def test_backoff_after_deferral(self):
+        schedule = PollSchedule()
+        intervals = []
+        for n in range(12):
+            schedule.defer("a")
+            intervals.append(schedule.interval("a", self.key))
+        self.assertEqual(sorted(intervals), intervals)
+        self.assertEqual(PollSchedule.ceiling, intervals[-1])
+
+    def test_due(self):
+        schedule = PollSchedule()
+        now = datetime.datetime.utcnow()
+        self.assertFalse(schedule.due("a", self.key, now, now))
+        then = now - datetime.timedelta(seconds=PollSchedule.initial)
+        self.assertTrue(schedule.due("a", self.key, then, now))
+
+    def test_forget(self):
+        schedule = PollSchedule()
+        schedule.defer("a")
+        schedule.track("a", "https://cloud/api/task/1")
+        schedule.forget("a")
+        self.assertNotIn("a", schedule.attempts)
+        self.assertNotIn("a", schedule.tasks)
+
+
+class ProvisioningStartedTests(unittest.TestCase):
+
+    def test_start_of_latest_run(self):
+        now = datetime.datetime.utcnow()
+        changes = [
+            Act(State(name), now + datetime.timedelta(seconds=n))
+            for n, name in enumerate((
+                "pre_provision", "provisioning", "pre_check", "provisioning",
+                "pre_provision", "provisioning", "provisioning", "pre_check"))
+        ]
+        self.assertEqual(changes[5].at, provisioning_started(changes))
+
+    def test_never_provisioned(self):
+        now = datetime.datetime.utcnow()
+        self.assertIsNone(
+            provisioning_started([Act(State("requested"), now)]))
@@ -38,6 +38,16 @@ class SessionAgentTesting(AgentTesting):
             message_handler.dispatch(SessionAgent.Message)
         )
 
+    def test_refused_credentials_expire(self):
+        agent = SessionAgent(asyncio.Queue(), args=None, config=None)
+        creds = agent.credentials(
+            "cloudhands.jasmin.vcloud.phase04.cfg", "testuser", "secret")
+        self.assertNotIn("secret", creds)
+        agent.refused[creds] = 10 + agent.refusal
+        self.assertTrue(agent.is_refused(creds, 10))
+        self.assertFalse(agent.is_refused(creds, 10 + agent.refusal))
+        self.assertNotIn(creds, agent.refused)
+
     def test_job_creation(self):
         session = Registry().connect(sqlite3, ":memory:").session
         with tempfile.TemporaryDirectory() as td:
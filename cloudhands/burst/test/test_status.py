@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+import unittest
+import xml.etree.ElementTree as ET
+
+from cloudhands.burst.status import find_vapprecords
+from cloudhands.burst.status import StatusPoller
+from cloudhands.burst.test.fakes import Client
+
+xml_queryresultrecords_vapp = """
+<QueryResultRecords xmlns="http://www.vmware.com/vcloud/v1.5"
+href="https://cloud/api/query?type=vApp&amp;page=1&amp;pageSize=2&amp;format=records"
+name="vApp" page="1" pageSize="2" total="3"
+type="application/vnd.vmware.vcloud.query.records+xml">
+    <Link href="https://cloud/api/query?type=vApp&amp;page=2&amp;pageSize=2&amp;format=records"
+rel="nextPage" type="application/vnd.vmware.vcloud.query.records+xml" />
+    <VAppRecord href="https://cloud/api/vApp/vapp-1" name="test_01"
+isBusy="false" isDeployed="true" status="POWERED_ON" />
+    <VAppRecord href="https://cloud/api/vApp/vapp-2" name="test_02"
+isBusy="true" isDeployed="false" status="UNRESOLVED" />
+</QueryResultRecords>
+"""
+
+xml_queryresultrecords_vapp_last = """
+<QueryResultRecords xmlns="http://www.vmware.com/vcloud/v1.5"
+name="vApp" page="2" pageSize="2" total="3"
+type="application/vnd.vmware.vcloud.query.records+xml">
+    <VAppRecord href="https://cloud/api/vApp/vapp-3" name="test_03"
+isBusy="false" isDeployed="false" status="POWERED_OFF" />
+</QueryResultRecords>
+"""
+
+
+class StatusPollerTests(unittest.TestCase):
+
+    config = {
+        "host": {"name": "cloud", "port": "443"},
+        "metadata": {"path": "cloudhands.jasmin.vcloud.phase04.cfg"},
+    }
+
+    def setUp(self):
+        StatusPoller().records.clear()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_find_records(self):
+        tree = ET.fromstring(xml_queryresultrecords_vapp)
+        self.assertEqual(2, len(list(find_vapprecords(tree))))
+
+    def test_busy(self):
+        self.assertTrue(StatusPoller.busy({"isBusy": "true"}))
+        self.assertTrue(StatusPoller.busy({"status": "UNRESOLVED"}))
+        self.assertFalse(
+            StatusPoller.busy({"isBusy": "false", "status": "POWERED_ON"}))
+
+    def test_fetch_follows_pages(self):
+        client = Client(
+            xml_queryresultrecords_vapp, xml_queryresultrecords_vapp_last)
+        rv = self.loop.run_until_complete(
+            StatusPoller().fetch(client, {}, self.config))
+        self.assertEqual(3, len(rv))
+        self.assertEqual(2, len(client.requests))
+        self.assertIn("page=2", client.requests[1][1])
+
+    def test_records_shared_between_lookups(self):
+        client = Client(
+            xml_queryresultrecords_vapp, xml_queryresultrecords_vapp_last)
+        poller = StatusPoller()
+        token = ("cloudhands.jasmin.vcloud.phase04.cfg", "T-Auth", "valid")
+        rv = self.loop.run_until_complete(asyncio.gather(*[
+            poller(client, {}, self.config, token,
+                   "https://cloud/api/vApp/vapp-{}".format(n), loop=self.loop)
+            for n in (1, 2, 3, 4)], loop=self.loop))
+        self.assertEqual(2, len(client.requests))
+        self.assertEqual("test_01", rv[0]["name"])
+        self.assertTrue(poller.busy(rv[1]))
+        self.assertIsNone(rv[3])
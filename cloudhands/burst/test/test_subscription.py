@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 # encoding: UTF-8
 
+import asyncio
 import datetime
 import sqlite3
 import unittest
 import uuid
 
+from cloudhands.burst.agent import message_handler
+from cloudhands.burst.index import create
+from cloudhands.burst.index import lookup
 from cloudhands.burst.subscription import Catalogue
+from cloudhands.burst.subscription import Catalogues
 from cloudhands.burst.subscription import Online
+from cloudhands.burst.subscription import UncheckedAgent
 
 import cloudhands.common
 from cloudhands.common.connectors import initialise
@@ -41,6 +47,24 @@ class SubscriptionLifecycleTests(unittest.TestCase):
     def tearDown(self):
         Registry().disconnect(sqlite3, ":memory:")
 
+    def unchecked_subscription(self):
+        subs = Subscription(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=self.org,
+            provider=self.providers[0])
+        puppet = Component(handle="config management", uuid=uuid.uuid4().hex)
+        unchecked = self.session.query(
+            SubscriptionState).filter(SubscriptionState.name=="unchecked").one()
+        subs.changes.append(
+            Touch(
+                artifact=subs, actor=puppet, state=unchecked,
+                at=datetime.datetime.utcnow())
+            )
+        self.session.add_all([puppet, subs])
+        self.session.commit()
+        return subs
+
 
 class OnlineTests(SubscriptionLifecycleTests):
 
@@ -99,21 +123,7 @@ class CatalogueTests(SubscriptionLifecycleTests):
 
     def setUp(self):
         super().setUp()
-        self.subs = Subscription(
-            uuid=uuid.uuid4().hex,
-            model=cloudhands.common.__version__,
-            organisation=self.org,
-            provider=self.providers[0])
-        puppet = Component(handle="config management", uuid=uuid.uuid4().hex)
-        unchecked = self.session.query(
-            SubscriptionState).filter(SubscriptionState.name=="unchecked").one()
-        self.subs.changes.append(
-            Touch(
-                artifact=self.subs, actor=puppet, state=unchecked,
-                at=datetime.datetime.utcnow())
-            )
-        self.session.add_all([puppet, self.subs])
-        self.session.commit()
+        self.subs = self.unchecked_subscription()
 
     def test_calling_catalogue_makes_active(self):
         actor = Component(handle="Maintenence", uuid=uuid.uuid4().hex)
@@ -133,6 +143,43 @@ class CatalogueTests(SubscriptionLifecycleTests):
             self.assertEqual("active", act.state.name)
             self.assertEqual(2, len(act.resources))
 
+    def test_catalogue_records_new_images(self):
+        actor = Component(handle="Maintenence", uuid=uuid.uuid4().hex)
+        images = [
+            ("CentOS6.5", "https://cloud/api/vAppTemplate/1"),
+            ("Ubuntu 12.04 LTS", "https://cloud/api/vAppTemplate/2"),
+            ("Ubuntu 12.04 LTS", "https://cloud/api/vAppTemplate/3"),
+        ]
+        act = Catalogue(actor, self.subs, images[:1])(self.session)
+        self.assertEqual(1, len(act.resources))
+
+        unchecked = self.session.query(
+            SubscriptionState).filter(
+            SubscriptionState.name=="unchecked").one()
+        now = datetime.datetime.utcnow()
+        self.session.add(
+            Touch(artifact=self.subs, actor=actor, state=unchecked, at=now))
+        self.session.commit()
+
+        act = Catalogue(actor, self.subs, images)(self.session)
+        self.assertEqual(["Ubuntu 12.04 LTS"], [i.name for i in act.resources])
+        self.assertIs(act, self.subs.changes[-1])
+
+    def test_catalogue_repeated_adds_no_images(self):
+        actor = Component(handle="Maintenence", uuid=uuid.uuid4().hex)
+        images = [("CentOS6.5", "https://cloud/api/vAppTemplate/1")]
+        unchecked = self.session.query(
+            SubscriptionState).filter(
+            SubscriptionState.name=="unchecked").one()
+        for n in range(3):
+            Catalogue(actor, self.subs, images)(self.session)
+            now = datetime.datetime.utcnow()
+            self.session.add(
+                Touch(artifact=self.subs, actor=actor, state=unchecked, at=now))
+            self.session.commit()
+
+        self.assertEqual(1, self.session.query(OSImage).count())
+
     def test_catalogue_from_invalid_state(self):
         actor = Component(handle="Maintenence", uuid=uuid.uuid4().hex)
         unchecked = self.session.query(
@@ -153,3 +200,98 @@ class CatalogueTests(SubscriptionLifecycleTests):
             act = Catalogue(actor, subs)(self.session)
             self.assertIs(None, act)
 
+
+class CataloguesTests(unittest.TestCase):
+
+    def setUp(self):
+        Catalogues().listings.clear()
+
+    def tearDown(self):
+        Catalogues().listings.clear()
+
+    def test_unchanged_catalogue_is_remembered(self):
+        catalogues = Catalogues()
+        catalogues.merge("JASMIN private DC", {
+            "https://cloud/api/catalog/1": ("v1", [
+                ("CentOS6.5", "https://cloud/api/vAppTemplate/1")]),
+        })
+        self.assertEqual(
+            {"https://cloud/api/catalog/1": "v1"},
+            catalogues.fingerprints("JASMIN private DC"))
+        rv = catalogues.merge("JASMIN private DC", {
+            "https://cloud/api/catalog/1": ("v1", None),
+            "https://cloud/api/vdc/1": ("v1", [
+                ("Ubuntu 12.04 LTS", "https://cloud/api/vAppTemplate/2")]),
+        })
+        self.assertEqual(
+            ["CentOS6.5", "Ubuntu 12.04 LTS"], [n for n, i in rv])
+
+
+class UncheckedAgentTests(SubscriptionLifecycleTests):
+
+    def setUp(self):
+        super().setUp()
+        self.subs = self.unchecked_subscription()
+        self.session.add(Component(
+            handle="burst.controller", uuid=uuid.uuid4().hex))
+        self.session.commit()
+
+    def test_handler_registration(self):
+        agent = UncheckedAgent(asyncio.Queue(), args=None, config=None)
+        for typ, handler in agent.callbacks:
+            message_handler.register(typ, handler)
+        self.assertEqual(
+            agent.touch_to_active,
+            message_handler.dispatch(UncheckedAgent.Catalogued))
+        self.assertEqual(
+            agent.touch_to_previous,
+            message_handler.dispatch(UncheckedAgent.NotCatalogued))
+
+    def test_jobs(self):
+        agent = UncheckedAgent(asyncio.Queue(), args=None, config=None)
+        jobs = agent.jobs(self.session)
+        self.assertEqual([self.subs.uuid], [i.uuid for i in jobs])
+
+    def test_msg_dispatch_and_touch(self):
+        agent = UncheckedAgent(asyncio.Queue(), args=None, config=None)
+        for typ, handler in agent.callbacks:
+            message_handler.register(typ, handler)
+        msg = UncheckedAgent.Catalogued(
+            self.subs.uuid, datetime.datetime.utcnow(),
+            self.providers[0].name,
+            (("CentOS6.5", "https://cloud/api/vAppTemplate/1"),), None, ())
+        rv = message_handler(msg, self.session)
+        self.assertIsInstance(rv, Touch)
+        self.assertEqual("active", self.subs.changes[-1].state.name)
+        self.assertEqual(["CentOS6.5"], [i.name for i in rv.resources])
+
+    def test_msg_for_checked_subscription(self):
+        agent = UncheckedAgent(asyncio.Queue(), args=None, config=None)
+        for typ, handler in agent.callbacks:
+            message_handler.register(typ, handler)
+        msg = UncheckedAgent.Catalogued(
+            self.subs.uuid, datetime.datetime.utcnow(),
+            self.providers[0].name, (), None, ())
+        act = message_handler(msg, self.session)
+        rv = message_handler(msg, self.session)
+        self.assertIs(act, rv)
+        self.assertIs(rv, self.subs.changes[-1])
+
+    def test_msg_updates_template_index(self):
+        create(self.session)
+        agent = UncheckedAgent(asyncio.Queue(), args=None, config=None)
+        for typ, handler in agent.callbacks:
+            message_handler.register(typ, handler)
+        msg = UncheckedAgent.Catalogued(
+            self.subs.uuid, datetime.datetime.utcnow(),
+            self.providers[0].name,
+            (("CentOS6.5", "https://cloud/api/vAppTemplate/1"),),
+            ({"catalogue": "Public catalog", "name": "CentOS6.5",
+              "href": "https://cloud/api/vAppTemplate/1",
+              "vms": [{"href": "https://cloud/api/vAppTemplate/vm-1",
+                       "networks": ["un-managed-external-network"]}]},),
+            ())
+        message_handler(msg, self.session)
+        rv = lookup(self.session, self.providers[0].name, "CentOS6.5")
+        self.assertEqual("https://cloud/api/vAppTemplate/1", rv["href"])
+        self.assertEqual(["un-managed-external-network"], rv["networks"])
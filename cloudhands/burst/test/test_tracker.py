@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+from collections import namedtuple
+import unittest
+from unittest.mock import patch
+
+from cloudhands.burst.tracker import TaskError
+from cloudhands.burst.test.fakes import Client
+from cloudhands.burst.tracker import TaskTracker
+from cloudhands.burst.tracker import when_complete
+
+xml_queryresultrecords_task = """
+<QueryResultRecords xmlns="http://www.vmware.com/vcloud/v1.5"
+name="task" page="1" pageSize="128" total="2"
+type="application/vnd.vmware.vcloud.query.records+xml">
+    <TaskRecord href="https://cloud/api/task/1" name="vdcComposeVapp"
+status="{0}" />
+    <TaskRecord href="https://cloud/api/task/2" name="vappDeploy"
+status="{1}" />
+</QueryResultRecords>
+"""
+
+xml_task_error = """
+<Task xmlns="http://www.vmware.com/vcloud/v1.5"
+href="https://cloud/api/task/2" status="error">
+    <Error majorErrorCode="500" message="Insufficient resources"
+minorErrorCode="INTERNAL_SERVER_ERROR" />
+</Task>
+"""
+
+
+class TaskTrackerTests(unittest.TestCase):
+
+    config = {
+        "host": {"name": "cloud", "port": "443"},
+        "metadata": {"path": "cloudhands.jasmin.vcloud.phase04.cfg"},
+    }
+
+    token = ("cloudhands.jasmin.vcloud.phase04.cfg", "T-Auth", "valid")
+
+    def setUp(self):
+        TaskTracker._shared_state.clear()
+        patcher = patch.object(TaskTracker, "floor", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        TaskTracker._shared_state.clear()
+        self.loop.close()
+
+    def test_tasks_polled_together(self):
+        client = Client(
+            xml_queryresultrecords_task.format("running", "running"),
+            xml_queryresultrecords_task.format("success", "running"),
+            xml_queryresultrecords_task.format("success", "error"),
+            xml_task_error)
+        tracker = TaskTracker()
+        futures = [
+            tracker.watch(
+                client, {"Content-Type": "text/xml"}, self.config,
+                self.token, "https://cloud/api/task/{}".format(n),
+                loop=self.loop)
+            for n in (1, 2)]
+        done, pending = self.loop.run_until_complete(
+            asyncio.wait(futures, loop=self.loop, timeout=5))
+        self.assertFalse(pending)
+        self.assertEqual("success", futures[0].result()["status"])
+        self.assertIsInstance(futures[1].exception(), TaskError)
+        self.assertEqual(
+            "Insufficient resources", futures[1].exception().message)
+        self.assertEqual(4, len(client.requests))
+        self.assertFalse(tracker.tasks)
+
+    def test_watch_is_idempotent(self):
+        client = Client(xml_queryresultrecords_task.format("success", "x"))
+        tracker = TaskTracker()
+        href = "https://cloud/api/task/1"
+        a = tracker.watch(
+            client, {}, self.config, self.token, href, loop=self.loop)
+        b = tracker.watch(
+            client, {}, self.config, self.token, href, loop=self.loop)
+        self.assertIs(a, b)
+        self.loop.run_until_complete(asyncio.wait_for(a, 5, loop=self.loop))
+        self.assertEqual(1, len(client.requests))
+
+
+class WhenCompleteTests(unittest.TestCase):
+
+    Message = namedtuple("Message", ["uuid"])
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.q = asyncio.Queue(loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_future(self, future):
+        self.loop.run_until_complete(when_complete(
+            future, self.q, self.Message("done"), self.Message("failed")))
+        return self.q.get_nowait()
+
+    def test_success_sends_message(self):
+        future = asyncio.Future(loop=self.loop)
+        future.set_result({"status": "success"})
+        self.assertEqual("done", self.run_future(future).uuid)
+
+    def test_failure_sends_failed_message(self):
+        future = asyncio.Future(loop=self.loop)
+        future.set_exception(TaskError(
+            "https://cloud/api/task/2", "error", "Insufficient resources"))
+        self.assertEqual("failed", self.run_future(future).uuid)
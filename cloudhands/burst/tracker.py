@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import asyncio
+import logging
+import time
+import xml.etree.ElementTree as ET
+
+from cloudhands.burst.utils import find_xpath
+
+__doc__ = """
+Many vCloud operations reply at once with a Task, and complete later.
+A :py:class:`TaskTracker` watches those Tasks on behalf of the agents, so
+that no agent need wait on one while it has other jobs to do.
+"""
+
+
+def find_taskrecords(tree):
+    return (i for i in find_xpath("./*", tree)
+            if i.tag.endswith("TaskRecord"))
+
+
+class TaskError(Exception):
+    """
+    Raised when a vCloud Task ends in any state other than `success`.
+    """
+
+    def __init__(self, href, status, message=None):
+        super().__init__(href, status, message)
+        self.href = href
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return "Task {0.href} ended with status {0.status}: {0.message}".format(
+            self)
+
+
+class TaskTracker:
+    """
+    Resolves a Future for each vCloud Task it is asked to watch.
+
+    The Tasks visible to each set of credentials are polled together
+    through the query API. Any which the query does not report are
+    fetched individually. The interval between polls starts at `floor`
+    seconds and grows by `factor` to at most `ceiling` while nothing
+    completes. It falls back to `floor` when something does.
+    """
+
+    _shared_state = {}
+
+    floor = 1
+    ceiling = 30
+    factor = 1.5
+    timeout = 600
+    pageSize = 128
+
+    finished = ("success", "error", "canceled", "aborted")
+
+    def __init__(self):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "tasks"):
+            self.tasks = {}
+            self.sources = {}
+            self.runners = {}
+
+    def watch(self, client, headers, config, token, href, loop=None):
+        """
+        Begin watching a Task.
+
+        :param tuple token: The credentials in `headers`, as supplied with
+            an agent's Job.
+        :param str href: The href of the Task.
+        :returns: A Future. Its result is the attributes of the Task when
+            it succeeds. Its exception is a :py:class:`TaskError` when
+            it does not.
+        """
+        key = (config["metadata"]["path"], token)
+        try:
+            future, started, owner = self.tasks[href]
+        except KeyError:
+            future = asyncio.Future(loop=loop)
+            self.tasks[href] = (future, time.time(), key)
+
+        self.sources[key] = (
+            client,
+            {k: v for k, v in headers.items() if k != "Content-Type"},
+            config)
+        runner = self.runners.get(key)
+        if runner is None or runner.done():
+            self.runners[key] = asyncio.Task(self.run(key, loop), loop=loop)
+        return future
+
+    def watching(self, key):
+        return [
+            href for href, (future, started, owner) in self.tasks.items()
+            if owner == key]
+
+    @asyncio.coroutine
+    def fetch(self, client, headers, config):
+        """
+        Query the Tasks visible to the credentials in `headers`.
+
+        :returns: A dictionary of record attributes keyed by Task href.
+        """
+        url = (
+            "{scheme}://{host}:{port}/{endpoint}"
+            "?type=task&format=records&pageSize={pageSize}"
+            "&sortDesc=startDate").format(
+            scheme="https",
+            host=config["host"]["name"],
+            port=config["host"]["port"],
+            endpoint="api/query",
+            pageSize=self.pageSize)
+        response = yield from client.request("GET", url, headers=headers)
+        data = yield from response.read_and_close()
+        tree = ET.fromstring(data.decode("utf-8"))
+        return {
+            i.attrib.get("href"): dict(i.attrib)
+            for i in find_taskrecords(tree)}
+
+    @asyncio.coroutine
+    def inspect(self, client, headers, href):
+        """
+        GET a single Task.
+
+        :returns: A tuple of its attributes and its error message, if any.
+        """
+        response = yield from client.request("GET", href, headers=headers)
+        data = yield from response.read_and_close()
+        tree = ET.fromstring(data.decode("utf-8"))
+        error = next(
+            (i for i in tree.iter() if i.tag.endswith("}Error")), None)
+        return (
+            dict(tree.attrib),
+            error.attrib.get("message") if error is not None else None)
+
+    def resolve(self, href, status, attribs, message=None):
+        future, started, key = self.tasks.pop(href)
+        if future.done():
+            return
+        elif status == "success":
+            future.set_result(attribs)
+        else:
+            future.set_exception(TaskError(href, status, message))
+
+    @asyncio.coroutine
+    def run(self, key, loop=None):
+        log = logging.getLogger("cloudhands.burst.tracker.run")
+        interval = self.floor
+        while self.watching(key):
+            yield from asyncio.sleep(interval, loop=loop)
+            client, headers, config = self.sources[key]
+            try:
+                records = yield from self.fetch(client, headers, config)
+            except Exception as e:
+                log.warning(e)
+                records = {}
+
+            progress = False
+            now = time.time()
+            for href in self.watching(key):
+                try:
+                    record = records.get(href)
+                    if record is None:
+                        record, message = yield from self.inspect(
+                            client, headers, href)
+                    else:
+                        message = None
+                except Exception as e:
+                    log.warning(e)
+                    continue
+
+                status = record.get("status")
+                if status in self.finished:
+                    if status != "success" and message is None:
+                        try:
+                            record, message = yield from self.inspect(
+                                client, headers, href)
+                        except Exception as e:
+                            log.warning(e)
+                    self.resolve(href, status, record, message)
+                    progress = True
+                elif now - self.tasks[href][1] > self.timeout:
+                    self.resolve(
+                        href, "timeout", record,
+                        "No result after {} seconds".format(self.timeout))
+                    progress = True
+
+            if progress:
+                interval = self.floor
+            else:
+                interval = min(self.ceiling, interval * self.factor)
+
+        self.runners.pop(key, None)
+
+
+@asyncio.coroutine
+def when_complete(future, msgQ, msg, failed=None):
+    """
+    Put a message on the queue once a Task succeeds, or the `failed`
+    message if it does not.
+    """
+    log = logging.getLogger("cloudhands.burst.tracker.when_complete")
+    try:
+        yield from future
+    except Exception as e:
+        log.error(e)
+        if failed is not None:
+            yield from msgQ.put(failed)
+    else:
+        yield from msgQ.put(msg)
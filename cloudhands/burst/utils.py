@@ -1,8 +1,19 @@
 #!/usr/bin/env python
 # encoding: UTF-8
 
+import hashlib
 import xml.sax.saxutils
 
+def fingerprint(version, hrefs):
+    """
+    Return a fingerprint for a catalogue from its version number and the
+    hrefs of its items.
+    """
+    digest = hashlib.sha1(
+        "\n".join(sorted(hrefs)).encode("utf-8")).hexdigest()
+    return "{}:{}:{}".format(version, len(hrefs), digest)
+
+
 def find_xpath(xpath, tree, namespaces={}, **kwargs):
     elements = tree.iterfind(xpath, namespaces=namespaces)
     if not kwargs:
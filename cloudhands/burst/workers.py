@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# encoding: UTF-8
+
+import atexit
+import concurrent.futures
+import logging
+
+__doc__ = """
+The libcloud driver is synchronous, so calls to it are made in worker
+processes. A :py:class:`WorkerPool` keeps those processes for the life of
+the program. Their imports and provider connections are made once.
+"""
+
+
+def warm():
+    """
+    Prepare a new worker process. Import the driver, and connect to each
+    provider in advance of the first job.
+    """
+    log = logging.getLogger("cloudhands.burst.workers.warm")
+    import cloudhands.burst.drivers.vcloud
+    from cloudhands.burst.control import Connections
+    from cloudhands.common.discovery import providers
+
+    conns = Connections()
+    for config in (cfg for p in providers.values() for cfg in p):
+        try:
+            conns(config)
+        except Exception as e:
+            log.warning(e)
+
+
+class WorkerPool:
+    """
+    Holds a single process pool executor, shared by the agents which
+    call the libcloud driver.
+
+    The pool size is read from the `processes` option in the `workers`
+    section of the configuration. It defaults to `size`.
+    """
+
+    _shared_state = {}
+
+    size = 4
+
+    def __init__(self, config=None):
+        self.__dict__ = self._shared_state
+        if not hasattr(self, "pool"):
+            self.pool = None
+            try:
+                self.size = config.getint(
+                    "workers", "processes", fallback=self.size)
+            except (AttributeError, ValueError):
+                pass
+
+    @property
+    def executor(self):
+        """
+        The executor. It is created when first needed.
+        """
+        log = logging.getLogger("cloudhands.burst.workers.executor")
+        if self.pool is None:
+            try:
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.size, initializer=warm)
+            except TypeError:
+                # Before Python 3.7 workers can't be initialised
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.size)
+            atexit.register(self.shutdown)
+            log.info("Started {} worker processes".format(self.size))
+        return self.pool
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker processes, once they finish their jobs.
+        """
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            pool.shutdown(wait=wait)